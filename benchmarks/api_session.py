@@ -0,0 +1,65 @@
+"""
+Compares a new connection per request (plain requests.get) with the pooled session of ZtmApi
+against a local mock of api.um.warszawa.pl.
+
+Usage:
+    python -m benchmarks.api_session [requests] [threads]
+"""
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import perf_counter
+
+import requests
+
+from wawbus.api import ZtmApi
+
+_BODY = json.dumps({'result': [{'Lines': '123', 'Lat': 52.0, 'Lon': 21.0, 'VehicleNumber': '1234',
+                                'Brigade': '1', 'Time': '2021-01-01 12:00:00'}]}).encode()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(_BODY)))
+        self.end_headers()
+        self.wfile.write(_BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+def _run(fn, count: int, threads: int) -> float:
+    start = perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(lambda _: fn(), range(count)))
+    return perf_counter() - start
+
+
+def main(count: int = 2000, threads: int = 5):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}/api/action'
+
+    def unpooled():
+        requests.get(f'{base_url}/busestrams_get', params={'apikey': 'bench'}).json()
+
+    api = ZtmApi('bench', pool_size=threads)
+    api.base_url = base_url
+
+    for name, fn in (('requests.get', unpooled), ('ZtmApi session', api.get_bus_positions)):
+        elapsed = _run(fn, count, threads)
+        print(f'{name:>16}: {count / elapsed:8.1f} req/s ({elapsed:.2f}s for {count} requests, {threads} threads)')
+
+    api.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
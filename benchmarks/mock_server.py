@@ -0,0 +1,112 @@
+"""
+Local mock of api.um.warszawa.pl serving a SyntheticCity, with configurable latency of every response.
+"""
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from threading import Lock, Thread
+from time import sleep
+from urllib.parse import parse_qs, urlsplit
+
+from .synthetic import SyntheticCity
+
+
+def _kv(record: dict) -> dict:
+    return {'values': [{'key': k, 'value': v} for k, v in record.items()]}
+
+
+class _Server(ThreadingHTTPServer):
+    # the default backlog of 5 drops connections of concurrent clients (e.g. collect_timetables_async),
+    # which then wait for SYN retransmits, so the benchmark would measure the mock instead of the client
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class MockZtmServer:
+    """
+    Serves busestrams_get (the next poll of the city on every request), dbtimetable_get, public_transport_routes
+    and dbstore_get (stops) on http://127.0.0.1:port/api/action, use as a context manager.
+
+    Attributes:
+        city (SyntheticCity): served data
+        latency (float): seconds every response is delayed by
+        requests (int): number of handled requests
+    """
+    city: SyntheticCity
+    latency: float
+    requests: int = 0
+
+    def __init__(self, city: SyntheticCity, latency: float = 0.0, port: int = 0):
+        """
+        Args:
+            city (SyntheticCity): served data
+            latency (float): seconds every response is delayed by
+            port (int): port to listen on, 0 picks a free one
+        """
+        self.city = city
+        self.latency = latency
+        self._polls = count()
+        self._lock = Lock()
+
+        tt = city.timetable.assign(czas=city.timetable['czas'].dt.strftime('%H:%M:%S'))
+        self._timetables = {key: [_kv(r) for r in rows[['brygada', 'czas', 'trasa']].to_dict('records')]
+                            for key, rows in tt.groupby(['nr_zespolu', 'nr_przystanku', 'bus'])}
+        self._routes = {}
+        for r in city.routes.to_dict('records'):
+            stops = self._routes.setdefault(r.pop('bus'), {}).setdefault(r.pop('direction'), {})
+            stops[r.pop('stop')] = r
+        self._stops = [_kv({k: str(v) for k, v in r.items()}) for r in city.stops.to_dict('records')]
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                body = json.dumps({'result': server._result(url.path.rsplit('/', 1)[-1], parse_qs(url.query))})
+                body = body.encode()
+                if server.latency:
+                    sleep(server.latency)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = _Server(('127.0.0.1', port), Handler)
+
+    @property
+    def base_url(self) -> str:
+        """
+        Returns:
+            str: URL to set as ZtmApi.base_url
+        """
+        return f'http://127.0.0.1:{self._server.server_port}/api/action'
+
+    def _result(self, endpoint: str, query: dict):
+        with self._lock:
+            self.requests += 1
+        if endpoint == 'busestrams_get':
+            df = self.city.snapshot(next(self._polls))
+            return df.assign(Time=df['Time'].dt.strftime('%Y-%m-%d %H:%M:%S')).to_dict('records')
+        if endpoint == 'dbtimetable_get':
+            key = (query['busstopId'][0], query['busstopNr'][0], query['line'][0])
+            return self._timetables.get(key, [])
+        if endpoint == 'public_transport_routes':
+            return self._routes
+        if endpoint == 'dbstore_get':
+            return self._stops
+        return 'Błędna metoda lub parametry wywołania'
+
+    def __enter__(self) -> 'MockZtmServer':
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,339 @@
+"""
+Measures wall time, throughput and peak RSS of the public methods of WawBus on synthetic cities
+(see benchmarks.synthetic). Collection methods talk to a local mock of the API with configurable latency.
+
+Every case runs in a fresh process, so memory freed by one case doesn't hide the peak of another,
+peak RSS is measured from the end of the case's setup (loading the data) on Linux.
+Results are saved as JSON, and can be compared with an earlier run.
+
+Usage:
+    python -m benchmarks.suite [--sizes 10k 100k 1M 10M] [--cases calculate_speed ...] [--latency 0.02]
+    python -m benchmarks.suite --compare benchmarks/results/old.json   # run and compare with an old run
+    python -m benchmarks.suite --compare old.json new.json            # only compare two runs
+"""
+import argparse
+import asyncio
+import gc
+import json
+import multiprocessing
+import platform
+import resource
+import subprocess
+import sys
+from contextlib import nullcontext, redirect_stdout
+from datetime import datetime
+from os import devnull, makedirs
+from os.path import dirname, join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from wawbus.main import WawBus
+
+from .mock_server import MockZtmServer
+from .synthetic import SIZES, SyntheticCity, ensure_city
+
+HERE = dirname(__file__)
+
+
+def _analysis(path: str, base_url: str, args: argparse.Namespace) -> WawBus:
+    wb = WawBus(dataset=join(path, "positions"))
+    wb.tt = pd.read_parquet(join(path, "timetable.parquet"))
+    wb.stops = pd.read_parquet(join(path, "stops.parquet"))
+    wb.routes = pd.read_parquet(join(path, "routes.parquet"))
+    return wb
+
+
+def _client(path: str, base_url: str, args: argparse.Namespace) -> WawBus:
+    wb = WawBus(apikey="bench", retry_count=1)
+    wb.api.base_url = base_url
+    wb.routes = pd.read_parquet(join(path, "routes.parquet"))
+    wb.routes = wb.routes[wb.routes["bus"].isin(wb.routes["bus"].unique()[:args.tt_lines])]
+    return wb
+
+
+def _load(path: str, args: argparse.Namespace) -> int:
+    return len(WawBus(dataset=join(path, "positions")).dataset)
+
+
+def _trajectories(wb: WawBus, args: argparse.Namespace) -> int:
+    wb.trajectories()
+    return len(wb.dataset)
+
+
+def _calculate_speed(wb: WawBus, args: argparse.Namespace) -> int:
+    wb.calculate_speed()
+    return len(wb.dataset)
+
+
+def _calculate_speed_along_route(wb: WawBus, args: argparse.Namespace) -> int:
+    wb.calculate_speed(along_route=True)
+    return len(wb.dataset)
+
+
+def _calculate_late(wb: WawBus, args: argparse.Namespace) -> int:
+    wb.calculate_late()
+    return len(wb.dataset)
+
+
+def _calculate_late_parallel(wb: WawBus, args: argparse.Namespace) -> int:
+    wb.calculate_late(n_jobs=args.jobs)
+    return len(wb.dataset)
+
+
+def _iter_late(wb: WawBus, args: argparse.Namespace) -> int:
+    for _ in wb.iter_late():
+        pass
+    return len(wb.dataset)
+
+
+def _calculate_late_to_parquet(wb: WawBus, args: argparse.Namespace) -> int:
+    with TemporaryDirectory() as tmp:
+        wb.calculate_late_to_parquet(join(tmp, "late.parquet"))
+    return len(wb.dataset)
+
+
+def _nearest_stops(wb: WawBus, args: argparse.Namespace) -> int:
+    wb.nearest_stops()
+    return len(wb.dataset)
+
+
+def _calculate_late_at_stops(wb: WawBus, args: argparse.Namespace) -> int:
+    wb.calculate_late_at_stops()
+    return len(wb.dataset)
+
+
+def _collect_positions(wb: WawBus, args: argparse.Namespace) -> int:
+    wb.collect_positions(args.polls, sleep_between=0)
+    return len(wb.dataset)
+
+
+def _collect_stops(wb: WawBus, args: argparse.Namespace) -> int:
+    wb.collect_stops()
+    return len(wb.stops)
+
+
+def _collect_routes(wb: WawBus, args: argparse.Namespace) -> int:
+    wb.collect_routes()
+    return len(wb.routes)
+
+
+def _collect_timetables(wb: WawBus, args: argparse.Namespace) -> int:
+    wb.collect_timetables()
+    return len(wb.tt)
+
+
+def _collect_timetables_async(wb: WawBus, args: argparse.Namespace) -> int:
+    asyncio.run(wb.collect_timetables_async())
+    return len(wb.tt)
+
+
+# name: (setup(city directory, mock API URL, options), case(result of setup, options) -> number of processed rows),
+# analysis cases count rows of the dataset, collection cases count collected rows
+CASES = {
+    "load": (lambda path, base_url, args: path, _load),
+    "trajectories": (_analysis, _trajectories),
+    "calculate_speed": (_analysis, _calculate_speed),
+    "calculate_speed_along_route": (_analysis, _calculate_speed_along_route),
+    "calculate_late": (_analysis, _calculate_late),
+    "calculate_late_parallel": (_analysis, _calculate_late_parallel),
+    "iter_late": (_analysis, _iter_late),
+    "calculate_late_to_parquet": (_analysis, _calculate_late_to_parquet),
+    "nearest_stops": (_analysis, _nearest_stops),
+    "calculate_late_at_stops": (_analysis, _calculate_late_at_stops),
+    "collect_positions": (_client, _collect_positions),
+    "collect_stops": (_client, _collect_stops),
+    "collect_routes": (_client, _collect_routes),
+    "collect_timetables": (_client, _collect_timetables),
+    "collect_timetables_async": (_client, _collect_timetables_async),
+}
+COLLECTION = {case for case in CASES if case.startswith("collect_")}
+
+
+def _status_mb(field: str) -> float:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+    raise KeyError(field)
+
+
+def _reset_peak() -> bool:
+    """
+    Reset the peak RSS (VmHWM) of this process, only possible on Linux
+
+    Returns:
+        bool: whether it was reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_mb() -> float:
+    try:
+        return _status_mb("VmHWM")
+    except (OSError, KeyError):
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2 if sys.platform == "darwin" else 1024)
+
+
+def _run_case(case: str, path: str, base_url: str, args: argparse.Namespace, conn):
+    setup, run = CASES[case]
+    # a spawned process inherits the spawn start method, process pools of the case should use the platform default
+    multiprocessing.set_start_method(None, force=True)
+    with open(devnull, "w") as null, redirect_stdout(null):
+        wb = setup(path, base_url, args)
+        gc.collect()
+        try:
+            base = _status_mb("VmRSS")
+        except (OSError, KeyError):
+            base = _peak_mb()
+        _reset_peak()
+
+        start = perf_counter()
+        rows = run(wb, args)
+        seconds = perf_counter() - start
+    conn.send({"rows": int(rows), "seconds": seconds, "base_rss_mb": base, "peak_rss_mb": _peak_mb()})
+    conn.close()
+
+
+def measure(case: str, path: str, base_url: str, args: argparse.Namespace) -> dict:
+    """
+    Run a case in a fresh process
+
+    Args:
+        case (str): name of the case in CASES
+        path (str): directory of the city (see ensure_city)
+        base_url (str): URL of the mock API
+        args (argparse.Namespace): options of the suite
+
+    Returns:
+        dict: rows, seconds, base_rss_mb and peak_rss_mb of the case
+
+    Raises:
+        RuntimeError: when the case fails
+    """
+    ctx = multiprocessing.get_context("spawn")
+    recv, send = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_run_case, args=(case, path, base_url, args, send))
+    process.start()
+    send.close()
+    try:
+        result = recv.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None or process.exitcode != 0:
+        raise RuntimeError(f"{case} failed with exit code {process.exitcode}")
+    return result
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _meta(args: argparse.Namespace) -> dict:
+    return {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": multiprocessing.cpu_count(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "pyarrow": pa.__version__,
+        "seed": args.seed,
+        "latency": args.latency,
+        "jobs": args.jobs,
+        "polls": args.polls,
+        "tt_lines": args.tt_lines,
+    }
+
+
+def _print_result(r: dict):
+    print(f"{r['case']:>27} {r['size']:>5} {r['rows']:>10} rows {r['seconds']:9.3f}s "
+          f"{r['rows'] / r['seconds'] if r['seconds'] else 0:14,.0f} rows/s "
+          f"peak {r['peak_rss_mb']:8.1f} MB (base {r['base_rss_mb']:.1f} MB)")
+
+
+def compare(old: dict, new: dict):
+    """
+    Print time and peak RSS of new results relative to old ones, for cases present in both
+
+    Args:
+        old (dict): saved results
+        new (dict): saved results
+    """
+    print(f"Comparing {new['meta']['commit']} ({new['meta']['time']}) with {old['meta']['commit']} "
+          f"({old['meta']['time']})")
+    before = {(r["case"], r["size"]): r for r in old["results"]}
+    for r in new["results"]:
+        o = before.get((r["case"], r["size"]))
+        if o is None:
+            continue
+        print(f"{r['case']:>27} {r['size']:>5} time {o['seconds']:9.3f}s -> {r['seconds']:9.3f}s "
+              f"({r['seconds'] / o['seconds'] if o['seconds'] else float('inf'):5.2f}x) "
+              f"peak {o['peak_rss_mb']:8.1f} -> {r['peak_rss_mb']:8.1f} MB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark WawBus on synthetic data")
+    parser.add_argument("--sizes", nargs="+", default=["10k", "100k", "1M"],
+                        help=f"numbers of positions, {', '.join(SIZES)} or a number of rows")
+    parser.add_argument("--cases", nargs="+", default=list(CASES), choices=list(CASES), metavar="CASE",
+                        help=f"cases to run: {', '.join(CASES)}")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the synthetic data")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds every mock API response is delayed by")
+    parser.add_argument("--jobs", type=int, default=-1, help="n_jobs of calculate_late_parallel, all CPUs by default")
+    parser.add_argument("--polls", type=int, default=20, help="number of polls of collect_positions")
+    parser.add_argument("--tt-lines", type=int, default=5, help="number of lines of collect_timetables")
+    parser.add_argument("--repeat", type=int, default=1, help="runs of every case, the fastest one is kept")
+    parser.add_argument("--data-dir", default=join(HERE, "data"), help="directory of generated data")
+    parser.add_argument("--output", help="results file, benchmarks/results/<time>-<commit>.json by default")
+    parser.add_argument("--compare", nargs="+", metavar="RESULTS",
+                        help="compare with an earlier results file, or only compare two results files")
+    args = parser.parse_args(argv)
+
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[0]) as f, open(args.compare[1]) as g:
+            compare(json.load(f), json.load(g))
+        return
+
+    results = []
+    for size in args.sizes:
+        path = ensure_city(args.data_dir, size, args.seed)
+        city = SyntheticCity.load(path) if COLLECTION.intersection(args.cases) else None
+        server = MockZtmServer(city, args.latency) if city is not None else None
+        with server if server is not None else nullcontext():
+            for case in args.cases:
+                runs = [measure(case, path, server.base_url if server else "", args) for _ in range(args.repeat)]
+                result = dict(min(runs, key=lambda r: r["seconds"]), case=case, size=size)
+                result["peak_rss_mb"] = max(r["peak_rss_mb"] for r in runs)
+                results.append(result)
+                _print_result(result)
+
+    out = {"meta": _meta(args), "results": results}
+    output = args.output or join(HERE, "results", f"{datetime.now():%Y%m%d-%H%M%S}-{out['meta']['commit']}.json")
+    makedirs(dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(out, f, indent=2)
+    print(f"Saved results to {output}")
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            compare(json.load(f), out)
+
+
+if __name__ == "__main__":
+    main()
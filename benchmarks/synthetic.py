@@ -0,0 +1,273 @@
+"""
+Deterministic synthetic data in the formats used by WawBus: bus positions, stops, routes and a weekday timetable
+of a Warsaw-sized network.
+
+Every line is a chain of stops wandering out from a random point around the city centre, its brigades shuttle
+between the terminals at a constant speed with a fixed delay, so positions, routes and the timetable agree with
+each other and calculate_late finds a departure for almost every position. The same rows and seed always give
+the same data.
+"""
+from math import ceil, cos, radians
+from os import makedirs
+from os.path import isfile, join
+
+import numpy as np
+import pandas as pd
+
+from wawbus.util.storage import read_frame, write_frame
+
+SIZES = {"10k": 10_000, "100k": 100_000, "1M": 1_000_000, "10M": 10_000_000}
+
+CENTER = (52.2297, 21.0122)
+CITY_RADIUS = 9000  # meters
+DATE = "2024-01-08"  # a Monday, so positions use the weekday timetable
+FIRST_POLL = 5 * 3600  # seconds from 00:00:00
+POLL_INTERVAL = 10
+SERVICE_HOURS = (5 * 3600, 24 * 3600)  # timetable covers the whole service day
+
+MAX_VEHICLES = 1600
+VEHICLES_PER_LINE = 8
+ROWS_PER_VEHICLE = 400  # polls of the smaller sizes
+STOPS_PER_LINE = 24
+STOP_SPACING = 450  # meters
+OPPOSITE_STOP = 15  # meters between the stops of both directions
+BUS_SPEED = 6.0  # meters per second
+MAX_DELAY = 300  # seconds, negative delays are early buses
+REPEAT_RATE = 0.1  # fraction of positions repeating the previous fix, like the API does
+GPS_NOISE = 3.0  # meters
+
+_M_PER_DEG_LAT = 111_320.0
+_M_PER_DEG_LON = _M_PER_DEG_LAT * cos(radians(CENTER[0]))
+
+
+def parse_size(size: str) -> int:
+    """
+    Args:
+        size (str): one of SIZES or a number of rows
+
+    Returns:
+        int: number of rows
+    """
+    return SIZES[size] if size in SIZES else int(size)
+
+
+class SyntheticCity:
+    """
+    Synthetic network with positions of its buses
+
+    Attributes:
+        positions (pd.DataFrame): bus positions, ordered by poll like collect_positions stores them
+        stops (pd.DataFrame): stop locations with 'zespol', 'slupek', 'szer_geo', 'dlug_geo' columns
+        routes (pd.DataFrame): routes with the same columns as WawBus.routes
+        timetable (pd.DataFrame): weekday timetable with the same columns as WawBus.tt
+        vehicles (int): number of vehicles in every poll
+        polls (int): number of polls
+    """
+    positions: pd.DataFrame
+    stops: pd.DataFrame
+    routes: pd.DataFrame
+    timetable: pd.DataFrame
+    vehicles: int
+    polls: int
+
+    def __init__(self, rows: int, seed: int = 0):
+        """
+        Args:
+            rows (int): number of positions
+            seed (int): random seed
+        """
+        rng = np.random.default_rng(seed)
+        self.vehicles = int(np.clip(rows // ROWS_PER_VEHICLE, 1, MAX_VEHICLES))
+        self.polls = ceil(rows / self.vehicles)
+        n_lines = max(1, self.vehicles // VEHICLES_PER_LINE)
+
+        self._line_names = np.array([str(100 + i) for i in range(n_lines)], dtype=object)
+        self._stop_xy, self._stop_dist = self._layout(rng, n_lines)
+
+        vehicle = np.arange(self.vehicles)
+        self._line = vehicle % n_lines
+        self._brigade = np.array([str(b + 1) for b in vehicle // n_lines], dtype=object)
+        length = self._stop_dist[self._line, -1]
+        self._phase = rng.uniform(0, 2 * length)  # where the brigade is at FIRST_POLL on schedule
+        self._delay = rng.integers(-MAX_DELAY // 5, MAX_DELAY, self.vehicles)
+        self._lag = rng.integers(0, POLL_INTERVAL, self.vehicles)  # age of the fix when it's polled
+
+        self.stops = self._stops_frame()
+        self.routes = self._routes_frame()
+        self.timetable = self._timetable_frame()
+        self.positions = self._positions_frame(rng, rows)
+
+    @staticmethod
+    def _layout(rng: np.random.Generator, n_lines: int):
+        """
+        Returns:
+            tuple: stop offsets from CENTER in meters (lines x stops x 2),
+                distances of stops along their line in meters (lines x stops)
+        """
+        r = CITY_RADIUS * np.sqrt(rng.uniform(0, 1, n_lines))
+        angle = rng.uniform(0, 2 * np.pi, n_lines)
+        start = np.stack([r * np.cos(angle), r * np.sin(angle)], axis=1)
+
+        # heading drifts a little at every stop, lines head roughly away from their start
+        heading = angle[:, None] + np.pi + np.cumsum(rng.normal(0, 0.3, (n_lines, STOPS_PER_LINE - 1)), axis=1)
+        step = rng.uniform(0.7, 1.3, (n_lines, STOPS_PER_LINE - 1)) * STOP_SPACING
+        offsets = np.stack([step * np.cos(heading), step * np.sin(heading)], axis=2)
+        xy = np.concatenate([start[:, None, :], start[:, None, :] + np.cumsum(offsets, axis=1)], axis=1)
+        dist = np.concatenate([np.zeros((n_lines, 1)), np.cumsum(step, axis=1)], axis=1)
+        return xy, dist
+
+    @staticmethod
+    def _lat_lon(xy: np.ndarray):
+        return CENTER[0] + xy[..., 1] / _M_PER_DEG_LAT, CENTER[1] + xy[..., 0] / _M_PER_DEG_LON
+
+    def _zespol(self) -> np.ndarray:
+        n_lines = len(self._line_names)
+        return np.array([f"{1000 + i}" for i in range(n_lines * STOPS_PER_LINE)],
+                        dtype=object).reshape(n_lines, STOPS_PER_LINE)
+
+    def _stops_frame(self) -> pd.DataFrame:
+        lat, lon = self._lat_lon(self._stop_xy)
+        zespol = self._zespol().ravel()
+        return pd.DataFrame({
+            "zespol": np.concatenate([zespol, zespol]),
+            "slupek": np.repeat(np.array(["01", "02"], dtype=object), len(zespol)),
+            "szer_geo": np.concatenate([lat.ravel(), lat.ravel() + OPPOSITE_STOP / _M_PER_DEG_LAT]),
+            "dlug_geo": np.concatenate([lon.ravel(), lon.ravel()]),
+        })
+
+    def _routes_frame(self) -> pd.DataFrame:
+        zespol = self._zespol()
+        rows = []
+        for line, name in enumerate(self._line_names):
+            for direction, slupek, order in (("TP-A", "01", range(STOPS_PER_LINE)),
+                                             ("TP-B", "02", range(STOPS_PER_LINE - 1, -1, -1))):
+                start = self._stop_dist[line, order[0]]
+                for i, stop in enumerate(order):
+                    rows.append({
+                        "bus": name, "direction": direction, "stop": str(i + 1), "nr_zespolu": zespol[line, stop],
+                        "nr_przystanku": slupek, "ulica_id": str(line), "typ": "1",
+                        "odleglosc": str(int(abs(self._stop_dist[line, stop] - start))),
+                    })
+        return pd.DataFrame(rows, dtype=str)
+
+    def _timetable_frame(self) -> pd.DataFrame:
+        """
+        Departures from every stop whenever the brigade passes it on schedule during SERVICE_HOURS
+        """
+        zespol = self._zespol()
+        first, last = SERVICE_HOURS
+        parts = []
+        for v in range(self.vehicles):
+            line = self._line[v]
+            dist = self._stop_dist[line]
+            cycle = 2 * dist[-1]
+            # scheduled position s(t) = phase + speed * (t - FIRST_POLL) (mod cycle) passes stop k at distance
+            # dist[k] going out and at cycle - dist[k] coming back
+            at = np.concatenate([dist, cycle - dist])
+            n = np.arange(np.floor((BUS_SPEED * (first - FIRST_POLL) + self._phase[v]) / cycle) - 1,
+                          np.ceil((BUS_SPEED * (last - FIRST_POLL) + self._phase[v]) / cycle) + 1)
+            t = FIRST_POLL + (at[None, :] - self._phase[v] + n[:, None] * cycle) / BUS_SPEED
+            stop = np.tile(np.concatenate([np.arange(STOPS_PER_LINE)] * 2), len(n))
+            back = np.tile(np.repeat([False, True], STOPS_PER_LINE), len(n))
+            t = t.ravel()
+            keep = (t >= first) & (t < last)
+            parts.append(pd.DataFrame({
+                "bus": self._line_names[line],
+                "nr_zespolu": zespol[line, stop[keep]],
+                "nr_przystanku": np.where(back[keep], "02", "01").astype(object),
+                "brygada": self._brigade[v],
+                "czas": np.datetime64(DATE) + np.round(t[keep]).astype("timedelta64[s]"),
+                "trasa": np.where(back[keep], "TP-B", "TP-A").astype(object),
+            }))
+        tt = pd.concat(parts, ignore_index=True)
+        tt["czas"] = tt["czas"].astype("datetime64[ns]")
+        return tt.sort_values(["bus", "nr_zespolu", "nr_przystanku", "czas", "brygada"], kind="stable",
+                              ignore_index=True)
+
+    def _positions_frame(self, rng: np.random.Generator, rows: int) -> pd.DataFrame:
+        poll = np.repeat(np.arange(self.polls), self.vehicles)[:rows]
+        vehicle = np.tile(np.arange(self.vehicles), self.polls)[:rows]
+        # a repeated fix is the fix of the previous poll, with the same time and coordinates
+        poll = np.maximum(poll - (rng.random(rows) < REPEAT_RATE), 0)
+
+        t = FIRST_POLL + poll * POLL_INTERVAL - self._lag[vehicle]
+        line = self._line[vehicle]
+        dist = self._stop_dist
+        s = (self._phase[vehicle] + BUS_SPEED * (t - self._delay[vehicle] - FIRST_POLL)) % (2 * dist[line, -1])
+        s = np.where(s > dist[line, -1], 2 * dist[line, -1] - s, s)
+
+        # interpolate along all lines at once, every line gets its own stretch of the axis
+        stretch = dist[:, -1].max() + 1
+        xp = (dist + stretch * np.arange(len(dist))[:, None]).ravel()
+        x = np.interp(s + stretch * line, xp, self._stop_xy[..., 0].ravel())
+        y = np.interp(s + stretch * line, xp, self._stop_xy[..., 1].ravel())
+
+        noise = rng.normal(0, GPS_NOISE, (self.polls, self.vehicles, 2))[poll, vehicle]
+        lat, lon = self._lat_lon(np.stack([x, y], axis=1) + noise)
+        return pd.DataFrame({
+            "Lat": lat,
+            "Lon": lon,
+            "Time": np.datetime64(DATE, "ns") + (t * 1_000_000_000).astype("timedelta64[ns]"),
+            "Lines": self._line_names[line],
+            "VehicleNumber": np.array([str(1000 + v) for v in range(self.vehicles)], dtype=object)[vehicle],
+            "Brigade": self._brigade[vehicle],
+        })
+
+    @classmethod
+    def load(cls, path: str) -> "SyntheticCity":
+        """
+        Args:
+            path (str): directory of a saved city (see save)
+
+        Returns:
+            SyntheticCity: the saved city
+        """
+        city = cls.__new__(cls)
+        city.positions = read_frame(join(path, "positions.arrow"))
+        for name in ("stops", "routes", "timetable"):
+            setattr(city, name, pd.read_parquet(join(path, f"{name}.parquet")))
+        city.vehicles = city.positions["VehicleNumber"].nunique()
+        city.polls = ceil(len(city.positions) / city.vehicles)
+        return city
+
+    def snapshot(self, poll: int) -> pd.DataFrame:
+        """
+        Args:
+            poll (int): poll number, wraps around self.polls
+
+        Returns:
+            pd.DataFrame: positions returned by the API in that poll
+        """
+        poll %= self.polls
+        return self.positions.iloc[poll * self.vehicles:(poll + 1) * self.vehicles]
+
+    def save(self, path: str):
+        """
+        Save the city to a directory, positions as positions.arrow so WawBus(dataset=...) memory maps them
+
+        Args:
+            path (str): directory, created if needed
+        """
+        makedirs(path, exist_ok=True)
+        write_frame(self.positions, join(path, "positions.arrow"))
+        for name in ("stops", "routes", "timetable"):
+            getattr(self, name).to_parquet(join(path, f"{name}.parquet"))
+
+
+def ensure_city(data_dir: str, size: str, seed: int = 0) -> str:
+    """
+    Generate and save a city once, later calls reuse the saved files
+
+    Args:
+        data_dir (str): directory for generated cities
+        size (str): one of SIZES or a number of rows
+        seed (int): random seed
+
+    Returns:
+        str: directory of the city (see SyntheticCity.save)
+    """
+    path = join(data_dir, f"{size}-{seed}")
+    if not isfile(join(path, "timetable.parquet")):
+        print(f"Generating {size} rows (seed {seed}) in {path}")
+        SyntheticCity(parse_size(size), seed).save(path)
+    return path
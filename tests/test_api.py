@@ -1,6 +1,13 @@
+import asyncio
+import re
+
+import requests
 import requests_mock
+from aioresponses import aioresponses
 
 from wawbus.api import ZtmApi, ZtmApiException
+from wawbus.api.aio import AsyncZtmApi, RateLimiter
+from wawbus.util.metrics import Metrics
 
 
 def test_bus_positions_ok():
@@ -30,7 +37,7 @@ def test_bus_positions_ok():
 
 def test_bus_positions_retry():
     with requests_mock.Mocker() as m:
-        api = ZtmApi('test_key', retry_count=3)
+        api = ZtmApi('test_key', retry_count=3, backoff=0)
         m.get(
             'https://api.um.warszawa.pl/api/action/busestrams_get',
             [{'json': {'result': 'error'}, 'status_code': 200}] +
@@ -66,3 +73,81 @@ def test_bus_positions_error():
             assert isinstance(e, ZtmApiException)
         else:
             assert False
+
+
+def test_backoff_and_timeout(monkeypatch):
+    delays = []
+    monkeypatch.setattr('wawbus.api.sleep', delays.append)
+    monkeypatch.setattr('wawbus.api.random', lambda: 1.0)
+    with requests_mock.Mocker() as m:
+        api = ZtmApi('test_key', retry_count=4, timeout=5, backoff=0.5)
+        m.get(
+            'https://api.um.warszawa.pl/api/action/busestrams_get',
+            [{'json': {'result': 'error'}, 'status_code': 200}] * 3 +
+            [{'json': {'result': [{'Lines': '123'}]}, 'status_code': 200}]
+        )
+        assert api.get_bus_positions() == [{'Lines': '123'}]
+        assert delays == [0.5, 1.0, 2.0]
+        assert all(r.timeout == 5 for r in m.request_history)
+
+
+def test_async_bus_positions_retry():
+    async def run():
+        with aioresponses() as m:
+            url = re.compile(r'^https://api\.um\.warszawa\.pl/api/action/busestrams_get')
+            m.get(url, payload={'result': 'error'})
+            m.get(url, status=500)
+            m.get(url, payload={'result': [{'Lines': '123', 'VehicleNumber': '1234'}]})
+            async with AsyncZtmApi('test_key', retry_count=3, backoff=0) as api:
+                return await api.get_bus_positions()
+
+    assert asyncio.run(run()) == [{'Lines': '123', 'VehicleNumber': '1234'}]
+
+
+def test_rate_limiter():
+    async def run():
+        limiter = RateLimiter(100)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for _ in range(11):
+            await limiter.acquire()
+        return loop.time() - start
+
+    assert asyncio.run(run()) >= 0.09
+
+
+def test_request_metrics():
+    metrics = Metrics()
+    with requests_mock.Mocker() as m:
+        api = ZtmApi('test_key', retry_count=3, backoff=0, metrics=metrics)
+        m.get(
+            'https://api.um.warszawa.pl/api/action/busestrams_get',
+            [
+                {'exc': requests.exceptions.ConnectTimeout},
+                {'json': {'result': 'error'}, 'status_code': 200},
+                {'json': {'result': [{'Lines': '123'}]}, 'status_code': 200},
+            ]
+        )
+        api.get_bus_positions()
+
+    endpoint = 'busestrams_get'
+    assert metrics.counter('wawbus_api_errors_total').value(endpoint=endpoint, error='ConnectTimeout') == 1
+    assert metrics.counter('wawbus_api_errors_total').value(endpoint=endpoint, error='ZtmApiException') == 1
+    assert metrics.counter('wawbus_api_retries_total').value(endpoint=endpoint) == 2
+    assert metrics.counter('wawbus_api_failures_total').value(endpoint=endpoint) == 0
+    assert metrics.histogram('wawbus_api_request_seconds').count(endpoint=endpoint) == 3
+    assert 'wawbus_api_request_seconds_count{endpoint="busestrams_get"} 3\n' in metrics.exposition()
+
+
+def test_resize_pool():
+    api = ZtmApi('test_key', pool_size=4)
+    adapter = api.session.get_adapter('https://api.um.warszawa.pl')
+    api.resize_pool(4)
+    assert api.session.get_adapter('https://api.um.warszawa.pl') is adapter
+
+    closed = []
+    adapter.close = lambda: closed.append(adapter)
+    api.resize_pool(8)
+    assert closed == [adapter]
+    assert api.session.get_adapter('https://api.um.warszawa.pl')._pool_maxsize == 8
+    assert api.session.get_adapter('http://127.0.0.1') is api.session.get_adapter('https://api.um.warszawa.pl')
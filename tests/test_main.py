@@ -1,12 +1,34 @@
+import asyncio
+import io
+import json
+import os
+import re
+from threading import Event
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
 import requests_mock
+from aioresponses import aioresponses
 
 from wawbus import WawBus
+from wawbus.constants import _STOPS_URL, _TIMETABLE_URL
+from wawbus.util.cache import RemoteCache
+from wawbus.util.dtypes import compact_positions
+from wawbus.util.metrics import Metrics
+from wawbus.util.schedule import PollScheduler
+from wawbus.util.storage import PositionsStore, PositionsWriter, RollingPositionsWriter, write_frame
 
 
 def _wraprow(*row):
     return {"result": row}
 
 
+def _kv(**values):
+    return {'values': [{'key': k, 'value': v} for k, v in values.items()]}
+
+
 def _mkrow(lat, lon, time, vehicle):
     return ({
         "Lat": lat,
@@ -33,12 +55,13 @@ def test_collect_positions():
             ]
         )
         wb = WawBus(apikey='test_key')
-        wb.collect_positions(2, 0)
+        wb.api.backoff = 0
+        wb.collect_positions(2, 0, deduplicate=False)
         assert len(wb.dataset) == 2
-        assert wb.dataset['Lat'].values[0] == 52.2296133
-        assert wb.dataset['Lon'].values[0] == 21.0123688
-        assert wb.dataset['Lat'].values[1] == 52.2296133
-        assert wb.dataset['Lon'].values[1] == 21.0123688
+        assert wb.dataset['Lat'].values[0] == pytest.approx(52.2296133, abs=1e-5)
+        assert wb.dataset['Lon'].values[0] == pytest.approx(21.0123688, abs=1e-5)
+        assert wb.dataset['Lat'].values[1] == pytest.approx(52.2296133, abs=1e-5)
+        assert wb.dataset['Lon'].values[1] == pytest.approx(21.0123688, abs=1e-5)
         assert wb.dataset['VehicleNumber'].values[0] == '1234'
         assert wb.dataset['VehicleNumber'].values[1] == '1234'
         assert wb.dataset['Brigade'].values[0] == '1'
@@ -64,6 +87,7 @@ def test_speed():
             ]
         )
         wb = WawBus(apikey='test_key')
+        wb.api.backoff = 0
         wb.collect_positions(2, 0)
         df = wb.calculate_speed()
         assert len(df) == 2
@@ -95,6 +119,7 @@ def test_speed_2buses():
         )
 
         wb = WawBus(apikey='test_key')
+        wb.api.backoff = 0
         wb.collect_positions(2, 0)
         df = wb.calculate_speed()
         df = df.dropna()
@@ -102,3 +127,570 @@ def test_speed_2buses():
 
         assert abs(df['Speed'].values[0] - 41.31) < epsilon
         assert abs(df['Speed'].values[1] - 44.3) < epsilon
+
+
+def test_collect_positions_schedule_metrics():
+    class Clock:
+        now = 103.0
+
+        def __call__(self):
+            return self.now
+
+        def sleep(self, seconds):
+            self.now += seconds
+
+    clock = Clock()
+
+    def positions(request, context):
+        clock.now += 25 if clock.now == 110 else 2  # the first poll takes longer than two intervals
+        return _wraprow(_mkrow(52.2296133, 21.0123688, f'2021-01-01 12:00:{int(clock.now) % 60:02}', '1234'))
+
+    with requests_mock.Mocker() as m:
+        m.get('https://api.um.warszawa.pl/api/action/busestrams_get', json=positions)
+        wb = WawBus(apikey='test_key', metrics=Metrics())
+        wb.collect_positions(3, scheduler=PollScheduler(10, clock=clock, sleep_fn=clock.sleep))
+
+    # ticks at 110, 135 (130 is late) and 140
+    interval = wb.metrics.histogram("wawbus_poll_interval_seconds")
+    assert interval.count(target="10") == 2
+    assert interval.sum(target="10") == 30
+    assert wb.metrics.counter("wawbus_poll_ticks_skipped_total").value(target="10") == 1
+    assert wb.metrics.counter("wawbus_poll_ticks_late_total").value(target="10") == 1
+    assert 'wawbus_poll_ticks_late_total{target="10"} 1' in wb.metrics.exposition()
+
+
+def test_collect_positions_compact_dtypes():
+    with requests_mock.Mocker() as m:
+        m.get('https://api.um.warszawa.pl/api/action/busestrams_get', [
+            {'json': _wraprow(_mkrow(52.2296133, 21.0123688, '2021-01-01 12:00:00', '1234')), 'status_code': 200},
+            {'json': _wraprow(_mkrow(52.2323437, 21.009987, '2021-01-01 12:00:30', '1234'),
+                              _mkrow(52.2323437, 21.009987, '2021-01-01 12:00:30', '4567')), 'status_code': 200},
+        ])
+        wb = WawBus(apikey='test_key')
+        for _ in range(2):
+            wb.collect_positions(1, 0)
+            for column in ('Lines', 'VehicleNumber', 'Brigade'):
+                assert isinstance(wb.dataset[column].dtype, pd.CategoricalDtype)
+            assert wb.dataset['Lat'].dtype == np.float32
+            assert wb.dataset['Lon'].dtype == np.float32
+
+    # a vehicle seen for the first time extends the categories, old rows keep their values
+    assert list(wb.dataset['VehicleNumber']) == ['1234', '1234', '4567']
+    assert list(wb.dataset['VehicleNumber'].cat.categories) == ['1234', '4567']
+
+
+def test_speed_incremental():
+    with requests_mock.Mocker() as m:
+        m.get(
+            'https://api.um.warszawa.pl/api/action/busestrams_get',
+            [
+                {'json': _wraprow(
+                    _mkrow(52.2296133, 21.0123688, '2021-01-01 12:00:00', '1234'),
+                    _mkrow(52.2323437, 21.009987, '2021-01-01 12:00:01', '1235')
+                ), 'status_code': 200},
+                {'json': _wraprow(
+                    _mkrow(52.2323437, 21.009987, '2021-01-01 12:00:30', '1234'),
+                ), 'status_code': 200},
+                {'json': _wraprow(
+                    _mkrow(52.2296133, 21.0123688, '2021-01-01 12:01:00', '1234'),
+                    _mkrow(52.2296133, 21.0123688, '2021-01-01 12:00:29', '1235'),
+                    _mkrow(52.2296133, 21.0123688, '2021-01-01 12:00:29', '1236')
+                ), 'status_code': 200},
+            ]
+        )
+
+        wb = WawBus(apikey='test_key', metrics=Metrics())
+        wb.api.backoff = 0
+        wb.collect_positions(2, 0)
+        first = wb.calculate_speed()
+        assert len(first) == 3
+        assert len(first.dropna()) == 1
+
+        wb.collect_positions(1, 0)
+        incremental = wb.calculate_speed()
+        assert len(incremental) == 6
+
+        wb._speed_of = None  # force full recalculation
+        full = wb.calculate_speed()
+        assert np.allclose(incremental['Speed'].values, full['Speed'].values, equal_nan=True)
+        assert len(incremental.dropna()) == 3
+
+        # only steps which ran are timed
+        assert wb._steps.count(step="speed_incremental") == 1
+        assert wb._steps.count(step="speed_full") == 2
+
+
+def test_collect_positions_stream(tmp_path):
+    path = str(tmp_path / "positions.parquet")
+    with requests_mock.Mocker() as m:
+        m.get(
+            'https://api.um.warszawa.pl/api/action/busestrams_get',
+            [
+                {'json': _wraprow(_mkrow(52.2296133, 21.0123688, '2021-01-01 12:00:00', '1234')), 'status_code': 200},
+                {'json': {"result": "test error"}},  # this should be ignored
+                {'json': _wraprow(_mkrow(52.2323437, 21.009987, '2021-01-01 12:00:30', '1234')), 'status_code': 200},
+                {'json': _wraprow(_mkrow(52.2323437, 21.009987, '2021-01-01 12:01:00', '1234')), 'status_code': 200},
+            ]
+        )
+        wb = WawBus(apikey='test_key')
+        wb.api.backoff = 0
+        with PositionsWriter(path, batch_size=2) as writer:
+            wb.collect_positions(3, 0, writer=writer)
+        assert len(wb.dataset) == 0
+        assert writer.rows == 3
+
+    assert sorted(os.listdir(path)) == ['part-000000.parquet', 'part-000001.parquet']
+    assert writer.parts == 2
+    df = pd.read_parquet(path)
+    assert len(df) == 3
+    assert "|".join(df.columns) == "Lat|Lon|Time|Lines|VehicleNumber|Brigade"
+    assert df['Time'].values[2] == np.datetime64('2021-01-01T12:01:00')
+
+
+def test_positions_writer_readable_before_close(tmp_path):
+    path = str(tmp_path / "positions.parquet")
+    snapshot = pd.DataFrame({'Lat': [52.0], 'Lon': [21.0], 'Time': pd.to_datetime(['2021-01-01 12:00:00']),
+                             'Lines': ['1'], 'VehicleNumber': ['1'], 'Brigade': ['1']})
+
+    writer = PositionsWriter(path, batch_size=2)
+    for _ in range(5):
+        writer.write(snapshot)
+    # an unfinished file of a killed writer is ignored
+    with open(os.path.join(path, '.part-000002.parquet'), 'wb') as f:
+        f.write(b'PAR1')
+    assert len(pd.read_parquet(path)) == 4  # the fifth snapshot is still in the batch
+
+    # reopening continues the numbering
+    with PositionsWriter(path) as writer:
+        writer.write(snapshot)
+    assert len(pd.read_parquet(path)) == 5
+    assert os.path.isfile(os.path.join(path, 'part-000002.parquet'))
+
+
+def test_load_positions_writer_output(tmp_path):
+    snapshot = pd.DataFrame({'Lat': [52.0, 52.1], 'Lon': [21.0, 21.1],
+                             'Time': pd.to_datetime(['2021-01-01 12:00:00', '2021-01-01 12:00:10']),
+                             'Lines': ['1', '2'], 'VehicleNumber': ['1', '2'], 'Brigade': ['1', '1']})
+    with PositionsWriter(str(tmp_path / 'day.gzip'), compression='gzip') as writer:
+        writer.write(snapshot)
+        writer.write(snapshot)
+
+    wb = WawBus(dataset=str(tmp_path / 'day'), cache_dir=str(tmp_path / 'cache'), offline=True)
+    assert len(wb.dataset) == 4
+    assert list(wb.dataset['Lines']) == ['1', '2', '1', '2']
+
+
+def test_collect_timetables_async():
+    async def run():
+        with aioresponses() as m:
+            m.get(re.compile(r'^https://api\.um\.warszawa\.pl/api/action/public_transport_routes'), payload={
+                'result': {'123': {'TP-1': {
+                    '1': {'nr_zespolu': '1001', 'nr_przystanku': '01'},
+                    '2': {'nr_zespolu': '1002', 'nr_przystanku': '02'},
+                }}}
+            })
+            timetable = re.compile(r'^https://api\.um\.warszawa\.pl/api/action/dbtimetable_get')
+            m.get(timetable, payload={'result': [_kv(brygada='1', czas='12:00:00', trasa='TP-1')]})
+            m.get(timetable, payload={'result': 'error'}, repeat=True)
+
+            wb = WawBus(apikey='test_key', retry_count=1)
+            await wb.collect_timetables_async(concurrency=4)
+            return wb.tt
+
+    tt = asyncio.run(run())
+    assert len(tt) == 1
+    assert tt['bus'].values[0] == '123'
+    assert tt['brygada'].values[0] == '1'
+    assert tt['nr_zespolu'].values[0] in ('1001', '1002')
+
+
+def test_collect_timetables_checkpoint(tmp_path):
+    checkpoint = str(tmp_path / "tt.sqlite")
+    routes = {'result': {'123': {'TP-1': {
+        '1': {'nr_zespolu': '1001', 'nr_przystanku': '01'},
+        '2': {'nr_zespolu': '1002', 'nr_przystanku': '02'},
+    }}}}
+    ok = {'json': {'result': [_kv(brygada='1', czas='12:00:00', trasa='TP-1')]}, 'status_code': 200}
+    error = {'json': {'result': 'error'}, 'status_code': 200}
+
+    with requests_mock.Mocker() as m:
+        m.get('https://api.um.warszawa.pl/api/action/public_transport_routes', json=routes)
+        timetable = m.get('https://api.um.warszawa.pl/api/action/dbtimetable_get', [ok] + [error] * 10)
+
+        wb = WawBus(apikey='test_key', retry_count=1)
+        wb.tt_worker_count = 1
+        wb.collect_timetables(checkpoint=checkpoint)
+        assert len(wb.tt) == 1
+        assert timetable.call_count == 3  # second key failed, then was retried once
+
+        timetable = m.get('https://api.um.warszawa.pl/api/action/dbtimetable_get', [ok])
+        wb = WawBus(apikey='test_key', retry_count=1)
+        wb.collect_timetables(checkpoint=checkpoint)
+        assert len(wb.tt) == 2
+        assert set(wb.tt['nr_zespolu']) == {'1001', '1002'}
+        assert timetable.call_count == 1  # only the failed key was requested again
+
+
+def test_timetable_plan():
+    routes = {'result': {'123': {
+        'TP-1': {
+            '1': {'nr_zespolu': '1001', 'nr_przystanku': '01'},
+            '2': {'nr_zespolu': '1002', 'nr_przystanku': '02'},
+        },
+        'TX-1': {
+            '1': {'nr_zespolu': '1001', 'nr_przystanku': '01'},
+        },
+    }, '456': {'TP-1': {
+        '1': {'nr_zespolu': '1001', 'nr_przystanku': '01'},
+    }}}}
+
+    with requests_mock.Mocker() as m:
+        m.get('https://api.um.warszawa.pl/api/action/public_transport_routes', json=routes)
+        wb = WawBus(apikey='test_key')
+        plan = wb._timetable_plan()
+        assert len(wb.routes) == 4
+        keys = sorted((p['bus'], p['nr_zespolu']) for p in plan)
+        assert keys == [('123', '1001'), ('123', '1002'), ('456', '1001')]
+
+
+def test_collect_timetables_pipeline():
+    def timetable(request, context):
+        stop = int(request.qs['busstopid'][0])
+        if stop % 10 == 0:
+            return {'result': 'error'}
+        if stop % 10 == 1:
+            return {'result': 'No result'}  # endpoint with no timetable emits nothing
+        return {'result': [_kv(brygada=str(b), czas='12:00:00', trasa='TP-1') for b in range(2)]}
+
+    routes = {'result': {'123': {'TP-1': {
+        str(i): {'nr_zespolu': str(i), 'nr_przystanku': '01'} for i in range(2000)
+    }}}}
+
+    with requests_mock.Mocker() as m:
+        m.get('https://api.um.warszawa.pl/api/action/public_transport_routes', json=routes)
+        m.get('https://api.um.warszawa.pl/api/action/dbtimetable_get', json=timetable)
+        wb = WawBus(apikey='test_key', retry_count=1)
+        wb.tt_worker_count = 8
+        wb.tt_queue_size = 4
+        wb.collect_timetables()
+
+    assert len(wb.tt) == 2 * 1600
+    assert list(wb.tt['nr_zespolu'].iloc[:4]) == ['1002', '1002', '1003', '1003']
+    assert wb.tt_stats.requests == 2000
+    assert wb.tt_stats.errors == 400
+    assert wb.tt_stats.max_unprocessed <= 4
+
+
+def test_collect_timetables_invalid_response():
+    def timetable(request, context):
+        if int(request.qs['busstopid'][0]) % 2:
+            return '<html><body>502 Bad Gateway</body></html>'
+        return json.dumps({'result': [_kv(brygada='1', czas='12:00:00', trasa='TP-1')]})
+
+    routes = {'result': {'123': {'TP-1': {
+        str(i): {'nr_zespolu': str(i), 'nr_przystanku': '01'} for i in range(50)
+    }}}}
+
+    with requests_mock.Mocker() as m:
+        m.get('https://api.um.warszawa.pl/api/action/public_transport_routes', json=routes)
+        m.get('https://api.um.warszawa.pl/api/action/dbtimetable_get', text=timetable)
+        wb = WawBus(apikey='test_key', retry_count=1)
+        wb.api.backoff = 0
+        wb.tt_worker_count = 3
+        wb.collect_timetables()
+
+    # HTML pages are counted as failed requests, workers keep going
+    assert len(wb.tt) == 25
+    assert wb.tt_stats.requests == 50
+    assert wb.tt_stats.errors == 25
+
+
+def _late_wawbus():
+    wb = WawBus(apikey='test_key')
+    wb.dataset = pd.DataFrame({
+        'Lat': [52.2323437, 52.2296133, 52.2296133, 52.2323437],
+        'Lon': [21.009987, 21.0123688, 21.0123688, 21.009987],
+        'Time': pd.to_datetime(['2021-01-01 12:05:00', '2021-01-01 12:12:00',
+                                '2021-01-01 13:00:00', '2021-01-01 12:05:00']),
+        'Lines': ['123', '123', '123', '456'],
+        'VehicleNumber': ['1234', '1234', '1234', '4567'],
+        'Brigade': ['1', '1', '1', '1'],
+    })
+    wb.tt = pd.DataFrame({
+        'bus': ['123', '123', '456'],
+        'nr_zespolu': ['1001', '1002', '1001'],
+        'nr_przystanku': ['01', '01', '01'],
+        'brygada': ['1', '1', '1'],
+        'czas': pd.to_datetime(['2021-01-01 12:00:00', '2021-01-01 12:10:00', '2021-01-01 12:00:00']),
+        'trasa': ['TP-1', 'TP-1', 'TP-1'],
+    })
+    wb.stops = pd.DataFrame({
+        'zespol': ['1001', '1002'],
+        'slupek': ['01', '01'],
+        'szer_geo': [52.2296133, 52.2296133],
+        'dlug_geo': [21.0123688, 21.0123688],
+    })
+    return wb
+
+
+def test_calculate_late():
+    epsilon = 0.005
+
+    wb = _late_wawbus()
+    df = wb.calculate_late()
+    # the bus at the stop and the bus without a matching timetable entry are filtered out
+    assert len(df) == 2
+    assert set(df['Lines']) == {'123', '456'}
+    assert all(df['nr_zespolu'] == '1001')
+    assert all(abs(df['dist'] - 0.344) < epsilon)
+
+
+def test_iter_late(tmp_path):
+    wb = _late_wawbus()
+    expected = wb.calculate_late().sort_values(['Lines', 'Time'], ignore_index=True)
+
+    for hour_band in (None, 1):
+        parts = list(wb.iter_late(hour_band=hour_band))
+        assert len(parts) == 2
+        actual = pd.concat(parts).sort_values(['Lines', 'Time'], ignore_index=True)
+        pd.testing.assert_frame_equal(actual, expected)
+
+    path = str(tmp_path / "late.parquet")
+    assert wb.calculate_late_to_parquet(path) == 2
+    assert pq.ParquetFile(path).num_row_groups == 2
+
+
+def test_parallel():
+    wb = _late_wawbus()
+    # lines and brigades missing from the timetable aren't sent to processes, duplicates are dropped by processes
+    wb.dataset = pd.concat([wb.dataset, wb.dataset.iloc[:2].assign(Lines='789'),
+                            wb.dataset.iloc[:2].assign(Brigade='2'), wb.dataset.iloc[[0]]], ignore_index=True)
+
+    expected = wb.calculate_late().sort_values(['Lines', 'Time'], ignore_index=True)
+    for n_jobs in (2, 3):
+        actual = wb.calculate_late(n_jobs=n_jobs)
+        assert (actual['Lines'] != actual['Lines'].shift()).sum() == actual['Lines'].nunique()
+        pd.testing.assert_frame_equal(actual.sort_values(['Lines', 'Time'], ignore_index=True), expected)
+
+
+def test_calculate_late_at_stops():
+    wb = _late_wawbus()
+    wb.stops.loc[1, ['szer_geo', 'dlug_geo']] = [52.2323437, 21.009987]
+
+    near = wb.nearest_stops()
+    assert list(near['nr_zespolu'].fillna('')) == ['1002', '1001', '1001', '']
+
+    df = wb.calculate_late_at_stops().sort_values('Time')
+    assert list(df['nr_zespolu']) == ['1002', '1001']
+    assert list(df['delay']) == [-300, 720]
+
+
+def test_speed_along_route():
+    wb = WawBus(apikey='test_key')
+    wb.dataset = compact_positions(pd.DataFrame([
+        _mkrow(52.2, 21.0, '2021-01-01 12:00:00', '1234'),
+        _mkrow(52.208983, 21.014657, '2021-01-01 12:06:00', '1234'),
+    ]).assign(Time=lambda df: pd.to_datetime(df['Time'])))
+    # 1 km north, then 1 km east
+    wb.stops = pd.DataFrame({
+        'zespol': ['1001', '1002', '1003'],
+        'slupek': ['01', '01', '01'],
+        'szer_geo': [52.2, 52.208983, 52.208983],
+        'dlug_geo': [21.0, 21.0, 21.014657],
+    })
+    wb.routes = pd.DataFrame({
+        'bus': ['123'] * 3,
+        'direction': ['TP-1'] * 3,
+        'stop': ['1', '2', '3'],
+        'nr_zespolu': ['1001', '1002', '1003'],
+        'nr_przystanku': ['01'] * 3,
+    })
+
+    assert wb.calculate_speed()['Speed'].values[0] == pytest.approx(14.14, abs=0.1)
+    assert wb.calculate_speed(along_route=True)['Speed'].values[0] == pytest.approx(20.0, abs=0.1)
+    assert wb.calculate_speed()['Speed'].values[0] == pytest.approx(14.14, abs=0.1)
+
+    # without routes and an API key to collect them
+    wb.routes, wb.api = None, None
+    with pytest.raises(ValueError, match='wb.routes'):
+        wb.calculate_speed(along_route=True)
+
+
+def test_load_dataset_filters(tmp_path):
+    df = pd.DataFrame({
+        'Lat': [52.0, 52.1, 52.2, 52.3],
+        'Lon': [21.0, 21.1, 21.2, 21.3],
+        'Time': pd.to_datetime(['2021-01-01 12:00:00', '2021-01-01 12:00:10',
+                                '2021-01-01 13:00:00', '2021-01-01 13:00:10']),
+        'Lines': ['123', '456', '123', '456'],
+        'VehicleNumber': ['1', '2', '1', '2'],
+        'Brigade': ['1', '1', '1', '1'],
+    })
+    df.to_parquet(str(tmp_path / 'day.gzip'), index=False, compression='gzip', row_group_size=2)
+
+    wb = WawBus(dataset=str(tmp_path / 'day'), cache_dir=str(tmp_path / 'cache'),
+                columns=['Time', 'Lines', 'Lat'], lines=['123'], time_range=('2021-01-01 12:30', None))
+    assert list(wb.dataset.columns) == ['Time', 'Lines', 'Lat']
+    assert list(wb.dataset['Lat']) == pytest.approx([52.2], abs=1e-5)
+
+    wb = WawBus(dataset=str(tmp_path / 'day'), time_range=(None, '2021-01-01 12:00:10'))
+    assert list(wb.dataset['Lat']) == pytest.approx([52.0], abs=1e-5)
+
+
+def _mapped_regions(path: str):
+    with open('/proc/self/maps') as f:
+        return [tuple(int(x, 16) for x in line.split()[0].split('-')) for line in f if line.rstrip().endswith(path)]
+
+
+def test_load_dataset_arrow(tmp_path):
+    n = 200_000  # more than the default record batch size of pyarrow
+    df = pd.DataFrame({
+        'Lat': 52.0 + np.arange(n) % 3 * 0.1,
+        'Lon': 21.0 + np.arange(n) % 3 * 0.1,
+        'Time': pd.Timestamp('2021-01-01 12:00:00') + pd.to_timedelta(np.arange(n), 's'),
+        'Lines': np.array(['123', '456', '123'])[np.arange(n) % 3],
+        'VehicleNumber': np.array(['1', '2', '1'])[np.arange(n) % 3],
+        'Brigade': '1',
+    })
+    path = str(tmp_path / 'day.arrow')
+    write_frame(df, path)
+
+    wb = WawBus(dataset=str(tmp_path / 'day'), cache_dir=str(tmp_path / 'cache'), offline=True)
+    assert len(wb.dataset) == n
+    assert wb.dataset['Lat'].dtype == np.float32
+    assert isinstance(wb.dataset['Lines'].dtype, pd.CategoricalDtype)
+    if os.path.exists('/proc/self/maps'):
+        # columns point into the mapped file, nothing was copied or converted
+        regions = _mapped_regions(path)
+        for values in (wb.dataset['Lat'].values, wb.dataset['Time'].values, wb.dataset['Lines'].values.codes):
+            address = values.__array_interface__['data'][0]
+            assert any(start <= address < end for start, end in regions)
+
+    wb = WawBus(dataset=str(tmp_path / 'day'), cache_dir=str(tmp_path / 'cache'), offline=True,
+                columns=['Lat'], lines=['123'], time_range=(None, '2021-01-01 12:00:03'))
+    assert list(wb.dataset.columns) == ['Lat']
+    assert list(wb.dataset['Lat']) == pytest.approx([52.0, 52.2], abs=1e-5)
+
+
+def test_positions_store(tmp_path):
+    path = str(tmp_path / 'store')
+    with requests_mock.Mocker() as m:
+        m.get(
+            'https://api.um.warszawa.pl/api/action/busestrams_get',
+            [
+                {'json': _wraprow(_mkrow(52.2296133, 21.0123688, '2021-01-01 12:00:00', '1234')), 'status_code': 200},
+                {'json': _wraprow(_mkrow(52.2323437, 21.009987, '2021-01-01 13:00:00', '1234')), 'status_code': 200},
+                {'json': _wraprow(_mkrow(52.2323437, 21.009987, '2021-01-02 08:00:00', '1234')), 'status_code': 200},
+            ]
+        )
+        wb = WawBus(apikey='test_key')
+        with PositionsStore(path) as store:
+            wb.collect_positions(2, 0, writer=store)
+        first = sorted(p.name for p in (tmp_path / 'store').rglob('*.parquet'))
+
+        # a later collection only adds files
+        with PositionsStore(path) as store:
+            wb.collect_positions(1, 0, writer=store)
+        assert store.rows == 1
+        files = sorted(p.name for p in (tmp_path / 'store').rglob('*.parquet'))
+        assert len(files) == len(first) + 1
+        assert set(first) <= set(files)
+
+    wb = WawBus(store=path)
+    assert len(wb.dataset) == 3
+    assert "|".join(wb.dataset.columns) == "Lat|Lon|Time|Lines|VehicleNumber|Brigade"
+
+    wb = WawBus(store=path, time_range=('2021-01-01 12:30', '2021-01-02'))
+    assert list(wb.dataset['Time']) == [pd.Timestamp('2021-01-01 13:00:00')]
+
+
+def test_late_day_types(tmp_path):
+    def parquet(df):
+        buf = io.BytesIO()
+        df.to_parquet(buf, index=False)
+        return buf.getvalue()
+
+    def timetable(brigade):
+        return pd.DataFrame({
+            'bus': ['123'],
+            'nr_zespolu': ['1001'],
+            'nr_przystanku': ['01'],
+            'brygada': [brigade],
+            'czas': pd.to_datetime(['1899-12-30 12:00:00']),
+            'trasa': ['TP-1'],
+        })
+
+    stops = pd.DataFrame({'zespol': ['1001'], 'slupek': ['01'], 'szer_geo': [52.2296133], 'dlug_geo': [21.0123688]})
+
+    with requests_mock.Mocker() as m:
+        m.get(_TIMETABLE_URL.format('weekday'), content=parquet(timetable('1')))
+        m.get(_TIMETABLE_URL.format('saturday'), content=parquet(timetable('2')))
+        m.get(_STOPS_URL, content=parquet(stops))
+
+        wb = WawBus(apikey='test_key', cache_dir=str(tmp_path / 'cache'))
+        wb.dataset = compact_positions(pd.DataFrame({
+            'Lat': [52.2323437, 52.2323437],
+            'Lon': [21.009987, 21.009987],
+            # friday and saturday
+            'Time': pd.to_datetime(['2021-01-01 12:05:00', '2021-01-02 12:05:00']),
+            'Lines': ['123', '123'],
+            'VehicleNumber': ['1234', '4567'],
+            'Brigade': ['1', '2'],
+        }))
+
+        df = wb.calculate_late()
+        assert list(df['VehicleNumber']) == ['1234', '4567']
+        assert set(wb.timetables) == {'weekday', 'saturday'}
+        assert wb.timetable_index('saturday') is wb.timetable_index('saturday')
+
+        parts = list(wb.iter_late())
+        assert [list(part['VehicleNumber']) for part in parts] == [['1234'], ['4567']]
+
+        # one timetable for every day type is indexed once
+        wb.tt = timetable('1')
+        assert wb.timetable_index('weekday') is wb.timetable_index('saturday')
+        assert len(wb._tt_index) == 1
+
+
+def test_late_missing_day_type_timetable(tmp_path):
+    wb = _late_wawbus()
+    tt, wb.tt = wb.tt, None
+    buf = io.BytesIO()
+    tt.to_parquet(buf, index=False)
+
+    with requests_mock.Mocker() as m:
+        m.get(_TIMETABLE_URL.format('weekday'), content=buf.getvalue())
+        m.get(_TIMETABLE_URL.format('saturday'), status_code=404)
+        wb.cache = RemoteCache(str(tmp_path / 'cache'))
+        # a saturday is matched with the weekday timetable
+        wb.dataset = wb.dataset.assign(Time=wb.dataset['Time'] + pd.Timedelta(days=1))
+        df = wb.calculate_late()
+
+    assert len(df) == 2
+    assert wb.timetables['saturday'] is wb.timetables['weekday']
+
+
+def test_collect_until_stopped(tmp_path):
+    stop = Event()
+    polls = []
+
+    def positions(request, context):
+        polls.append(request)
+        if len(polls) == 3:
+            stop.set()  # e.g. SIGTERM during the third poll
+        return _wraprow(_mkrow(52.2296133, 21.0123688, f'2021-01-01 12:00:{len(polls):02}', '1234'))
+
+    with requests_mock.Mocker() as m:
+        m.get('https://api.um.warszawa.pl/api/action/busestrams_get', json=positions)
+        wb = WawBus(apikey='test_key')
+        with pytest.raises(ValueError):
+            wb.collect_positions(None, 0)
+
+        writer = RollingPositionsWriter(str(tmp_path / 'positions'), batch_size=10)
+        with writer:
+            wb.collect_positions(None, 0.01, writer=writer, stop=stop)
+
+    # the poll in progress is still written
+    assert len(polls) == 3
+    assert writer.rows == 3
+    assert len(pd.read_parquet(writer.files[0])) == 3
@@ -1,4 +1,23 @@
-from wawbus.util.dist import haversine
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+
+from wawbus.util.cache import RemoteCache
+from wawbus.util.dedup import FixDeduplicator
+from wawbus.util.dist import haversine, haversine_np, speed, speed_np
+from wawbus.util.dtypes import align_categories, compact_positions, memory_per_row
+from wawbus.util.metrics import Metrics
+from wawbus.util.routes import RouteIndex
+from wawbus.util.schedule import PollScheduler
+from wawbus.util.spatial import StopIndex
+from wawbus.util.storage import RollingPositionsWriter
+from wawbus.util.time import DAY_TYPES, day_type_np, timeint, timeint_np
+from wawbus.util.timetable import TimetableIndex
+from wawbus.util.trajectory import Trajectories
 
 
 def test_haversine():
@@ -6,3 +25,334 @@ def test_haversine():
     assert abs(haversine(21.1816406, 50.0077390, 19.8632813, 52.6097194) - 303.5) < epsilon
     assert abs(haversine(21.1816406, 50.0077390, 21.1816406, 50.0077390) - 0) < epsilon
     assert abs(haversine(19.3798828, 52.6097194, 176.4843750, 63.1543552) - 6989.0) < epsilon
+
+
+def test_haversine_np():
+    lon1 = np.array([21.1816406, 21.1816406, 19.3798828, np.nan])
+    lat1 = np.array([50.0077390, 50.0077390, 52.6097194, 52.0])
+    lon2 = np.array([19.8632813, 21.1816406, 176.4843750, 21.0])
+    lat2 = np.array([52.6097194, 50.0077390, 63.1543552, 52.0])
+    dist = haversine_np(lon1, lat1, lon2, lat2)
+    for i in range(3):
+        assert abs(dist[i] - haversine(lon1[i], lat1[i], lon2[i], lat2[i])) < 1e-9
+    assert np.isnan(dist[3])
+
+
+def test_speed_np():
+    df = pd.DataFrame({
+        'Lon': [21.0123688, 21.009987, 21.009987, 21.0],
+        'Lat': [52.2296133, 52.2323437, 52.2323437, 52.0],
+        'Time': pd.to_datetime(['2021-01-01 12:00:00', '2021-01-01 12:00:30',
+                                '2021-01-01 12:00:30', '2021-01-01 12:01:00']),
+        'NextLon': [21.009987, 21.009987, 21.0, np.nan],
+        'NextLat': [52.2323437, 52.2323437, 52.0, np.nan],
+        'NextTime': pd.to_datetime(['2021-01-01 12:00:30', '2021-01-01 12:00:30',
+                                    '2021-01-01 12:01:00', None]),
+    })
+    expected = df.apply(speed, axis='columns').astype(np.float64).values
+    actual = speed_np(df['Lon'].values, df['Lat'].values, df['Time'].values,
+                      df['NextLon'].values, df['NextLat'].values, df['NextTime'].values)
+    assert np.allclose(actual, expected, equal_nan=True)
+    assert np.isnan(actual[1])  # zero time delta
+    assert np.isnan(actual[3])  # no next point
+
+
+def test_compact_positions():
+    n = 1000
+    df = pd.DataFrame({
+        'Lat': 52.2 + np.arange(n) * 1e-6,
+        'Lon': 21.0 + np.arange(n) * 1e-6,
+        'Time': pd.date_range('2021-01-01', periods=n, freq='s'),
+        'Lines': [str(100 + i % 10) for i in range(n)],
+        'VehicleNumber': [str(1000 + i % 50) for i in range(n)],
+        'Brigade': [str(i % 5) for i in range(n)],
+    })
+    compact = compact_positions(df)
+    assert compact['Lat'].dtype == np.float32
+    assert compact['Lines'].dtype == 'category'
+    assert np.allclose(compact['Lat'], df['Lat'], atol=1e-5, rtol=0)
+    assert (compact['VehicleNumber'].astype(str) == df['VehicleNumber']).all()
+    assert memory_per_row(compact) * 3 < memory_per_row(df)
+
+    # coordinates which don't fit float32 precision are kept
+    assert compact_positions(pd.DataFrame({'Lat': [1e9 + 0.5]}))['Lat'].dtype == np.float64
+
+    left, right = align_categories(compact, pd.DataFrame({'bus': ['100', '999']}), ['Lines'], ['bus'])
+    assert left['Lines'].dtype == right['bus'].dtype
+    assert list(right['bus']) == ['100', '999']
+
+
+def test_fix_deduplicator():
+    def snapshot(*fixes):
+        return pd.DataFrame(fixes, columns=['VehicleNumber', 'Time', 'Lat', 'Lon']).astype({'Time': 'datetime64[ns]'})
+
+    dedup = FixDeduplicator()
+    df = dedup.filter(snapshot(('1', '2021-01-01 12:00:00', 52.0, 21.0), ('2', '2021-01-01 12:00:00', 52.1, 21.1)))
+    assert len(df) == 2
+
+    df = dedup.filter(snapshot(('1', '2021-01-01 12:00:00', 52.0, 21.0), ('2', '2021-01-01 12:00:10', 52.1, 21.1),
+                               ('3', '2021-01-01 12:00:00', 52.0, 21.0), ('3', '2021-01-01 12:00:00', 52.0, 21.0)))
+    assert list(df['VehicleNumber']) == ['2', '3']
+
+    df = dedup.filter(snapshot(('1', '2021-01-01 12:00:00', 52.0, 21.0), ('2', '2021-01-01 12:00:10', 52.1, 21.1),
+                               ('3', '2021-01-01 12:00:00', 52.0, 21.01)))
+    assert list(df['VehicleNumber']) == ['3']
+    assert (dedup.rows, dedup.dropped, len(dedup)) == (9, 4, 3)
+
+
+def test_trajectories():
+    df = pd.DataFrame({
+        'VehicleNumber': ['2', '1', '2', '1', '3'],
+        'Time': pd.to_datetime(['2021-01-01 12:00:30', '2021-01-01 12:00:30', '2021-01-01 12:00:00',
+                                '2021-01-01 12:00:00', '2021-01-01 12:00:00']),
+        'Lat': [4.0, 2.0, 3.0, 1.0, 5.0],
+    })
+    traj = Trajectories(df)
+    assert list(traj.vehicles) == ['1', '2', '3']
+    assert list(traj.offsets) == [0, 2, 4, 5]
+
+    lat = traj.take(df['Lat'].values)
+    assert list(lat) == [1.0, 2.0, 3.0, 4.0, 5.0]
+    assert np.allclose(traj.next(lat), [2.0, np.nan, 4.0, np.nan, np.nan], equal_nan=True)
+    assert list(traj.scatter(lat)) == list(df['Lat'])
+
+
+class _FakeClock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_poll_scheduler():
+    clock = _FakeClock(103.0)
+    scheduler = PollScheduler(10, clock=clock, sleep_fn=clock.sleep)
+
+    assert scheduler.wait() == 110  # aligned to wall-clock
+    clock.now += 2  # request duration doesn't shift the next tick
+    assert scheduler.wait() == 120
+    clock.now += 25  # request took longer than two intervals
+    assert scheduler.wait() == 140
+    assert clock.now == 145
+    assert scheduler.wait() == 150
+
+    stats = scheduler.stats()
+    assert stats['ticks'] == 4
+    assert stats['skipped'] == 1
+    assert stats['late'] == 1
+    assert stats['mean_interval'] == (150 - 110) / 3
+
+
+def test_rolling_positions_writer(tmp_path):
+    def snapshot(n):
+        return pd.DataFrame({
+            'Lat': np.full(n, 52.0), 'Lon': np.full(n, 21.0),
+            'Time': pd.date_range('2021-01-01', periods=n, freq='s'),
+            'Lines': ['1'] * n, 'VehicleNumber': ['1'] * n, 'Brigade': ['1'] * n,
+        })
+
+    clock = _FakeClock(1609502400.0)
+    writer = RollingPositionsWriter(str(tmp_path / 'positions'), rotate_every=3600, batch_size=3,
+                                    max_buffer_rows=10, clock=clock)
+    with writer:
+        writer.write(snapshot(2))
+        writer.write(snapshot(2))
+        assert writer.rows == 0
+        writer.write(snapshot(20))  # buffer is full before batch_size snapshots
+        assert writer.rows == 24
+        assert list(tmp_path.glob('*.part'))
+
+        clock.now += 3600
+        writer.write(snapshot(10))
+        assert len(writer.files) == 1
+        writer.write(snapshot(1))  # flushed on close
+
+    assert writer.rows == 35
+    assert len(writer.files) == 2
+    assert not list(tmp_path.glob('*.part'))
+    assert [len(pd.read_parquet(path)) for path in writer.files] == [24, 11]
+
+
+def test_timeint_np():
+    times = pd.to_datetime(['2021-01-01 00:00:00', '2021-01-01 12:34:56', '2021-01-02 23:59:59.900'])
+    actual = timeint_np(times.values)
+    assert actual.dtype == np.int32
+    assert list(actual) == [timeint(t) for t in times]
+
+
+def test_day_type_np():
+    # friday, saturday, sunday, monday
+    times = pd.to_datetime(['2021-01-01 23:59:59', '2021-01-02 00:00:00', '2021-01-03 12:00:00', '2021-01-04 08:00:00'])
+    assert [DAY_TYPES[code] for code in day_type_np(times.values)] == ['weekday', 'saturday', 'sunday', 'weekday']
+
+
+def test_timetable_index():
+    rng = np.random.default_rng(0)
+    n = 2000
+    tt_loc = pd.DataFrame({
+        'bus': rng.choice(['1', '2', '3'], n),
+        'brygada': rng.choice(['1', '2'], n),
+        'stop': np.arange(n),
+        't': rng.integers(0, 86400, n),
+    }).sort_values('t', kind='stable', ignore_index=True)
+    positions = pd.DataFrame({
+        'Lines': pd.Categorical(rng.choice(['1', '2', '3', '4'], n)),
+        'Brigade': rng.choice(['1', '2'], n),
+        't': rng.integers(0, 86400, n),
+    }).sort_values('t', kind='stable', ignore_index=True)
+
+    index = TimetableIndex(tt_loc)
+    pos = index.lookup(positions['Lines'], positions['Brigade'], positions['t'].values, 600)
+    actual = np.where(pos >= 0, index.frame['stop'].values[pos], -1)
+
+    expected = pd.merge_asof(positions.astype({'Lines': str}), tt_loc.rename(columns={'t': 'tt_t'}),
+                             left_on='t', right_on='tt_t', left_by=['Lines', 'Brigade'],
+                             right_by=['bus', 'brygada'], tolerance=600)
+    assert list(actual) == list(expected['stop'].fillna(-1).astype(int))
+    assert (pos >= 0).any() and (pos < 0).any()
+
+
+def test_stop_index():
+    rng = np.random.default_rng(0)
+    stops = pd.DataFrame({
+        'line': rng.choice(['1', '2', '3'], 300),
+        'szer_geo': 52.2 + rng.random(300) * 0.05,
+        'dlug_geo': 21.0 + rng.random(300) * 0.05,
+    })
+    index = StopIndex(stops, radius=300)
+
+    lines = rng.choice(['1', '2', '4'], 1000)
+    lat = 52.19 + rng.random(1000) * 0.07
+    lon = 20.99 + rng.random(1000) * 0.07
+    found, dist = index.query(lines, lat, lon)
+
+    for i in range(len(lines)):
+        same_line = stops[stops['line'] == lines[i]]
+        d = haversine_np(lon[i], lat[i], same_line['dlug_geo'].values, same_line['szer_geo'].values)
+        if len(d) and d.min() < 0.295:
+            assert abs(dist[i] - d.min()) < 1e-6
+        elif len(d) == 0 or d.min() > 0.305:
+            assert found[i] == -1
+
+
+def test_route_index():
+    # L-shaped line: 1 km north, then 1 km east, and the same stops back
+    stops = pd.DataFrame({
+        'zespol': ['1', '2', '3'],
+        'slupek': ['01', '01', '01'],
+        'szer_geo': [52.2, 52.208983, 52.208983],
+        'dlug_geo': [21.0, 21.0, 21.014657],
+    })
+    routes = pd.DataFrame({
+        'bus': ['1'] * 6,
+        'direction': ['A'] * 3 + ['B'] * 3,
+        'stop': ['1', '2', '3'] * 2,
+        'nr_zespolu': ['1', '2', '3', '3', '2', '1'],
+        'nr_przystanku': ['01'] * 6,
+    })
+    index = RouteIndex(routes, stops, radius=50)
+    assert index.lengths == pytest.approx([2000, 2000], rel=0.01)
+
+    # first vehicle goes from the start to the end of direction A, then back to the corner along direction B,
+    # the second one has a line without routes
+    lat = np.array([52.2, 52.208983, 52.208983, 52.2])
+    lon = np.array([21.0001, 21.014657, 21.0, 21.0])
+    travelled = index.travelled(index.line_codes(['1', '1', '1', '2']), lat, lon, np.array([2, 3]))
+    assert travelled[0] == pytest.approx(2.0, rel=0.01)
+    assert travelled[1] == pytest.approx(1.0, rel=0.01)
+    assert np.isnan(travelled[2:]).all()
+
+
+class _CachedFileHandler(BaseHTTPRequestHandler):
+    body = b'first version'
+    hits = []
+
+    def do_GET(self):
+        etag = f'"{hash(self.body)}"'
+        self.hits.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_remote_cache(tmp_path):
+    server = HTTPServer(('127.0.0.1', 0), _CachedFileHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/stops.gzip'
+    try:
+        cache = RemoteCache(str(tmp_path))
+        path = cache.fetch(url)
+        assert open(path, 'rb').read() == b'first version'
+        assert cache.fetch(url) == path  # fresh, no request
+        assert len(_CachedFileHandler.hits) == 1
+
+        cache.max_age = 0
+        assert cache.fetch(url) == path  # revalidated, not modified
+        assert _CachedFileHandler.hits[-1] is not None
+
+        _CachedFileHandler.body = b'second version'
+        assert open(cache.fetch(url), 'rb').read() == b'second version'
+
+        # corrupted object is downloaded again
+        path = cache.fetch(url)
+        with open(path, 'wb') as f:
+            f.write(b'garbage')
+        assert open(RemoteCache(str(tmp_path)).fetch(url), 'rb').read() == b'second version'
+        assert len(_CachedFileHandler.hits) == 5
+    finally:
+        server.shutdown()
+
+    offline = RemoteCache(str(tmp_path), offline=True)
+    assert open(offline.fetch(url), 'rb').read() == b'second version'
+    with pytest.raises(FileNotFoundError):
+        offline.fetch(url + '.missing')
+
+
+def test_metrics():
+    metrics = Metrics()
+    observed = []
+    metrics.subscribe(lambda name, labels, value: observed.append((name, labels, value)))
+
+    metrics.counter('polls_total', 'Polls').inc(outcome='ok')
+    metrics.counter('polls_total').inc(2, outcome='ok')
+    hist = metrics.histogram('rows', 'Rows', buckets=(10, 100))
+    for value in (5, 50, 500):
+        hist.observe(value)
+    with pytest.raises(ValueError):
+        metrics.histogram('polls_total')
+
+    assert observed[0] == ('polls_total', {'outcome': 'ok'}, 1)
+    assert metrics.exposition() == (
+        '# HELP polls_total Polls\n'
+        '# TYPE polls_total counter\n'
+        'polls_total{outcome="ok"} 3\n'
+        '# HELP rows Rows\n'
+        '# TYPE rows histogram\n'
+        'rows_bucket{le="10"} 1\n'
+        'rows_bucket{le="100"} 2\n'
+        'rows_bucket{le="+Inf"} 3\n'
+        'rows_sum 555\n'
+        'rows_count 3\n'
+    )
+
+    server = metrics.serve(0, host='127.0.0.1')
+    try:
+        url = f'http://127.0.0.1:{server.server_address[1]}'
+        assert requests.get(f'{url}/metrics').text == metrics.exposition()
+        assert requests.get(f'{url}/other').status_code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -1,6 +1,9 @@
+import signal
 from os import environ
+from threading import Event
 
 from .main import WawBus
+from .util.storage import PositionsStore, PositionsWriter, RollingPositionsWriter, read_frame, write_frame
 
 
 def __main__():
@@ -10,18 +13,38 @@ def __main__():
     parser.add_argument("--apikey", help="api.um.warszawa.pl API key. If set to 'env', will use WAWBUS_APIKEY."
                                          "environment variable")
     parser.add_argument("--type", help="What to collect",
-                        default="positions", choices=["positions", "timetable", "stops"])
+                        default="positions", choices=["positions", "timetable", "stops", "routes"])
     parser.add_argument("--count", help="number of collections", type=int, default=25)
     parser.add_argument("--retry", help="number of retries", type=int, default=3)
-    parser.add_argument("--sleep", help="sleep between collections", type=int, default=10)
+    parser.add_argument("--sleep", help="seconds between collections", type=float, default=10)
     parser.add_argument("--workers", help="number of workers when collecting timetables", type=int, default=5)
-    parser.add_argument("--output", help="output file")
+    parser.add_argument("--output", help="output file (.csv, .parquet, .gzip, or .arrow/.feather for an uncompressed "
+                                         "file which can be memory mapped)")
+    parser.add_argument("--routes", help="routes file (collected with --type routes) to plan timetable collection "
+                                         "from, instead of fetching routes")
+    parser.add_argument("--checkpoint", help="checkpoint file, allows resuming an interrupted timetable collection")
+    parser.add_argument("--stream", help="write positions after every collection as numbered files in the output "
+                                         "directory, readable while collecting (parquet and gzip only)",
+                        action="store_true")
+    parser.add_argument("--batch", help="number of collections written at once when streaming or storing", type=int,
+                        default=1)
+    parser.add_argument("--store", help="append positions to a dataset store directory partitioned by date and hour, "
+                                        "instead of writing the output file")
+    parser.add_argument("--by-line", help="also partition the store by line", action="store_true")
+    parser.add_argument("--daemon", help="collect positions until SIGTERM/SIGINT, writing rolling output "
+                                         "directories <output>-<time>.parquet (or to the store)", action="store_true")
+    parser.add_argument("--rotate", help="seconds after which the daemon starts a new output file", type=float,
+                        default=3600)
+    parser.add_argument("--rotate-size", help="megabytes after which the daemon starts a new output file", type=float)
+    parser.add_argument("--buffer", help="maximum number of rows the daemon keeps in memory before writing them",
+                        type=int, default=100_000)
+    parser.add_argument("--metrics-port", help="serve Prometheus metrics on http://localhost:PORT/metrics", type=int)
 
     args = parser.parse_args()
 
     if not args.apikey:
         raise ValueError("API key is required.")
-    if not args.output:
+    if not args.output and not args.store:
         raise ValueError("Output file is required.")
 
     if args.apikey == "env":
@@ -29,30 +52,69 @@ def __main__():
 
     wb = WawBus(apikey=args.apikey, retry_count=args.retry)
     wb.tt_worker_count = args.workers
+    if args.metrics_port is not None:
+        wb.metrics.serve(args.metrics_port)
+
+    count, stop = args.count, None
+    if args.daemon:
+        if args.type != "positions":
+            raise ValueError("Daemon mode is only supported for positions")
+        # finish the current poll and flush everything instead of being killed
+        count, stop = None, Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: stop.set())
+
+    if args.store:
+        if args.type != "positions":
+            raise ValueError("Store is only supported for positions")
+        with PositionsStore(args.store, by_line=args.by_line or None, batch_size=args.batch) as writer:
+            wb.collect_positions(count, args.sleep, writer=writer, stop=stop)
+        print(f"Collected {writer.rows} records")
+        return
+
+    filetype = args.output.split(".")[-1]
+
+    if args.daemon:
+        prefix = args.output[:-len(filetype) - 1] if filetype in ("parquet", "gzip") else args.output
+        max_bytes = int(args.rotate_size * 2 ** 20) if args.rotate_size else None
+        with RollingPositionsWriter(prefix, rotate_every=args.rotate, max_bytes=max_bytes, batch_size=args.batch,
+                                    max_buffer_rows=args.buffer,
+                                    compression="gzip" if filetype == "gzip" else "snappy") as writer:
+            wb.collect_positions(count, args.sleep, writer=writer, stop=stop)
+        print(f"Collected {writer.rows} records into {len(writer.files)} files")
+        return
+
+    if args.stream:
+        if args.type != "positions":
+            raise ValueError("Streaming is only supported for positions")
+        if filetype not in ("parquet", "gzip"):
+            raise ValueError("Unsupported file type")
+        compression = "gzip" if filetype == "gzip" else "snappy"
+        with PositionsWriter(args.output, batch_size=args.batch, compression=compression) as writer:
+            wb.collect_positions(args.count, args.sleep, writer=writer)
+        print(f"Collected {writer.rows} records")
+        return
 
     if args.type == "positions":
         wb.collect_positions(args.count, args.sleep)
         df = wb.dataset
     elif args.type == "timetable":
-        wb.collect_timetables()
+        if args.routes:
+            wb.routes = read_frame(args.routes)
+        wb.collect_timetables(checkpoint=args.checkpoint)
         df = wb.tt
     elif args.type == "stops":
         wb.collect_stops()
         df = wb.stops
+    elif args.type == "routes":
+        wb.collect_routes()
+        df = wb.routes
     else:
         raise ValueError(f"Unsupported type: {args.type}")
 
     print(f"Collected {len(df)} records")
 
-    filetype = args.output.split(".")[-1]
-    if filetype == "csv":
-        df.to_csv(args.output, index=False)
-    elif filetype == "parquet":
-        df.to_parquet(args.output, index=False)
-    elif filetype == "gzip":
-        df.to_parquet(args.output, index=False, compression="gzip")
-    else:
-        raise ValueError("Unsupported file type")
+    write_frame(df, args.output)
 
 
 if __name__ == "__main__":
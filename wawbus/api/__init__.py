@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
-from typing import Optional, List
+from random import random
+from time import perf_counter, sleep
+from typing import Iterator, Optional, List, Tuple, Union
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from .exceptions import ZtmApiException, ZtmHttpException
+from ..util.metrics import REGISTRY, Metrics
 
 
 def _normalize_kv(data: List[dict]) -> List[dict]:
@@ -19,13 +23,152 @@ def _normalize_kv(data: List[dict]) -> List[dict]:
     return [{x['key']: x['value'] for x in d['values']} for d in data]
 
 
+def _result(response: dict):
+    """
+    Extract result from api.um.warszawa.pl response
+
+    Args:
+        response: decoded JSON response
+
+    Returns:
+        result of the request
+
+    Raises:
+        ZtmApiException: when response contains an error or no result
+    """
+    if not isinstance(response, dict):
+        raise ZtmApiException(f'Unexpected response: {type(response).__name__}')
+
+    if error := response.get('error'):
+        raise ZtmApiException(error)
+
+    if result := response.get('result'):
+        if isinstance(result, str):
+            raise ZtmApiException(result)
+        else:
+            return result
+    else:
+        raise ZtmApiException('No result in response')
+
+
+def _flatten_routes(routes: dict) -> Iterator[dict]:
+    """
+    Flatten public_transport_routes result
+
+    Args:
+        routes: result of public_transport_routes request
+
+    Returns:
+        dicts with keys: odleglosc, ulica_id, nr_zespolu, typ, nr_przystanku, bus, direction, stop
+    """
+    for bus, data in routes.items():
+        for direction, stops in data.items():
+            for stop, kv in stops.items():
+                kv['bus'] = bus
+                kv['direction'] = direction
+                kv['stop'] = stop
+                yield kv
+
+
+def _backoff_delay(attempt: int, backoff: float, max_backoff: float) -> float:
+    """
+    Exponential backoff with full jitter
+
+    Args:
+        attempt: number of the attempt, starting from 1 for the first retry
+        backoff: base delay in seconds
+        max_backoff: maximum delay in seconds
+
+    Returns:
+        delay in seconds
+    """
+    return min(max_backoff, backoff * 2 ** (attempt - 1)) * random()
+
+
+class _RequestMetrics:
+    """
+    Metrics of API requests, shared by ZtmApi and AsyncZtmApi
+    """
+
+    def __init__(self, metrics: Metrics):
+        self.seconds = metrics.histogram("wawbus_api_request_seconds", "Duration of API request attempts")
+        self.errors = metrics.counter("wawbus_api_errors_total", "Failed API request attempts by exception type")
+        self.retries = metrics.counter("wawbus_api_retries_total", "API request attempts after a failed one")
+        self.failures = metrics.counter("wawbus_api_failures_total", "API requests failed after all attempts")
+
+    def error(self, endpoint: str, e: ZtmApiException):
+        cause = e.error if isinstance(e, ZtmHttpException) else e
+        self.errors.inc(endpoint=endpoint, error=type(cause).__name__)
+
+
 class ZtmApi:
+    """
+    Client for api.um.warszawa.pl, keeps a pooled keep-alive session
+
+    Attributes:
+        api_key (str): API key
+        retry_count (int): number of attempts of every request
+        timeout (float | tuple): connect and read timeout in seconds
+        backoff (float): base delay in seconds of the exponential backoff between attempts
+        max_backoff (float): maximum delay in seconds between attempts
+        pool_size (int): maximum number of kept-alive connections
+        session (requests.Session): HTTP session used for all requests
+        base_url (str): URL of the API actions
+        metrics (Metrics): registry of request metrics
+    """
+    base_url: str = 'https://api.um.warszawa.pl/api/action'
     api_key: str
     retry_count: int = 3
+    timeout: Union[float, Tuple[float, float]] = (3.05, 30)
+    backoff: float = 0.5
+    max_backoff: float = 30
+    pool_size: int = 10
+    session: requests.Session
+    metrics: Metrics
 
-    def __init__(self, api_key: str, retry_count: int = 3):
+    def __init__(self, api_key: str, retry_count: int = 3, pool_size: int = 10,
+                 timeout: Union[float, Tuple[float, float]] = (3.05, 30), backoff: float = 0.5,
+                 metrics: Optional[Metrics] = None):
+        """
+        Args:
+            api_key (str): API key
+            retry_count (int): number of attempts of every request
+            pool_size (int): maximum number of kept-alive connections, should match the number of threads using the api
+            timeout (float | tuple): connect and read timeout in seconds
+            backoff (float): base delay in seconds of the exponential backoff between attempts
+            metrics (Metrics): registry of request metrics, wawbus.util.metrics.REGISTRY by default
+        """
         self.api_key = api_key
         self.retry_count = retry_count
+        self.timeout = timeout
+        self.backoff = backoff
+        self.metrics = metrics if metrics is not None else REGISTRY
+        self._metrics = _RequestMetrics(self.metrics)
+        self.session = requests.Session()
+        self._adapter: Optional[HTTPAdapter] = None
+        self.resize_pool(pool_size)
+
+    def resize_pool(self, pool_size: int):
+        """
+        Change the maximum number of kept-alive connections, connections of the previous pool are closed
+
+        Args:
+            pool_size (int): maximum number of kept-alive connections
+        """
+        if self._adapter is not None and pool_size == self.pool_size:
+            return
+        if self._adapter is not None:
+            self._adapter.close()
+        self.pool_size = pool_size
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', self._adapter)
+        self.session.mount('http://', self._adapter)
+
+    def close(self):
+        """
+        Close all pooled connections
+        """
+        self.session.close()
 
     def _req_once(self, endpoint: str, rid: Optional[str] = None, **qparams):
         """
@@ -44,32 +187,27 @@ class ZtmApi:
             qparams['resource_id'] = rid
 
         try:
-            r = requests.get(
-                f'https://api.um.warszawa.pl/api/action/{endpoint}',
-                params=qparams
+            r = self.session.get(
+                f'{self.base_url}/{endpoint}',
+                params=qparams,
+                timeout=self.timeout
             )
         except requests.exceptions.RequestException as e:
             raise ZtmHttpException(e)
 
         if r.status_code != requests.codes.ok:
             raise ZtmApiException(f'API error: {r.status_code}')
-        else:
-            response = r.json()
-
-        if error := response.get('error'):
-            raise ZtmApiException(error)
 
-        if result := response.get('result'):
-            if isinstance(result, str):
-                raise ZtmApiException(result)
-            else:
-                return result
-        else:
-            raise ZtmApiException('No result in response')
+        try:
+            response = r.json()
+        except ValueError as e:
+            # e.g. an HTML error page with status 200
+            raise ZtmApiException(f'Invalid JSON response: {e}')
+        return _result(response)
 
     def req(self, endpoint: str, rid: Optional[str] = None, **qparams):
         """
-        Request method with retries
+        Request method with retries, attempts are separated by exponential backoff with full jitter
 
         Args:
             endpoint: which endpoint to use
@@ -80,12 +218,21 @@ class ZtmApi:
             response from ZTM API
         """
         err = None
-        for _ in range(self.retry_count):
+        for attempt in range(self.retry_count):
+            if attempt > 0:
+                self._metrics.retries.inc(endpoint=endpoint)
+                if self.backoff > 0:
+                    sleep(_backoff_delay(attempt, self.backoff, self.max_backoff))
+            start = perf_counter()
             try:
                 return self._req_once(endpoint, rid, **qparams)
             except ZtmApiException as e:
+                self._metrics.error(endpoint, e)
                 err = e
+            finally:
+                self._metrics.seconds.observe(perf_counter() - start, endpoint=endpoint)
         else:
+            self._metrics.failures.inc(endpoint=endpoint)
             raise err
 
     def get_bus_positions(self) -> List[dict]:
@@ -108,15 +255,7 @@ class ZtmApi:
         Returns:
             a list of dicts with keys: odleglosc, ulica_id, nr_zespolu, typ, nr_przystanku, bus, direction, stop
         """
-        for bus, data in self.req(
-                'public_transport_routes'
-        ).items():
-            for direction, stops in data.items():
-                for stop, kv in stops.items():
-                    kv['bus'] = bus
-                    kv['direction'] = direction
-                    kv['stop'] = stop
-                    yield kv
+        yield from _flatten_routes(self.req('public_transport_routes'))
 
     def get_stop_locations(self) -> List[dict]:
         """
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from time import perf_counter
+from typing import Optional, List
+
+import aiohttp
+
+from . import _normalize_kv, _result, _flatten_routes, _backoff_delay, _RequestMetrics
+from .exceptions import ZtmApiException, ZtmHttpException
+from ..util.metrics import REGISTRY, Metrics
+
+
+class RateLimiter:
+    """
+    Spaces out acquisitions so that at most `rate` of them happen per second
+
+    Attributes:
+        rate (float): maximum number of acquisitions per second
+    """
+    rate: float
+
+    def __init__(self, rate: float):
+        """
+        Args:
+            rate (float): maximum number of acquisitions per second
+        """
+        self.rate = rate
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """
+        Wait for the next free slot
+        """
+        async with self._lock:
+            now = asyncio.get_running_loop().time()
+            slot = max(now, self._next)
+            self._next = slot + 1 / self.rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class AsyncZtmApi:
+    """
+    asyncio client for api.um.warszawa.pl, mirrors ZtmApi.
+    Use it as an async context manager, so the underlying session is closed.
+
+    Attributes:
+        api_key (str): API key
+        retry_count (int): number of attempts of every request
+        timeout (float): total timeout of a single attempt in seconds
+        backoff (float): base delay in seconds of the exponential backoff between attempts
+        max_backoff (float): maximum delay in seconds between attempts
+        concurrency (int): maximum number of requests in flight
+        rate_limit (float): maximum number of requests per second, None for no limit
+        base_url (str): URL of the API actions
+        metrics (Metrics): registry of request metrics
+    """
+    base_url: str = 'https://api.um.warszawa.pl/api/action'
+    api_key: str
+    retry_count: int = 3
+    timeout: float = 30
+    backoff: float = 0.5
+    max_backoff: float = 30
+    concurrency: int = 100
+    rate_limit: Optional[float] = None
+    metrics: Metrics
+
+    def __init__(self, api_key: str, retry_count: int = 3, concurrency: int = 100,
+                 rate_limit: Optional[float] = None, timeout: float = 30, backoff: float = 0.5,
+                 metrics: Optional[Metrics] = None):
+        """
+        Args:
+            api_key (str): API key
+            retry_count (int): number of attempts of every request
+            concurrency (int): maximum number of requests in flight
+            rate_limit (float): maximum number of requests per second, None for no limit
+            timeout (float): total timeout of a single attempt in seconds
+            backoff (float): base delay in seconds of the exponential backoff between attempts
+            metrics (Metrics): registry of request metrics, wawbus.util.metrics.REGISTRY by default
+        """
+        self.api_key = api_key
+        self.retry_count = retry_count
+        self.concurrency = concurrency
+        self.rate_limit = rate_limit
+        self.timeout = timeout
+        self.backoff = backoff
+        self.metrics = metrics if metrics is not None else REGISTRY
+        self._metrics = _RequestMetrics(self.metrics)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.BoundedSemaphore] = None
+        self._limiter: Optional[RateLimiter] = None
+
+    async def __aenter__(self):
+        # created here, so they're bound to the running loop
+        self._semaphore = asyncio.BoundedSemaphore(self.concurrency)
+        self._limiter = RateLimiter(self.rate_limit) if self.rate_limit else None
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(total=self.timeout)
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        """
+        Close the underlying session
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _req_once(self, endpoint: str, rid: Optional[str] = None, **qparams):
+        """
+        Generic request method for ZTM API
+
+        Args:
+            endpoint: which endpoint to use
+            rid: resource id
+            qparams: other query parameters
+
+        Returns:
+            response from ZTM API
+        """
+        qparams['apikey'] = self.api_key
+        if rid:
+            qparams['resource_id'] = rid
+
+        if self._limiter:
+            await self._limiter.acquire()
+
+        async with self._semaphore:
+            try:
+                async with self._session.get(f'{self.base_url}/{endpoint}', params=qparams) as r:
+                    if r.status != 200:
+                        raise ZtmApiException(f'API error: {r.status}')
+                    response = await r.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise ZtmHttpException(e)
+            except ValueError as e:
+                # e.g. an HTML error page with status 200
+                raise ZtmApiException(f'Invalid JSON response: {e}')
+
+        return _result(response)
+
+    async def req(self, endpoint: str, rid: Optional[str] = None, **qparams):
+        """
+        Request method with retries, attempts are separated by exponential backoff with full jitter
+
+        Args:
+            endpoint: which endpoint to use
+            rid: resource id
+            qparams: other query parameters
+
+        Returns:
+            response from ZTM API
+        """
+        err = None
+        for attempt in range(self.retry_count):
+            if attempt > 0:
+                self._metrics.retries.inc(endpoint=endpoint)
+                if self.backoff > 0:
+                    await asyncio.sleep(_backoff_delay(attempt, self.backoff, self.max_backoff))
+            start = perf_counter()
+            try:
+                return await self._req_once(endpoint, rid, **qparams)
+            except ZtmApiException as e:
+                self._metrics.error(endpoint, e)
+                err = e
+            finally:
+                self._metrics.seconds.observe(perf_counter() - start, endpoint=endpoint)
+        else:
+            self._metrics.failures.inc(endpoint=endpoint)
+            raise err
+
+    async def get_bus_positions(self) -> List[dict]:
+        """
+        Get bus positions
+
+        Returns:
+            a list of dicts with keys: Lat, Lon, Time, Lines, VehicleNumber, Brigade
+        """
+        return await self.req(
+            'busestrams_get',
+            'f2e5503e-927d-4ad3-9500-4ab9e55deb59',
+            type='1'
+        )
+
+    async def get_routes(self) -> List[dict]:
+        """
+        Get bus routes
+
+        Returns:
+            a list of dicts with keys: odleglosc, ulica_id, nr_zespolu, typ, nr_przystanku, bus, direction, stop
+        """
+        return list(_flatten_routes(await self.req('public_transport_routes')))
+
+    async def get_stop_locations(self) -> List[dict]:
+        """
+        Get bus stop locations
+
+        Returns:
+            a list of dicts with keys: id, name, lat, lon
+        """
+        return _normalize_kv(await self.req(
+            'dbstore_get',
+            id='ab75c33d-3a26-4342-b36a-6e5fef0a3ac3'
+        ))
+
+    async def get_timetable(self, stop_id: str, line: str, stop_nr: str) -> List[dict]:
+        """
+        Get bus timetable
+
+        Args:
+            stop_id (str): bus stop id (from get_stop_locations)
+            line (str): bus line number
+            stop_nr (str): bus stop number
+
+        Returns:
+            a list of dicts with keys: symbol_2, symbol_1, brygada, kierunek, trasa, czas
+        """
+        return _normalize_kv(await self.req(
+            'dbtimetable_get',
+            id='e923fa0e-d96c-43f9-ae6e-60518c9f3238',
+            busstopId=stop_id,
+            busstopNr=stop_nr,
+            line=line
+        ))
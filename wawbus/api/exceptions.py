@@ -1,6 +1,3 @@
-from requests.exceptions import RequestException
-
-
 class ZtmApiException(Exception):
     msg: str
 
@@ -10,6 +7,8 @@ class ZtmApiException(Exception):
 
 
 class ZtmHttpException(ZtmApiException):
+    error: Exception
 
-    def __init__(self, error: RequestException):
+    def __init__(self, error: Exception):
+        self.error = error
         super().__init__(str(error))
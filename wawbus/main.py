@@ -1,17 +1,120 @@
 # -*- coding: utf-8 -*-
-from os.path import isfile
+import asyncio
+import itertools
+from os.path import exists, isfile
 from queue import Queue
-from threading import Thread
-from time import sleep
-from typing import Optional
+from threading import Event, Thread
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import requests
 
 from .api import ZtmApi, ZtmApiException
-from .util.dist import speed, stop_dist
-from .constants import _DATASET_URL, _TIMETABLE_URL, _STOPS_URL, BUS_LENGTH, M_TO_KM
-from .util.time import timeint
+from .util.cache import RemoteCache
+from .util.checkpoint import TimetableCheckpoint
+from .util.crawl import CrawlStats
+from .util.dedup import FixDeduplicator
+from .util.dist import speed_np
+from .util.dtypes import align_categories, append_positions, compact_positions, memory_per_row
+from .util.late import late_join
+from .util.metrics import REGISTRY, SIZE_BUCKETS, Metrics
+from .util.parallel import late_parallel, resolve_jobs
+from .util.routes import RouteIndex
+from .constants import _DATASET_URL, _TIMETABLE_URL, _STOPS_URL
+from .util.time import DAY_TYPES, day_type_np, timeint_np
+from .util.timetable import TimetableIndex, timetable_locations
+from .util.schedule import PollScheduler
+from .util.spatial import StopIndex
+from .util.storage import PositionsStore, PositionsWriter, RollingPositionsWriter, read_positions
+from .util.trajectory import Trajectories
+
+
+def _positions_frame(response: List[dict]) -> pd.DataFrame:
+    """
+    Args:
+        response (List[dict]): bus positions returned by ZtmApi.get_bus_positions
+
+    Returns:
+        pd.DataFrame: bus positions with parsed Time, entries with invalid Time are dropped
+    """
+    df = pd.DataFrame(response, columns=[
+        "Lat",
+        "Lon",
+        "Time",
+        "Lines",
+        "VehicleNumber",
+        "Brigade"
+    ])
+
+    # for some fucking reason some entries have the year 2022024, so we need to coerce them
+    df['Time'] = pd.to_datetime(df['Time'], errors='coerce')
+    return df.dropna(subset=['Time'])
+
+
+def _timetable_frame(entries: Iterable[dict]) -> pd.DataFrame:
+    """
+    Args:
+        entries (Iterable[dict]): timetable entries with added bus, nr_zespolu and nr_przystanku keys
+
+    Returns:
+        pd.DataFrame: timetable with parsed czas, entries with invalid czas are dropped
+    """
+    df = pd.DataFrame(entries, columns=[
+        "bus",
+        "nr_zespolu",
+        "nr_przystanku",
+        "brygada",
+        "czas",
+        "trasa"
+    ], dtype=str)
+
+    df['czas'] = pd.to_datetime(df['czas'], errors='coerce')
+    df = df.dropna(subset=['czas'])
+
+    # entries arrive in the order requests finish, sort them so the result doesn't depend on it
+    return df.sort_values(['bus', 'nr_zespolu', 'nr_przystanku', 'czas', 'brygada'], kind='stable', ignore_index=True)
+
+
+def _routes_frame(routes: Iterable[dict]) -> pd.DataFrame:
+    """
+    Args:
+        routes (Iterable[dict]): routes returned by ZtmApi.get_routes
+
+    Returns:
+        pd.DataFrame: routes
+    """
+    return pd.DataFrame(routes, columns=[
+        "bus",
+        "direction",
+        "stop",
+        "nr_zespolu",
+        "nr_przystanku",
+        "ulica_id",
+        "typ",
+        "odleglosc"
+    ], dtype=str)
+
+
+def _trajectory_speed(df: pd.DataFrame, traj: Trajectories, routes: Optional[RouteIndex] = None) -> np.ndarray:
+    """
+    Args:
+        df (pd.DataFrame): positions dataframe
+        traj (Trajectories): layout of df
+        routes (RouteIndex): if set, distance is measured along the routes of the vehicle's line
+
+    Returns:
+        np.ndarray: speed of each row of df, in the row order of df
+    """
+    lon = traj.take(df['Lon'].values)
+    lat = traj.take(df['Lat'].values)
+    time = traj.take(df['Time'].values)
+    if routes is not None:
+        along = routes.travelled(traj.take(routes.line_codes(df['Lines'].values)), lat, lon, traj.last)
+        return traj.scatter(speed_np(lon, lat, time, traj.next(lon), traj.next(lat), traj.next(time), along))
+    return traj.scatter(speed_np(lon, lat, time, traj.next(lon), traj.next(lat), traj.next(time)))
 
 
 class WawBus:
@@ -20,218 +123,682 @@ class WawBus:
 
     Attributes:
         api (ZtmApi): ZtmApi instance
-        tt (pd.DataFrame): Timetable dataframe
+        tt (pd.DataFrame): Timetable dataframe, when set it's used for every day type
+        timetables (Dict[str, pd.DataFrame]): Downloaded timetables of every day type (see DAY_TYPES), used when tt
+            isn't set
         stops (pd.DataFrame): Stop locations dataframe
-        dataset (pd.DataFrame): Dataset of bus positions dataframe
+        routes (pd.DataFrame): Routes dataframe, used to plan timetable collection
+        dataset (pd.DataFrame): Dataset of bus positions dataframe, with compact dtypes (see compact_positions)
         tt_worker_count (int): Number of timetable collection workers when collecting timetables
+        tt_queue_size (int): Maximum number of pending requests and pending batches of results when collecting
+            timetables
+        tt_stats (CrawlStats): Counters of the last timetable collection
+        cache (RemoteCache): Cache of downloaded datasets, timetables and stops
+        dedup (FixDeduplicator): Last seen fix of every vehicle, used to drop repeats when collecting positions
+        metrics (Metrics): Registry of collection and analysis metrics, shared with api
     """
     api: Optional[ZtmApi] = None
     tt: Optional[pd.DataFrame] = None
+    timetables: Dict[str, pd.DataFrame]
     stops: Optional[pd.DataFrame] = None
+    routes: Optional[pd.DataFrame] = None
     dataset: pd.DataFrame = pd.DataFrame()
     tt_worker_count: int = 5
+    tt_queue_size: int = 1000
+    tt_stats: Optional[CrawlStats] = None
+    cache: RemoteCache
+    dedup: FixDeduplicator
+    metrics: Metrics
+    _trajectories: Optional[Trajectories] = None
+    _trajectories_of: Optional[pd.DataFrame] = None
+    _speed: Optional[np.ndarray] = None
+    _speed_of: Optional[pd.DataFrame] = None
+    _speed_routes: Optional[RouteIndex] = None
+    _last_fix: Optional[pd.Series] = None
+    _tt_index: Optional[dict] = None
+    _stop_index: Optional[StopIndex] = None
+    _stop_index_of: Optional[tuple] = None
+    _route_index: Optional[RouteIndex] = None
+    _route_index_of: Optional[tuple] = None
 
     def __init__(self, /, *,
                  apikey: Optional[str] = None,
                  dataset: Optional[str] = None,
-                 retry_count: int = 3):
+                 store: Optional[str] = None,
+                 retry_count: int = 3,
+                 cache_dir: Optional[str] = None,
+                 offline: bool = False,
+                 columns: Optional[List[str]] = None,
+                 lines: Optional[Iterable[str]] = None,
+                 time_range: Optional[Tuple] = None,
+                 metrics: Optional[Metrics] = None):
         """
         Args:
             apikey (str): API key for ZtmApi (optional)
-            dataset (str): frozen dataset's name (optional)
+            dataset (str): frozen dataset's name (optional), local {dataset}.arrow, {dataset}.gzip or
+                {dataset}.parquet files (or directories written by PositionsWriter) are used before downloading it
+            store (str): directory of a PositionsStore to load the dataset from (optional), only partitions
+                matching lines and time_range are read
             retry_count (int): number of retries when collecting data
+            cache_dir (str): directory for downloaded files, defaults to $WAWBUS_CACHE_DIR or $XDG_CACHE_HOME/wawbus
+            offline (bool): only use already downloaded files
+            columns (List[str]): only load these columns of the dataset
+            lines (Iterable[str]): only load these lines of the dataset
+            time_range (tuple): only load positions with start <= Time < end, either bound can be None
+            metrics (Metrics): registry of metrics, wawbus.util.metrics.REGISTRY by default
 
         Raises:
-            ValueError: when both apikey and dataset are not provided
+            ValueError: when none of apikey, dataset and store are provided
+            FileNotFoundError: when offline and the dataset wasn't downloaded before
         """
 
-        if not apikey and not dataset:
-            raise ValueError("API key or dataset is required.")
+        if not apikey and not dataset and not store:
+            raise ValueError("API key, dataset or store is required.")
+
+        self.cache = RemoteCache(cache_dir, offline=offline)
+        self.dedup = FixDeduplicator()
+        self.timetables = {}
+
+        self.metrics = metrics if metrics is not None else REGISTRY
+        self._polls = self.metrics.counter("wawbus_polls_total", "Position polls by outcome")
+        self._poll_interval = self.metrics.histogram("wawbus_poll_interval_seconds",
+                                                     "Actual time between position polls, by target interval")
+        self._ticks_skipped = self.metrics.counter("wawbus_poll_ticks_skipped_total",
+                                                   "Poll ticks skipped because a poll took too long")
+        self._ticks_late = self.metrics.counter("wawbus_poll_ticks_late_total", "Poll ticks fired late")
+        self._poll_rows = self.metrics.histogram("wawbus_poll_rows", "Rows kept from a position poll", SIZE_BUCKETS)
+        self._dedup_dropped = self.metrics.counter("wawbus_dedup_dropped_total", "Repeated fixes dropped at ingest")
+        self._steps = self.metrics.histogram("wawbus_step_seconds", "Duration of analysis steps")
 
         if apikey:
-            self.api = ZtmApi(apikey, retry_count)
+            self.api = ZtmApi(apikey, retry_count, metrics=self.metrics)
 
         if dataset:
-            if isfile(f"{dataset}.gzip"):
-                self.dataset = pd.read_parquet(f"{dataset}.gzip")
+            if isfile(f"{dataset}.arrow"):
+                path = f"{dataset}.arrow"  # memory mapped, see read_arrow
+            elif exists(f"{dataset}.gzip"):
+                path = f"{dataset}.gzip"  # a file or a PositionsWriter directory
+            elif exists(f"{dataset}.parquet"):
+                path = f"{dataset}.parquet"
             else:
                 # download dataset
-                self.dataset = pd.read_parquet(_DATASET_URL.format(dataset))
-
-    def collect_positions(self, count: int, sleep_between: int = 10):
+                path = self.cache.fetch(_DATASET_URL.format(dataset))
+            self.dataset = compact_positions(read_positions(path, columns=columns, lines=lines,
+                                                            time_range=time_range))
+        elif store:
+            self.dataset = compact_positions(PositionsStore(store).read(columns=columns, lines=lines,
+                                                                        time_range=time_range))
+
+    def collect_positions(self, count: Optional[int], sleep_between: float = 10,
+                          writer: Optional[Union[PositionsWriter, PositionsStore, RollingPositionsWriter]] = None,
+                          scheduler: Optional[PollScheduler] = None, deduplicate: bool = True,
+                          stop: Optional[Event] = None):
         """
         Collect bus positions
 
+        Collections are fired at a fixed rate aligned to wall-clock time, the time spent on a request
+        doesn't delay the following ones.
+
         Args:
-            count (int): - number of collections
-            sleep_between (int): - time between collections
+            count (int): - number of collections, None collects until stop is set (requires writer)
+            sleep_between (float): - time between collections in seconds
+            writer (PositionsWriter | PositionsStore | RollingPositionsWriter): - if set, every collection is written
+                to it instead of self.dataset
+            scheduler (PollScheduler): - scheduler to use instead of PollScheduler(sleep_between),
+                its stats() report actual intervals between collections, they're also observed in self.metrics
+            deduplicate (bool): - drop fixes already seen in previous collections (see self.dedup)
+            stop (Event): - collection ends after the current poll once it's set, waiting for the next poll is
+                interrupted when the default scheduler is used
 
         Updates:
-            self.dataset (pd.DataFrame): Dataset of bus positions dataframe
+            self.dataset (pd.DataFrame): Dataset of bus positions dataframe, when writer is not set
+            self.dedup (FixDeduplicator): last seen fixes and counters, when deduplicate is set
 
         Raises:
             ZtmApiException: when API returns an error more than self.retry_count times
-            ValueError: when API key is not provided
+            ValueError: when API key is not provided, or count is None without writer
             InvalidColumnName: when API returns an invalid column name
         """
         if not self.api:
             raise ValueError("API key is required.")
-
-        dfs = [self.dataset]
-        for i in range(count):
-            print(f"Collecting data {i + 1}/{count}")
+        if count is None and writer is None:
+            raise ValueError("Writer is required when collecting without count.")
+
+        if scheduler is None and stop is not None:
+            scheduler = PollScheduler(sleep_between, sleep_fn=stop.wait)
+        elif scheduler is None:
+            scheduler = PollScheduler(sleep_between)
+
+        of = f"/{count}" if count is not None else ""
+        dfs = []
+        target = f"{scheduler.interval:g}"
+        for i in range(count) if count is not None else itertools.count():
+            skipped, late = scheduler.skipped, scheduler.late
+            scheduler.wait()
+            self._ticks_skipped.inc(scheduler.skipped - skipped, target=target)
+            self._ticks_late.inc(scheduler.late - late, target=target)
+            if scheduler.last_interval is not None:
+                self._poll_interval.observe(scheduler.last_interval, target=target)
+            if stop is not None and stop.is_set():
+                break
+            print(f"Collecting data {i + 1}{of}")
             try:
                 response = self.api.get_bus_positions()
             except ZtmApiException as e:
-                print(f"Error: {e}, skipping collection {i + 1}/{count}")
-                sleep(sleep_between)
+                print(f"Error: {e}, skipping collection {i + 1}{of}")
+                self._polls.inc(outcome="error")
                 continue
-            df = pd.DataFrame(response, columns=[
-                "Lat",
-                "Lon",
-                "Time",
-                "Lines",
-                "VehicleNumber",
-                "Brigade"
-            ])
-            dfs.append(df)
-            sleep(sleep_between)
-
-        df = pd.concat(dfs, ignore_index=True)
-
-        # for some fucking reason some entries have the year 2022024, so we need to coerce them
-        df['Time'] = pd.to_datetime(df['Time'], errors='coerce')
-        df = df.dropna(subset=['Time'])
+            df = _positions_frame(response)
+            if deduplicate:
+                dropped = self.dedup.dropped
+                df = self.dedup.filter(df)
+                self._dedup_dropped.inc(self.dedup.dropped - dropped)
+            self._polls.inc(outcome="ok")
+            self._poll_rows.observe(len(df))
+            if writer is not None:
+                writer.write(df)
+            else:
+                dfs.append(df)
+
+        stats = scheduler.stats()
+        if stats['mean_interval'] is not None:
+            print(f"Mean interval {stats['mean_interval']:.2f}s (target {stats['target_interval']}s), "
+                  f"{stats['skipped']} skipped, {stats['late']} late")
+        if deduplicate:
+            print(f"Deduplication: {self.dedup}")
+
+        if not dfs:
+            return
+
+        # new rows are only appended, so speed computed for the old ones stays valid
+        df = append_positions(self.dataset, dfs)
+        if self._speed_of is self.dataset:
+            self._speed_of = df
 
         self.dataset = df
+        print(f"Dataset has {len(df)} rows, {memory_per_row(df):.1f} bytes per row")
 
-    def calculate_speed(self) -> pd.DataFrame:
+    def calculate_speed(self, along_route: bool = False, radius: float = 100) -> pd.DataFrame:
         """
         Calculate speed from dataset
 
+        Speed is computed incrementally: rows appended by collect_positions since the last call
+        are processed together with the last known fix of each vehicle, speed of older rows is reused.
+        It always runs in this process, only calculate_late takes n_jobs.
+
+        Args:
+            along_route (bool): measure distance along the route of the vehicle's line (see route_index) instead
+                of in a straight line, which underestimates speed on curved routes when polls are sparse.
+                Falls back to the straight line for positions which can't be matched with a route.
+                Needs self.routes or an API key to collect them.
+            radius (float): how close (in meters) positions have to be to a route with along_route
+
         Returns:
             A copy of self.dataset dataframe with new "Speed" column added.
+
+        Raises:
+            ValueError: with along_route, when self.routes is not set and API key is not provided
         """
+        routes = self.route_index(radius) if along_route else None
+        updated = False
+        if self._speed_of is self.dataset and self._speed_routes is routes:
+            with self._steps.time(step="speed_incremental"):
+                updated = self._update_speed()
+        if not updated:
+            traj = self.trajectories()
+            with self._steps.time(step="speed_full"):
+                self._speed = _trajectory_speed(self.dataset, traj, routes)
+            self._last_fix = pd.Series(traj.order[traj.last], index=traj.vehicles)
+            self._speed_of = self.dataset
+            self._speed_routes = routes
+
         df = self.dataset.copy(deep=False)
-        df['NextLon'] = df.groupby('VehicleNumber')['Lon'].shift(-1)
-        df['NextLat'] = df.groupby('VehicleNumber')['Lat'].shift(-1)
-        df['NextTime'] = df.groupby('VehicleNumber')['Time'].shift(-1)
+        df['Speed'] = self._speed
+
+        return df
 
-        df['Speed'] = df.apply(speed, axis='columns')
+    def _update_speed(self) -> bool:
+        """
+        Calculate speed only for rows appended to the dataset since the last calculate_speed call
 
-        df = df.drop('NextLat', axis=1)
-        df = df.drop('NextLon', axis=1)
-        df = df.drop('NextTime', axis=1)
+        Returns:
+            bool: False when the new rows can't be processed incrementally and everything has to be recomputed
+        """
+        done = len(self._speed)
+        new = self.dataset.iloc[done:]
+        if new.empty:
+            return True
+
+        last = self._last_fix.reindex(new['VehicleNumber'].unique()).dropna().astype(np.int64)
+        prev = self.dataset.iloc[last.values]
+
+        # fixes older than the last known one would land in the middle of a trajectory
+        last_time = pd.Series(prev['Time'].values, index=last.index).reindex(new['VehicleNumber'])
+        if (new['Time'].values < last_time.values).any():
+            return False
+
+        part = pd.concat([prev, new])
+        positions = np.concatenate((last.values, np.arange(done, len(self.dataset))))
+        traj = Trajectories(part)
+
+        speed = np.empty(len(self.dataset), dtype=np.float64)
+        speed[:done] = self._speed
+        speed[positions] = _trajectory_speed(part, traj, routes=self._speed_routes)
+
+        last_fix = pd.Series(positions[traj.order[traj.last]], index=traj.vehicles)
+        self._last_fix = pd.concat([self._last_fix.drop(last_fix.index, errors='ignore'), last_fix])
+        self._speed = speed
+        self._speed_of = self.dataset
+        return True
+
+    def trajectories(self) -> Trajectories:
+        """
+        Per-vehicle trajectory layout of the dataset, sorted by (VehicleNumber, Time).
+        The layout is cached until self.dataset is replaced.
 
-        return df
+        Returns:
+            Trajectories: layout of self.dataset
+        """
+        if self._trajectories is None or self._trajectories_of is not self.dataset:
+            with self._steps.time(step="trajectories"):
+                self._trajectories = Trajectories(self.dataset)
+            self._trajectories_of = self.dataset
+        return self._trajectories
 
-    def calculate_late(self, tolerance: pd.Timedelta = pd.Timedelta('15 minutes')) -> pd.DataFrame:
+    def calculate_late(self, tolerance: pd.Timedelta = pd.Timedelta('15 minutes'), n_jobs: int = 1) -> pd.DataFrame:
         """
-        Calculate how late buses are
+        Calculate how late buses are, every position is matched with the timetable of its day type
 
         Args:
             tolerance (pd.Timedelta): time tolerance for merging timetable and dataset
+            n_jobs (int): number of processes, lines are split between them, -1 uses all CPUs.
+                With more than one process rows are grouped by line.
 
         Returns:
             A union of dataset and timetable with new "dist" column added specifying distance to the stop the
             bus was supposed to be at.
         """
+        n_jobs = resolve_jobs(n_jobs)
+        parts = []
+        for day_type, rows in self._day_type_rows(self.dataset['Time']).items():
+            df = self.dataset if len(rows) == len(self.dataset) else self.dataset.iloc[rows]
+            index = self.timetable_index(day_type)
+            with self._steps.time(step="late_join"):
+                if n_jobs > 1:
+                    parts.append(late_parallel(df, index, tolerance, n_jobs))
+                else:
+                    parts.append(late_join(df, index, tolerance))
+        return parts[0] if len(parts) == 1 else pd.concat(parts, ignore_index=True)
+
+    def iter_late(self, tolerance: pd.Timedelta = pd.Timedelta('15 minutes'),
+                  hour_band: Optional[int] = None) -> Iterator[pd.DataFrame]:
+        """
+        Calculate how late buses are, partition by partition, so peak memory depends on the largest partition
+        instead of the whole dataset. Concatenated partitions contain the same rows as calculate_late.
+
+        Args:
+            tolerance (pd.Timedelta): time tolerance for merging timetable and dataset
+            hour_band (int): if set, lines are further split into bands of that many hours
+
+        Returns:
+            Iterator[pd.DataFrame]: results of calculate_late for every day type and line (and hour band)
+        """
+        for day_type, day_rows in self._day_type_rows(self.dataset['Time']).items():
+            index = self.timetable_index(day_type)
+
+            # only the keys of the day are taken, rows are copied partition by partition
+            keys = [self.dataset['Lines'].values[day_rows]]
+            if hour_band:
+                keys.append(pd.DatetimeIndex(self.dataset['Time'].values[day_rows]).hour.values // hour_band)
+
+            for rows in pd.Series(day_rows).groupby(keys, sort=True, observed=True).indices.values():
+                with self._steps.time(step="late_join"):
+                    df = late_join(self.dataset.iloc[day_rows[rows]], index, tolerance)
+                if len(df):
+                    yield df
+
+    def calculate_late_to_parquet(self, path: str, tolerance: pd.Timedelta = pd.Timedelta('15 minutes'),
+                                  hour_band: Optional[int] = None) -> int:
+        """
+        Calculate how late buses are and stream the result to a parquet file, one row group per partition
+
+        Args:
+            path (str): output file
+            tolerance (pd.Timedelta): time tolerance for merging timetable and dataset
+            hour_band (int): if set, lines are further split into bands of that many hours
+
+        Returns:
+            int: number of written rows
+        """
+        writer = None
+        rows = 0
+        try:
+            for df in self.iter_late(tolerance, hour_band):
+                table = pa.Table.from_pandas(df, schema=writer.schema if writer else None, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+                rows += len(df)
+        finally:
+            if writer is not None:
+                writer.close()
+        return rows
+
+    @staticmethod
+    def _day_type_rows(times: pd.Series) -> Dict[str, np.ndarray]:
+        """
+        Args:
+            times (pd.Series): timestamps
+
+        Returns:
+            Dict[str, np.ndarray]: positions of timestamps of every day type present in times, in DAY_TYPES order,
+                the first day type with no positions when times is empty
+        """
+        if times.empty:
+            return {DAY_TYPES[0]: np.arange(0)}
+        codes = day_type_np(times.values)
+        return {DAY_TYPES[code]: np.flatnonzero(codes == code) for code in np.unique(codes)}
+
+    def _timetable(self, day_type: str) -> pd.DataFrame:
+        """
+        Args:
+            day_type (str): one of DAY_TYPES
+
+        Returns:
+            pd.DataFrame: self.tt when it's set, otherwise the timetable of day_type, downloaded when needed.
+                The weekday timetable is used for day types whose timetable can't be fetched.
+        """
+        if self.tt is not None:
+            return self.tt
+        if day_type not in self.timetables:
+            try:
+                self.timetables[day_type] = pd.read_parquet(self.cache.fetch(_TIMETABLE_URL.format(day_type)))
+            except (requests.RequestException, FileNotFoundError) as e:
+                if day_type == DAY_TYPES[0]:
+                    raise
+                print(f"Warning: {day_type} timetable can't be fetched ({e}), using the {DAY_TYPES[0]} timetable")
+                self.timetables[day_type] = self._timetable(DAY_TYPES[0])
+        return self.timetables[day_type]
+
+    def timetable_index(self, day_type: str = DAY_TYPES[0]) -> TimetableIndex:
+        """
+        Timetable of a day type joined with stop locations and indexed by line and brigade.
+        Built once per timetable, so only once for all day types when self.tt is set,
+        and cached until the timetable or self.stops is replaced.
+
+        Args:
+            day_type (str): one of DAY_TYPES
+
+        Returns:
+            TimetableIndex: index of the timetable
+        """
         self._lazyload_stops()
-        self._lazyload_timetable()
+        tt = self._timetable(day_type)
+
+        # keyed by the timetable frame, entries keep their frame alive, so its id isn't reused
+        cached = (self._tt_index or {}).get(id(tt))
+        if cached is None or cached[1] is not tt or cached[2] is not self.stops:
+            # drop indexes of replaced timetables and stops
+            current = [self.tt] if self.tt is not None else list(self.timetables.values())
+            self._tt_index = {key: entry for key, entry in (self._tt_index or {}).items()
+                              if entry[2] is self.stops and any(entry[1] is t for t in current)}
+            with self._steps.time(step="timetable_index"):
+                cached = (TimetableIndex(timetable_locations(tt, self.stops)), tt, self.stops)
+            self._tt_index[id(tt)] = cached
+        return cached[0]
+
+    def stop_index(self, radius: float = 50) -> StopIndex:
+        """
+        Spatial index of stops of every line. Stops of a line are taken from self.routes when it's set,
+        otherwise from the timetable of the first day type of the dataset.
+        Cached until the source dataframes are replaced.
 
-        # tt_loc contains timetable with stop locations
-        tt_loc = pd.merge(self.tt, self.stops, left_on=['nr_zespolu', 'nr_przystanku'], right_on=['zespol', 'slupek'])
-        tt_loc = tt_loc.drop(columns=['zespol', 'slupek'])
+        Args:
+            radius (float): search radius in meters
 
-        df = self.dataset.copy(deep=False)
+        Returns:
+            StopIndex: index of stops with 'line', 'nr_zespolu', 'nr_przystanku', 'szer_geo', 'dlug_geo' columns
+        """
+        self._lazyload_stops()
+        if self.routes is not None:
+            lines = self.routes
+        else:
+            day_types = self._day_type_rows(self.dataset['Time']) if 'Time' in self.dataset else DAY_TYPES
+            lines = self._timetable(next(iter(day_types)))
+
+        cached = self._stop_index
+        if cached is None or cached.radius != radius or self._stop_index_of[0] is not lines \
+                or self._stop_index_of[1] is not self.stops:
+            with self._steps.time(step="stop_index"):
+                stops = lines[['bus', 'nr_zespolu', 'nr_przystanku']].drop_duplicates()
+                stops = pd.merge(stops, self.stops, left_on=['nr_zespolu', 'nr_przystanku'],
+                                 right_on=['zespol', 'slupek'])
+                stops = stops.drop(columns=['zespol', 'slupek']).rename(columns={'bus': 'line'})
+                self._stop_index = StopIndex(stops, radius)
+            self._stop_index_of = (lines, self.stops)
+        return self._stop_index
+
+    def route_index(self, radius: float = 100) -> RouteIndex:
+        """
+        Polylines of routes of every line, built from stop sequences of self.routes and stop locations.
+        Needs self.routes to be set (e.g. read from a file saved with ``--type routes``) or an API key,
+        routes are collected with collect_routes when it's not set. Cached until the source dataframes are replaced.
+
+        Args:
+            radius (float): maximum distance in meters between a position and a route
+
+        Returns:
+            RouteIndex: index of route polylines
+
+        Raises:
+            ValueError: when self.routes is not set and API key is not provided
+        """
+        if self.routes is None:
+            if not self.api:
+                raise ValueError("Routes are required to measure speed along routes (along_route=True): "
+                                 "set wb.routes, e.g. to a file saved with --type routes, or provide an API key "
+                                 "to collect them.")
+            self.collect_routes()
+        self._lazyload_stops()
+
+        cached = self._route_index
+        if cached is None or cached.radius != radius or self._route_index_of[0] is not self.routes \
+                or self._route_index_of[1] is not self.stops:
+            with self._steps.time(step="route_index"):
+                self._route_index = RouteIndex(self.routes, self.stops, radius)
+            self._route_index_of = (self.routes, self.stops)
+        return self._route_index
+
+    def nearest_stops(self, radius: float = 50) -> pd.DataFrame:
+        """
+        Find the nearest stop on the vehicle's line within radius for every position
+
+        Args:
+            radius (float): search radius in meters
 
-        # calculate time as int, so it can be merged by closest time
-        df['t'] = df['Time'].apply(timeint)
-        tt_loc['t'] = tt_loc['czas'].apply(timeint)
-
-        # merge by closest time, line and brigade
-        # we do it this way, instead of merging by position
-        # because we neither pandas nor geopandas support merging by closest point with extra condition
-        # and we cant just filter it out later, because it doesn't fit in memory
-        df = pd.merge_asof(
-            df.sort_values('t'),
-            tt_loc.sort_values('t'),
-            left_on='t',
-            right_on='t',
-            direction='backward',
-            left_by=['Lines', 'Brigade'],
-            right_by=['bus', 'brygada'],
-            tolerance=tolerance.seconds
-        )
-        df = df.drop(columns=['t', 'bus', 'brygada'])
-
-        # calculate distance to stop
-        df['dist'] = df.apply(stop_dist, axis='columns')
-        df = df[df['dist'] >= (BUS_LENGTH * M_TO_KM)]  # filter out buses that are too close to the stop
-
-        df = df.drop_duplicates()
+        Returns:
+            A copy of self.dataset with new "nr_zespolu", "nr_przystanku", "szer_geo", "dlug_geo" columns of the
+            nearest stop and "dist" column with distance to it in kilometers, NaN when there's no stop within radius.
+        """
+        index = self.stop_index(radius)
+        found, dist = index.query(self.dataset['Lines'].values, self.dataset['Lat'].values,
+                                  self.dataset['Lon'].values)
 
+        df = self.dataset.copy(deep=False)
+        stops = index.stops.reindex(found)  # -1 becomes a row of NaN
+        for column in ('nr_zespolu', 'nr_przystanku', 'szer_geo', 'dlug_geo'):
+            df[column] = stops[column].values
+        df['dist'] = dist
         return df
 
-    def _lazyload_timetable(self):
-        if self.tt is not None:
-            return
-        url = _TIMETABLE_URL.format("weekday")  # TODO: make tt for each day of the week
-        self.tt = pd.read_parquet(url)
+    def calculate_late_at_stops(self, radius: float = 50,
+                                tolerance: pd.Timedelta = pd.Timedelta('15 minutes')) -> pd.DataFrame:
+        """
+        Calculate how late buses are from positions where they actually are at a stop of their line,
+        matched with the closest departure of their brigade from that stop
 
-    def _tt_worker(self, unprocessed: Queue, processed: Queue):
+        Args:
+            radius (float): how close (in meters) a bus has to be to a stop
+            tolerance (pd.Timedelta): maximum difference between position time and timetable time
+
+        Returns:
+            Positions at stops with timetable columns and new "dist" column (distance to the stop in kilometers)
+            and "delay" column (seconds after the scheduled departure, negative when early).
+        """
+        near = self.nearest_stops(radius).dropna(subset=['dist'])
+        near['t'] = timeint_np(near['Time'].values)
+
+        parts = []
+        for day_type, rows in self._day_type_rows(near['Time']).items():
+            tt_loc = self.timetable_index(day_type).frame
+            tt_loc = tt_loc[['bus', 'brygada', 'nr_zespolu', 'nr_przystanku', 'czas', 'trasa', 't']]
+            df, tt_loc = align_categories(near.iloc[rows], tt_loc, ['Lines', 'Brigade'], ['bus', 'brygada'])
+            df = pd.merge_asof(
+                df.sort_values('t'),
+                tt_loc.rename(columns={'t': 'tt_t'}).sort_values('tt_t', kind='stable'),
+                left_on='t',
+                right_on='tt_t',
+                direction='nearest',
+                left_by=['Lines', 'Brigade', 'nr_zespolu', 'nr_przystanku'],
+                right_by=['bus', 'brygada', 'nr_zespolu', 'nr_przystanku'],
+                tolerance=int(tolerance.total_seconds())
+            )
+            df = df.dropna(subset=['tt_t'])
+            df['delay'] = df['t'] - df['tt_t']
+            parts.append(df.drop(columns=['t', 'tt_t', 'bus', 'brygada']))
+        return parts[0] if len(parts) == 1 else pd.concat(parts, ignore_index=True)
+
+    def _tt_worker(self, unprocessed: Queue, processed: Queue, stats: CrawlStats,
+                   checkpoint: Optional[TimetableCheckpoint] = None):
         """
-        Timetable collection worker definition
+        Timetable collection worker definition, runs until it gets None from unprocessed.
+        Puts a batch (list) of entries to processed for every request, then None when it's done.
 
         Args:
             unprocessed (Queue): Queue with dicts nr_zespolu, nr_przystanku, bus
-            processed (Queue): Queue with timetable entries
+            processed (Queue): Queue with batches of timetable entries
+            stats (CrawlStats): crawl counters
+            checkpoint (TimetableCheckpoint): checkpoint storing collected and failed keys, entries stored in it
+                aren't put to processed (optional)
         """
-        while True:
-            row = unprocessed.get()
-            try:
-                tt = self.api.get_timetable(stop_id=row['nr_zespolu'], stop_nr=row['nr_przystanku'], line=row['bus'])
-            except ZtmApiException:
-                # print(f"Error: {e}, skipping timetable {row['bus']}")
-                unprocessed.task_done()
-                continue
-            for t in tt:
-                t['bus'] = row['bus']
-                t['nr_zespolu'] = row['nr_zespolu']
-                t['nr_przystanku'] = row['nr_przystanku']
-                processed.put(t)
-            unprocessed.task_done()
+        try:
+            while (row := unprocessed.get()) is not None:
+                # any failure is recorded for its key, a dead worker would silently end the crawl early
+                try:
+                    tt = self.api.get_timetable(stop_id=row['nr_zespolu'], stop_nr=row['nr_przystanku'],
+                                                line=row['bus'])
+                    for t in tt:
+                        t['bus'] = row['bus']
+                        t['nr_zespolu'] = row['nr_zespolu']
+                        t['nr_przystanku'] = row['nr_przystanku']
+                except Exception as e:
+                    stats.error()
+                    if checkpoint is not None:
+                        checkpoint.fail(row, e)
+                    continue
+                stats.request(len(tt))
+                if checkpoint is not None:
+                    checkpoint.save(row, tt)
+                elif tt:
+                    processed.put(tt)
+        finally:
+            processed.put(None)
+
+    def _tt_producer(self, rows: Iterable[dict], unprocessed: Queue,
+                     checkpoint: Optional[TimetableCheckpoint] = None):
+        """
+        Puts keys to unprocessed, followed by a None for every worker
 
-    def _yield_timetables(self):
+        Args:
+            rows (Iterable[dict]): dicts with nr_zespolu, nr_przystanku, bus keys
+            unprocessed (Queue): Queue with dicts nr_zespolu, nr_przystanku, bus
+            checkpoint (TimetableCheckpoint): keys already done in the checkpoint are skipped (optional)
         """
-        Fetches all timetables
+        try:
+            for row in rows:
+                if checkpoint is None or not checkpoint.is_done(row):
+                    unprocessed.put(row)
+        finally:
+            for _ in range(self.tt_worker_count):
+                unprocessed.put(None)
+
+    def _yield_timetables(self, rows: Iterable[dict], checkpoint: Optional[TimetableCheckpoint] = None):
         """
+        Fetches timetables for given keys using a bounded producer/consumer pipeline
 
-        unprocessed = Queue()
-        processed = Queue()
+        Args:
+            rows (Iterable[dict]): dicts with nr_zespolu, nr_przystanku, bus keys
+            checkpoint (TimetableCheckpoint): checkpoint storing collected and failed keys, entries stored in it
+                aren't yielded (optional)
 
+        Updates:
+            self.tt_stats (CrawlStats): counters of the crawl
+        """
+        unprocessed = Queue(maxsize=self.tt_queue_size)
+        processed = Queue(maxsize=self.tt_queue_size)
+        stats = self.tt_stats = CrawlStats(self.metrics)
+
+        self.api.resize_pool(self.tt_worker_count)
+
+        Thread(target=self._tt_producer, args=(rows, unprocessed, checkpoint), daemon=True).start()
         for _ in range(self.tt_worker_count):
-            worker = Thread(target=self._tt_worker, args=(unprocessed, processed))
-            worker.daemon = True
-            worker.start()
+            Thread(target=self._tt_worker, args=(unprocessed, processed, stats, checkpoint), daemon=True).start()
+
+        running = self.tt_worker_count
+        while running:
+            batch = processed.get()
+            stats.queue_depth(unprocessed.qsize(), processed.qsize())
+            if batch is None:
+                running -= 1
+                continue
+            yield from batch
 
-        for row in self.api.get_routes():
-            unprocessed.put(row)
+        stats.finish()
+        print(f"Timetables: {stats}")
 
-        while unprocessed.qsize() > 0:
-            if elem := processed.get():
-                yield elem
-                processed.task_done()
+    def _timetable_plan(self) -> List[dict]:
+        """
+        Plan timetable collection. Routes list every (stop, line) pair once per direction and route variant,
+        but the timetable only depends on the stop and the line, so duplicates are requested only once.
+        Routes are collected when self.routes is not set.
 
-        unprocessed.join()
+        Returns:
+            List[dict]: unique dicts with nr_zespolu, nr_przystanku, bus keys
+        """
+        if self.routes is None:
+            self.collect_routes()
 
-        while not processed.empty():
-            yield processed.get()
+        plan = self.routes[['nr_zespolu', 'nr_przystanku', 'bus']].drop_duplicates()
+        print(f"Planned {len(plan)} timetable requests, {len(self.routes) - len(plan)} duplicates skipped")
+        return plan.to_dict('records')
 
-    def collect_timetables(self):
+    def collect_routes(self):
+        """
+        Collect routes
+
+        Updates:
+            self.routes (pd.DataFrame): Routes dataframe
+
+        Raises:
+            ValueError: when API key is not provided
+            ZtmApiException: when API returns an error more than self.retry_count times
+        """
+        if not self.api:
+            raise ValueError("API key is required.")
+
+        self.routes = _routes_frame(self.api.get_routes())
+
+    def collect_timetables(self, checkpoint: Optional[str] = None):
         """
         Collect ALL timetables for all stops
 
+        Set self.routes beforehand (e.g. from a file saved with collect_routes) to skip fetching routes.
+
+        Args:
+            checkpoint (str): checkpoint file (optional). Collected timetables are stored in it as they arrive,
+                when the crawl is restarted with the same file, already collected keys are skipped.
+                Failed keys are retried once at the end of the crawl.
+
         Updates:
             self.tt (pd.DataFrame): Timetable dataframe
 
@@ -243,24 +810,99 @@ class WawBus:
 
         print("\033[1;31mThis will take a while\033[0m")
 
-        df = pd.DataFrame(self._yield_timetables(), columns=[
-            "bus",
-            "nr_zespolu",
-            "nr_przystanku",
-            "brygada",
-            "czas",
-            "trasa"
-        ], dtype=str)
+        if checkpoint is None:
+            self.tt = _timetable_frame(self._yield_timetables(self._timetable_plan()))
+            return
+
+        with TimetableCheckpoint(checkpoint) as cp:
+            if len(cp):
+                print(f"Resuming from checkpoint, {len(cp)} timetables already collected")
+            for _ in self._yield_timetables(self._timetable_plan(), cp):
+                pass
+            if failed := cp.failed():
+                print(f"Retrying {len(failed)} failed timetables")
+                for _ in self._yield_timetables(failed, cp):
+                    pass
+            if failed := cp.failed():
+                print(f"{len(failed)} timetables failed, rerun to retry them")
+            self.tt = _timetable_frame(cp.entries())
+
+    async def collect_timetables_async(self, concurrency: int = 100, rate_limit: Optional[float] = None,
+                                       checkpoint: Optional[str] = None):
+        """
+        Collect ALL timetables for all stops using asyncio, keeping up to `concurrency` requests in flight
+
+        Args:
+            concurrency (int): maximum number of requests in flight
+            rate_limit (float): maximum number of requests per second, None for no limit
+            checkpoint (str): checkpoint file (optional), see collect_timetables
+
+        Updates:
+            self.tt (pd.DataFrame): Timetable dataframe
+            self.tt_stats (CrawlStats): counters of the crawl
 
-        df['czas'] = pd.to_datetime(df['czas'], errors='coerce')
-        df = df.dropna(subset=['czas'])
+        Raises:
+            ValueError: when API key is not provided
+            ZtmApiException: when routes can't be fetched
+        """
+        from .api.aio import AsyncZtmApi
+
+        if not self.api:
+            raise ValueError("API key is required.")
 
-        self.tt = df
+        entries = []
+        cp = TimetableCheckpoint(checkpoint) if checkpoint is not None else None
+        stats = self.tt_stats = CrawlStats(self.metrics)
+
+        async def crawl(rows: Iterable[dict]):
+            rows = iter(rows)
+
+            async def worker():
+                for row in rows:
+                    if cp is not None and cp.is_done(row):
+                        continue
+                    try:
+                        tt = await api.get_timetable(stop_id=row['nr_zespolu'], stop_nr=row['nr_przystanku'],
+                                                     line=row['bus'])
+                        for t in tt:
+                            t['bus'] = row['bus']
+                            t['nr_zespolu'] = row['nr_zespolu']
+                            t['nr_przystanku'] = row['nr_przystanku']
+                    except Exception as e:
+                        stats.error()
+                        if cp is not None:
+                            cp.fail(row, e)
+                        continue
+                    stats.request(len(tt))
+                    if cp is not None:
+                        cp.save(row, tt)
+                    else:
+                        entries.extend(tt)
+
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+        try:
+            async with AsyncZtmApi(self.api.api_key, self.api.retry_count, concurrency=concurrency,
+                                   rate_limit=rate_limit, backoff=self.api.backoff, metrics=self.metrics) as api:
+                api.base_url = self.api.base_url
+                if self.routes is None:
+                    self.routes = _routes_frame(await api.get_routes())
+                await crawl(self._timetable_plan())
+                if cp is not None and (failed := cp.failed()):
+                    print(f"Retrying {len(failed)} failed timetables")
+                    await crawl(failed)
+            stats.finish()
+            print(f"Timetables: {stats}")
+
+            self.tt = _timetable_frame(cp.entries() if cp is not None else entries)
+        finally:
+            if cp is not None:
+                cp.close()
 
     def _lazyload_stops(self):
         if self.stops is not None:
             return
-        self.stops = pd.read_parquet(_STOPS_URL)
+        self.stops = pd.read_parquet(self.cache.fetch(_STOPS_URL))
 
     def collect_stops(self):
         """
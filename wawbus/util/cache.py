@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+from os.path import expanduser, isfile, join
+from tempfile import NamedTemporaryFile
+from time import time
+from typing import Optional
+
+import requests
+
+
+def default_cache_dir() -> str:
+    """
+    Returns:
+        str: $WAWBUS_CACHE_DIR, or wawbus directory in $XDG_CACHE_HOME (~/.cache by default)
+    """
+    if path := os.environ.get("WAWBUS_CACHE_DIR"):
+        return path
+    return join(os.environ.get("XDG_CACHE_HOME") or expanduser(join("~", ".cache")), "wawbus")
+
+
+def _sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class RemoteCache:
+    """
+    Content-addressed on-disk cache of remote files.
+
+    Files are stored as objects/<sha256 of content>, refs/<sha256 of url>.json points an URL to its object
+    together with ETag and Last-Modified, so stale entries are revalidated with a conditional request.
+    Objects are checked against their checksum before use and downloaded again when they don't match.
+
+    Attributes:
+        path (str): cache directory
+        offline (bool): never touch the network, fail when a file isn't cached
+        max_age (float): seconds after which a cached file is revalidated
+    """
+    path: str
+    offline: bool = False
+    max_age: float = 24 * 3600
+
+    def __init__(self, path: Optional[str] = None, offline: bool = False, max_age: float = 24 * 3600,
+                 timeout: float = 30):
+        """
+        Args:
+            path (str): cache directory, default_cache_dir() by default
+            offline (bool): never touch the network, fail when a file isn't cached
+            max_age (float): seconds after which a cached file is revalidated
+            timeout (float): connect and read timeout in seconds
+        """
+        self.path = path or default_cache_dir()
+        self.offline = offline
+        self.max_age = max_age
+        self._timeout = timeout
+        self._verified = set()
+
+    def _ref_path(self, url: str) -> str:
+        return join(self.path, "refs", hashlib.sha256(url.encode()).hexdigest() + ".json")
+
+    def _object_path(self, digest: str) -> str:
+        return join(self.path, "objects", digest)
+
+    def _load_ref(self, url: str) -> Optional[dict]:
+        try:
+            with open(self._ref_path(url)) as f:
+                ref = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        obj = self._object_path(ref["sha256"])
+        if obj not in self._verified:
+            if not isfile(obj) or _sha256(obj) != ref["sha256"]:
+                return None
+            self._verified.add(obj)
+        return ref
+
+    def _save_ref(self, url: str, ref: dict):
+        with NamedTemporaryFile("w", dir=join(self.path, "refs"), delete=False) as f:
+            json.dump(ref, f)
+        os.replace(f.name, self._ref_path(url))
+
+    def fetch(self, url: str) -> str:
+        """
+        Get a local copy of a remote file, downloading it when it's not cached or has changed
+
+        Args:
+            url (str): URL of the file
+
+        Returns:
+            str: path of the cached file
+
+        Raises:
+            FileNotFoundError: when offline and the file isn't cached
+            requests.RequestException: when the file can't be downloaded and isn't cached
+        """
+        ref = self._load_ref(url)
+        if ref is not None and (self.offline or time() - ref["fetched_at"] < self.max_age):
+            return self._object_path(ref["sha256"])
+        if self.offline:
+            raise FileNotFoundError(f"{url} is not cached")
+
+        os.makedirs(join(self.path, "objects"), exist_ok=True)
+        os.makedirs(join(self.path, "refs"), exist_ok=True)
+
+        headers = {}
+        if ref is not None:
+            if ref.get("etag"):
+                headers["If-None-Match"] = ref["etag"]
+            if ref.get("last_modified"):
+                headers["If-Modified-Since"] = ref["last_modified"]
+
+        try:
+            r = requests.get(url, headers=headers, stream=True, timeout=self._timeout)
+            r.raise_for_status()
+        except requests.RequestException:
+            if ref is not None:
+                return self._object_path(ref["sha256"])  # stale copy is better than nothing
+            raise
+
+        with r:
+            if r.status_code == requests.codes.not_modified and ref is not None:
+                ref["fetched_at"] = time()
+                self._save_ref(url, ref)
+                return self._object_path(ref["sha256"])
+
+            h = hashlib.sha256()
+            with NamedTemporaryFile("wb", dir=join(self.path, "objects"), delete=False) as f:
+                try:
+                    for chunk in r.iter_content(1 << 20):
+                        h.update(chunk)
+                        f.write(chunk)
+                except BaseException:
+                    f.close()
+                    os.remove(f.name)
+                    raise
+            digest = h.hexdigest()
+            os.replace(f.name, self._object_path(digest))
+
+        self._verified.add(self._object_path(digest))
+        self._save_ref(url, {
+            "url": url,
+            "sha256": digest,
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+            "fetched_at": time(),
+        })
+        return self._object_path(digest)
@@ -0,0 +1,111 @@
+import sqlite3
+from threading import Lock
+from typing import Iterator, List
+
+_KEY = ("nr_zespolu", "nr_przystanku", "bus")
+_ENTRY = ("bus", "nr_zespolu", "nr_przystanku", "brygada", "czas", "trasa")
+
+
+def _key(row: dict) -> tuple:
+    return tuple(str(row[k]) for k in _KEY)
+
+
+class TimetableCheckpoint:
+    """
+    On-disk SQLite store of a timetable crawl, so an interrupted crawl can be resumed.
+    Completed (nr_zespolu, nr_przystanku, bus) keys are stored together with their timetable entries
+    in a single transaction, failed keys are kept until they succeed.
+
+    Safe to use from multiple threads.
+
+    Attributes:
+        path (str): checkpoint file
+    """
+    path: str
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): checkpoint file, created if it doesn't exist
+        """
+        self.path = path
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS done (nr_zespolu TEXT, nr_przystanku TEXT, bus TEXT, "
+                             "PRIMARY KEY (nr_zespolu, nr_przystanku, bus))")
+            self._db.execute("CREATE TABLE IF NOT EXISTS failed (nr_zespolu TEXT, nr_przystanku TEXT, bus TEXT, "
+                             "error TEXT, PRIMARY KEY (nr_zespolu, nr_przystanku, bus))")
+            self._db.execute(f"CREATE TABLE IF NOT EXISTS entries ({', '.join(f'{c} TEXT' for c in _ENTRY)})")
+        self._done = {tuple(r) for r in self._db.execute("SELECT nr_zespolu, nr_przystanku, bus FROM done")}
+
+    def is_done(self, row: dict) -> bool:
+        """
+        Args:
+            row (dict): dict with nr_zespolu, nr_przystanku, bus keys
+
+        Returns:
+            bool: whether timetable for the key was already collected
+        """
+        return _key(row) in self._done
+
+    def save(self, row: dict, entries: List[dict]):
+        """
+        Mark a key as done and store its timetable entries, does nothing if the key is already done
+
+        Args:
+            row (dict): dict with nr_zespolu, nr_przystanku, bus keys
+            entries (List[dict]): timetable entries of the key
+        """
+        key = _key(row)
+        with self._lock, self._db:
+            if key in self._done:
+                return
+            self._db.executemany(
+                f"INSERT INTO entries VALUES ({', '.join('?' * len(_ENTRY))})",
+                ([None if e.get(c) is None else str(e[c]) for c in _ENTRY] for e in entries)
+            )
+            self._db.execute("INSERT INTO done VALUES (?, ?, ?)", key)
+            self._db.execute("DELETE FROM failed WHERE nr_zespolu = ? AND nr_przystanku = ? AND bus = ?", key)
+            self._done.add(key)
+
+    def fail(self, row: dict, error: Exception):
+        """
+        Record a failed key
+
+        Args:
+            row (dict): dict with nr_zespolu, nr_przystanku, bus keys
+            error (Exception): reason of the failure
+        """
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO failed VALUES (?, ?, ?, ?)", _key(row) + (str(error),))
+
+    def failed(self) -> List[dict]:
+        """
+        Returns:
+            List[dict]: failed keys as dicts with nr_zespolu, nr_przystanku, bus, error keys
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT nr_zespolu, nr_przystanku, bus, error FROM failed").fetchall()
+        return [dict(zip(_KEY + ("error",), r)) for r in rows]
+
+    def entries(self) -> Iterator[dict]:
+        """
+        Returns:
+            Iterator[dict]: all stored timetable entries
+        """
+        with self._lock:
+            rows = self._db.execute(f"SELECT {', '.join(_ENTRY)} FROM entries").fetchall()
+        return (dict(zip(_ENTRY, r)) for r in rows)
+
+    def __len__(self) -> int:
+        return len(self._done)
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,103 @@
+from threading import Lock
+from time import perf_counter
+from typing import Optional
+
+from .metrics import REGISTRY, Metrics
+
+
+class CrawlStats:
+    """
+    Thread-safe counters of a timetable crawl, requests and entries are also counted in metrics
+
+    Attributes:
+        requests (int): number of finished timetable requests
+        errors (int): number of failed timetable requests
+        entries (int): number of collected timetable entries
+        max_unprocessed (int): highest observed depth of the request queue
+        max_processed (int): highest observed depth of the result queue
+    """
+    requests: int = 0
+    errors: int = 0
+    entries: int = 0
+    max_unprocessed: int = 0
+    max_processed: int = 0
+
+    def __init__(self, metrics: Optional[Metrics] = None):
+        """
+        Args:
+            metrics (Metrics): registry of crawl metrics, wawbus.util.metrics.REGISTRY by default
+        """
+        metrics = metrics if metrics is not None else REGISTRY
+        self._requests = metrics.counter("wawbus_timetable_requests_total", "Timetable requests by outcome")
+        self._entries = metrics.counter("wawbus_timetable_entries_total", "Collected timetable entries")
+        self._lock = Lock()
+        self._start = perf_counter()
+        self._end = None
+
+    def request(self, entries: int):
+        """
+        Count a successful request
+
+        Args:
+            entries (int): number of entries it returned
+        """
+        with self._lock:
+            self.requests += 1
+            self.entries += entries
+        self._requests.inc(outcome="ok")
+        self._entries.inc(entries)
+
+    def error(self):
+        """
+        Count a failed request
+        """
+        with self._lock:
+            self.requests += 1
+            self.errors += 1
+        self._requests.inc(outcome="error")
+
+    def queue_depth(self, unprocessed: int, processed: int):
+        """
+        Record observed queue depths
+
+        Args:
+            unprocessed (int): depth of the request queue
+            processed (int): depth of the result queue
+        """
+        self.max_unprocessed = max(self.max_unprocessed, unprocessed)
+        self.max_processed = max(self.max_processed, processed)
+
+    def finish(self):
+        """
+        Stop the clock
+        """
+        self._end = perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        """
+        Returns:
+            float: duration of the crawl in seconds
+        """
+        return (self._end or perf_counter()) - self._start
+
+    @property
+    def throughput(self) -> float:
+        """
+        Returns:
+            float: requests per second
+        """
+        return self.requests / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def error_rate(self) -> float:
+        """
+        Returns:
+            float: fraction of failed requests
+        """
+        return self.errors / self.requests if self.requests else 0.0
+
+    def __str__(self):
+        return (f"{self.requests} requests in {self.elapsed:.1f}s ({self.throughput:.1f} req/s), "
+                f"{self.entries} entries, error rate {self.error_rate:.1%}, "
+                f"max queue depth {self.max_unprocessed}/{self.max_processed}")
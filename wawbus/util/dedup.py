@@ -0,0 +1,61 @@
+import pandas as pd
+
+KEY_COLUMNS = ["VehicleNumber", "Time", "Lat", "Lon"]
+
+
+class FixDeduplicator:
+    """
+    Drops repeated GPS fixes at ingest. The API often returns the same fix of a vehicle in consecutive polls,
+    the last seen (Time, Lat, Lon) of every vehicle is kept across polls and snapshot rows equal to it are dropped.
+
+    Attributes:
+        rows (int): number of rows seen
+        dropped (int): number of dropped repeats
+    """
+    rows: int = 0
+    dropped: int = 0
+
+    def __init__(self):
+        self._last = pd.DataFrame({
+            "Time": pd.Series(dtype="datetime64[ns]"),
+            "Lat": pd.Series(dtype="float64"),
+            "Lon": pd.Series(dtype="float64"),
+        })
+
+    def filter(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Drop fixes seen before and remember the latest fix of every vehicle in df
+
+        Args:
+            df (pd.DataFrame): snapshot of bus positions
+
+        Returns:
+            pd.DataFrame: df without repeated fixes
+        """
+        self.rows += len(df)
+        out = df.drop_duplicates(subset=KEY_COLUMNS)
+
+        last = self._last.reindex(out["VehicleNumber"].values)
+        repeat = (last["Time"].values == out["Time"].values) & (last["Lat"].values == out["Lat"].values) & \
+                 (last["Lon"].values == out["Lon"].values)
+        out = out[~repeat]
+
+        latest = out.sort_values("Time", kind="stable").drop_duplicates("VehicleNumber", keep="last")
+        self._last = latest.set_index("VehicleNumber")[["Time", "Lat", "Lon"]].combine_first(self._last)
+
+        self.dropped += len(df) - len(out)
+        return out
+
+    def __len__(self):
+        return len(self._last)
+
+    @property
+    def drop_rate(self) -> float:
+        """
+        Returns:
+            float: fraction of dropped rows
+        """
+        return self.dropped / self.rows if self.rows else 0.0
+
+    def __str__(self):
+        return f"dropped {self.dropped} of {self.rows} fixes as repeats ({self.drop_rate:.1%}), {len(self)} vehicles"
@@ -1,7 +1,12 @@
 from math import radians, cos, sin, asin, sqrt
+from typing import Optional
 
 import numpy as np
 
+from ..constants import MAX_SPEED
+
+EARTH_RADIUS = 6371  # Radius of earth in kilometers. Use 3956 for miles.
+
 
 def haversine(lon1, lat1, lon2, lat2):
     """
@@ -26,8 +31,31 @@ def haversine(lon1, lat1, lon2, lat2):
     dlat = lat2 - lat1
     a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
     c = 2 * asin(sqrt(a))
-    r = 6371  # Radius of earth in kilometers. Use 3956 for miles.
-    return c * r
+    return c * EARTH_RADIUS
+
+
+def haversine_np(lon1, lat1, lon2, lat2) -> np.ndarray:
+    """
+    Vectorized version of haversine, works on whole arrays at once.
+    NaN in any of the coordinates results in NaN distance.
+
+    Args:
+        lon1 (np.ndarray): longitudes of points 1
+        lat1 (np.ndarray): latitudes of points 1
+        lon2 (np.ndarray): longitudes of points 2
+        lat2 (np.ndarray): latitudes of points 2
+
+    Returns:
+        np.ndarray: distances in kilometers
+    """
+    lon1, lat1, lon2, lat2 = (np.radians(np.asarray(x, dtype=np.float64)) for x in (lon1, lat1, lon2, lat2))
+
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    # clip guards against a slightly above 1 due to floating point errors
+    c = 2 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+    return c * EARTH_RADIUS
 
 
 # %%
@@ -49,6 +77,40 @@ def speed(row):
     )
 
 
+def speed_np(lon, lat, time, next_lon, next_lat, next_time, along: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Vectorized version of speed.
+
+    Assumptions:
+        The vehicle is moving in a straight line between two points, unless along is given
+        Missing next point (NaN/NaT) or zero time delta results in NaN speed
+
+    Args:
+        lon (np.ndarray): longitudes
+        lat (np.ndarray): latitudes
+        time (np.ndarray): datetime64 timestamps
+        next_lon (np.ndarray): longitudes of the next point
+        next_lat (np.ndarray): latitudes of the next point
+        next_time (np.ndarray): datetime64 timestamps of the next point
+        along (np.ndarray): distance in kilometers travelled along the route to the next point (see
+            RouteIndex.travelled), used instead of the straight line when it's longer and NaN otherwise,
+            distances implying more than MAX_SPEED are ignored
+
+    Returns:
+        np.ndarray: speed in km/h
+    """
+    hours = (np.asarray(next_time, dtype='datetime64[ns]') - np.asarray(time, dtype='datetime64[ns]')) \
+        / np.timedelta64(1, 'h')
+    hours[hours == 0] = np.nan
+    dist = haversine_np(lon, lat, next_lon, next_lat)
+    if along is not None:
+        # a route passing the same place twice can match the wrong pass, which gives an impossible speed
+        with np.errstate(invalid='ignore'):
+            along = np.where(along / hours > MAX_SPEED, np.nan, along)
+        dist = np.fmax(dist, along)
+    return dist / hours
+
+
 def stop_dist(row):
     """
     Pandas UDF to calculate distance from stop.
@@ -58,3 +120,14 @@ def stop_dist(row):
         Row contains 'Lon', 'Lat', 'dlug_geo', 'szer_geo'
     """
     return haversine(row['Lon'], row['Lat'], row['dlug_geo'], row['szer_geo'])
+
+
+def stop_dist_np(df) -> np.ndarray:
+    """
+    Vectorized version of stop_dist.
+
+    Assumptions:
+        Used internally in WawBus class
+        df contains 'Lon', 'Lat', 'dlug_geo', 'szer_geo' columns
+    """
+    return haversine_np(df['Lon'].values, df['Lat'].values, df['dlug_geo'].values, df['szer_geo'].values)
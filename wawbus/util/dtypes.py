@@ -0,0 +1,112 @@
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+
+ID_COLUMNS = ("Lines", "VehicleNumber", "Brigade")
+COORDINATE_COLUMNS = ("Lat", "Lon")
+COORDINATE_TOLERANCE = 1e-5  # degrees, about a meter
+
+
+def compact_positions(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert bus positions to compact dtypes: repeated identifiers become categoricals and coordinates
+    become float32, when it doesn't move any of them by more than COORDINATE_TOLERANCE.
+
+    Args:
+        df (pd.DataFrame): bus positions, missing columns are skipped
+
+    Returns:
+        pd.DataFrame: shallow copy of df with converted columns
+    """
+    df = df.copy(deep=False)
+    for column in ID_COLUMNS:
+        if column in df and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype("category")
+
+    for column in COORDINATE_COLUMNS:
+        if column in df and df[column].dtype == np.float64:
+            values = df[column].values
+            compact = values.astype(np.float32)
+            if not (np.abs(compact - values) > COORDINATE_TOLERANCE).any():
+                df[column] = compact
+    return df
+
+
+def append_positions(df: pd.DataFrame, new: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Append bus positions to a compact dataframe (see compact_positions). Only the new rows are converted,
+    categories of the old rows are extended instead of decoding and encoding them again.
+
+    Args:
+        df (pd.DataFrame): bus positions, converted first when they aren't compact yet
+        new (List[pd.DataFrame]): bus positions to append
+
+    Returns:
+        pd.DataFrame: compact positions of df followed by new
+    """
+    new = compact_positions(pd.concat(new, ignore_index=True))
+    if df.empty and not len(df.columns):
+        return new
+    df = compact_positions(df)
+    for column in ID_COLUMNS:
+        if column in df and column in new:
+            # old categories keep their codes, new ones are added after them
+            old = df[column].cat.categories
+            categories = old.append(new[column].cat.categories.difference(old))
+            if len(categories) != len(old):
+                df[column] = df[column].cat.set_categories(categories)
+            new[column] = new[column].cat.set_categories(categories)
+
+    for column in COORDINATE_COLUMNS:
+        if column in df and column in new and df[column].dtype != new[column].dtype:
+            # one side couldn't be stored as float32
+            df[column] = df[column].astype(np.float64)
+            new[column] = new[column].astype(np.float64)
+    return pd.concat([df, new], ignore_index=True)
+
+
+def memory_per_row(df: pd.DataFrame) -> float:
+    """
+    Args:
+        df (pd.DataFrame): any dataframe
+
+    Returns:
+        float: memory used by df (including python strings) in bytes per row, 0 for an empty dataframe
+    """
+    if not len(df):
+        return 0.0
+    return df.memory_usage(deep=True, index=False).sum() / len(df)
+
+
+def _categories(s: pd.Series) -> pd.Index:
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        return s.cat.categories
+    return pd.Index(s.dropna().unique())
+
+
+def align_categories(left: pd.DataFrame, right: pd.DataFrame, left_on: List[str],
+                     right_on: List[str]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Merges require keys of the same dtype, so when either key of a pair is categorical,
+    both are converted to a categorical with the union of their categories.
+
+    Args:
+        left (pd.DataFrame): left side of the merge
+        right (pd.DataFrame): right side of the merge
+        left_on (List[str]): key columns of left
+        right_on (List[str]): key columns of right, paired with left_on
+
+    Returns:
+        shallow copies of left and right with aligned keys
+    """
+    left = left.copy(deep=False)
+    right = right.copy(deep=False)
+    for lkey, rkey in zip(left_on, right_on):
+        if not isinstance(left[lkey].dtype, pd.CategoricalDtype) and \
+                not isinstance(right[rkey].dtype, pd.CategoricalDtype):
+            continue
+        dtype = pd.CategoricalDtype(_categories(left[lkey]).union(_categories(right[rkey])))
+        left[lkey] = left[lkey].astype(dtype)
+        right[rkey] = right[rkey].astype(dtype)
+    return left, right
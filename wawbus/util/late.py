@@ -0,0 +1,75 @@
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from .dist import stop_dist_np
+from .time import timeint_np
+from .timetable import TimetableIndex
+from ..constants import BUS_LENGTH, M_TO_KM
+
+MIN_STOP_DIST = BUS_LENGTH * M_TO_KM  # kilometers, buses closer to the stop than this are filtered out
+
+
+def late_join(df: pd.DataFrame, index: TimetableIndex, tolerance: pd.Timedelta) -> pd.DataFrame:
+    """
+    Args:
+        df (pd.DataFrame): bus positions
+        index (TimetableIndex): timetable with stop locations of the day type of df
+        tolerance (pd.Timedelta): time tolerance for merging timetable and dataset
+
+    Returns:
+        pd.DataFrame: union of df and the timetable with new "dist" column, see WawBus.calculate_late
+    """
+    df = df.copy(deep=False)
+
+    # calculate time as int, so it can be matched by closest time
+    df['t'] = timeint_np(df['Time'].values)
+    df = df.sort_values('t')
+
+    # match the last departure of the same line and brigade, by binary search in the timetable index
+    # we do it this way, instead of merging by position
+    # because we neither pandas nor geopandas support merging by closest point with extra condition
+    # and we cant just filter it out later, because it doesn't fit in memory
+    pos = index.lookup(df['Lines'], df['Brigade'], df['t'].values, int(tolerance.total_seconds()))
+    return late_rows(df.drop(columns=['t']), index, pos)
+
+
+def late_rows(df: pd.DataFrame, index: TimetableIndex, pos: np.ndarray,
+              dist: Optional[np.ndarray] = None) -> pd.DataFrame:
+    """
+    Args:
+        df (pd.DataFrame): bus positions
+        index (TimetableIndex): timetable with stop locations of the day type of df
+        pos (np.ndarray): matched position in index.frame of every row of df, -1 when there's none
+        dist (np.ndarray): distance in kilometers to the matched stop of every row of df, calculated when not given
+
+    Returns:
+        pd.DataFrame: union of matched rows of df and the timetable with new "dist" column,
+            see WawBus.calculate_late
+    """
+    found = pos >= 0
+    df = late_frame(df[found], index, pos[found], None if dist is None else dist[found])
+    df = df[df['dist'] >= MIN_STOP_DIST]  # filter out buses that are too close to the stop
+
+    return df.drop_duplicates()
+
+
+def late_frame(df: pd.DataFrame, index: TimetableIndex, pos: np.ndarray,
+               dist: Optional[np.ndarray] = None) -> pd.DataFrame:
+    """
+    Args:
+        df (pd.DataFrame): bus positions, all of them matched with the timetable
+        index (TimetableIndex): timetable with stop locations of the day type of df
+        pos (np.ndarray): matched position in index.frame of every row of df
+        dist (np.ndarray): distance in kilometers to the matched stop of every row of df, calculated when not given
+
+    Returns:
+        pd.DataFrame: rows of df joined with their timetable rows, with new "dist" column, nothing is filtered out
+    """
+    tt = index.frame.iloc[pos].drop(columns=['bus', 'brygada', 't'])
+    df = pd.concat([df.reset_index(drop=True), tt.reset_index(drop=True)], axis=1)
+
+    # calculate distance to stop
+    df['dist'] = stop_dist_np(df) if dist is None else dist
+    return df
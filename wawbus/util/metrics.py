@@ -0,0 +1,254 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (0, 10, 100, 1000, 2500, 5000, 10000, 100000)
+
+
+def _labels(labels: Dict[str, str]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    """
+    Monotonically increasing value, one per combination of labels
+
+    Attributes:
+        name (str): metric name
+        help (str): description
+    """
+    name: str
+    help: str
+
+    def __init__(self, registry: "Metrics", name: str, help: str):
+        self.name = name
+        self.help = help
+        self._registry = registry
+        self._lock = Lock()
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, value: float = 1, **labels):
+        """
+        Args:
+            value (float): increment
+            labels: label values
+        """
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+        self._registry._notify(self.name, labels, value)
+
+    def value(self, **labels) -> float:
+        """
+        Returns:
+            float: current value for the labels
+        """
+        return self._values.get(_labels(labels), 0)
+
+    def collect(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(key)} {_format_value(value)}"
+
+
+class Histogram:
+    """
+    Distribution of observed values in cumulative buckets, one per combination of labels
+
+    Attributes:
+        name (str): metric name
+        help (str): description
+        buckets (tuple): upper bounds of buckets
+    """
+    name: str
+    help: str
+    buckets: tuple
+
+    def __init__(self, registry: "Metrics", name: str, help: str, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._registry = registry
+        self._lock = Lock()
+        # per labels: counts of every bucket (+Inf last), sum
+        self._values: Dict[tuple, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        """
+        Args:
+            value (float): observed value
+            labels: label values
+        """
+        key = _labels(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[i] += 1
+            total[0] += value
+        self._registry._notify(self.name, labels, value)
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Context manager observing its duration in seconds
+
+        Args:
+            labels: label values
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        """
+        Returns:
+            int: number of observations for the labels
+        """
+        counts, _ = self._values.get(_labels(labels), ([0], [0.0]))
+        return sum(counts)
+
+    def sum(self, **labels) -> float:
+        """
+        Returns:
+            float: sum of observations for the labels
+        """
+        return self._values.get(_labels(labels), ([0], [0.0]))[1][0]
+
+    def collect(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            values = [(key, list(counts), total[0]) for key, (counts, total) in self._values.items()]
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = (("le", bound if isinstance(bound, str) else _format_value(bound)),)
+                yield f"{self.name}_bucket{_format_labels(key, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(key)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(key)} {cumulative}"
+
+
+class Metrics:
+    """
+    Registry of counters and histograms, exported in the Prometheus text exposition format
+    with exposition(), served over HTTP with serve(), or pushed to callbacks on every observation.
+
+    Observations only take a lock and update a dict entry, so they're cheap enough to leave enabled.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._metrics: Dict[str, object] = {}
+        self._callbacks: List[Callable[[str, dict, float], None]] = []
+
+    def _get(self, cls, name: str, *args):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(self, name, *args)
+            metric = self._metrics[name]
+        if not isinstance(metric, cls):
+            raise ValueError(f"{name} is already registered as {type(metric).__name__}")
+        return metric
+
+    def counter(self, name: str, help: str = "") -> Counter:
+        """
+        Args:
+            name (str): metric name
+            help (str): description
+
+        Returns:
+            Counter: registered counter, created on the first call
+        """
+        return self._get(Counter, name, help)
+
+    def histogram(self, name: str, help: str = "", buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        """
+        Args:
+            name (str): metric name
+            help (str): description
+            buckets (tuple): upper bounds of buckets, latency in seconds by default
+
+        Returns:
+            Histogram: registered histogram, created on the first call
+        """
+        return self._get(Histogram, name, help, buckets)
+
+    def subscribe(self, callback: Callable[[str, dict, float], None]):
+        """
+        Call callback(name, labels, value) on every observation, e.g. to forward metrics to another system
+
+        Args:
+            callback (Callable): function called on every observation, it should be fast
+        """
+        self._callbacks.append(callback)
+
+    def _notify(self, name: str, labels: dict, value: float):
+        for callback in self._callbacks:
+            callback(name, labels, value)
+
+    def exposition(self) -> str:
+        """
+        Returns:
+            str: all metrics in the Prometheus text exposition format
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "".join(line + "\n" for metric in metrics for line in metric.collect())
+
+    def serve(self, port: int, host: str = "") -> ThreadingHTTPServer:
+        """
+        Serve exposition() on http://host:port/metrics in a daemon thread
+
+        Args:
+            port (int): port to listen on, 0 picks a free one
+            host (str): address to listen on, all by default
+
+        Returns:
+            ThreadingHTTPServer: running server, call shutdown() to stop it
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.exposition().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+REGISTRY = Metrics()
+"""Default registry, used by ZtmApi and WawBus unless they get their own"""
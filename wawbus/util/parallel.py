@@ -0,0 +1,233 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from itertools import repeat
+from multiprocessing.shared_memory import SharedMemory
+from os import cpu_count
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .dist import haversine_np
+from .late import MIN_STOP_DIST, late_frame
+from .time import timeint_np
+from .timetable import TimetableIndex, lookup_keys
+
+
+def resolve_jobs(n_jobs: int) -> int:
+    """
+    Args:
+        n_jobs (int): number of processes, negative values count from the number of CPUs (-1 means all of them)
+
+    Returns:
+        int: number of processes
+    """
+    if n_jobs < 0:
+        return max(1, (cpu_count() or 1) + 1 + n_jobs)
+    return max(1, n_jobs)
+
+
+class SharedArrays:
+    """
+    NumPy arrays packed into a single shared memory block, so worker processes can use them without copying.
+    Only the (picklable) spec is sent to workers, they get the arrays with SharedArrays.attach.
+
+    Attributes:
+        spec (tuple): shared memory block name and layout of the arrays
+    """
+    spec: tuple
+
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        """
+        Args:
+            arrays (Dict[str, np.ndarray]): arrays to share, they're copied into the block
+        """
+        layout = []
+        size = 0
+        for key, arr in arrays.items():
+            layout.append((key, arr.dtype.str, arr.shape, size))
+            size += arr.nbytes
+        self._shm = SharedMemory(create=True, size=max(size, 1))
+        self.spec = (self._shm.name, tuple(layout))
+        for key, arr in arrays.items():
+            self[key][...] = arr
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        for k, dtype, shape, offset in self.spec[1]:
+            if k == key:
+                return np.ndarray(shape, dtype=dtype, buffer=self._shm.buf, offset=offset)
+        raise KeyError(key)
+
+    @staticmethod
+    def attach(spec: tuple) -> Tuple[SharedMemory, Dict[str, np.ndarray]]:
+        """
+        Args:
+            spec (tuple): SharedArrays.spec
+
+        Returns:
+            shared memory block (close it once the arrays are no longer referenced) and the arrays
+        """
+        shm = SharedMemory(name=spec[0])
+        return shm, {k: np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+                     for k, dtype, shape, offset in spec[1]}
+
+    def close(self):
+        self._shm.close()
+        self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _row_codes(df: pd.DataFrame) -> np.ndarray:
+    """
+    Args:
+        df (pd.DataFrame): any dataframe
+
+    Returns:
+        np.ndarray: int64 array of shape (columns, rows), rows of df which are equal for drop_duplicates
+            have equal columns of it
+    """
+    codes = np.empty((len(df.columns), len(df)), dtype=np.int64)
+    for i, column in enumerate(df.columns):
+        values = df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            codes[i] = values.cat.codes.values
+        elif values.dtype.kind == 'M':
+            codes[i] = values.values.view(np.int64)
+        elif values.dtype.kind == 'f':
+            x = values.values.astype(np.float64) + 0.0  # -0.0 becomes 0.0
+            x[np.isnan(x)] = np.nan  # a single NaN bit pattern
+            codes[i] = x.view(np.int64)
+        elif values.dtype.kind in 'biu':
+            codes[i] = values.values
+        else:
+            codes[i] = pd.factorize(values)[0]
+    return codes
+
+
+def _first_occurrences(keys: np.ndarray) -> np.ndarray:
+    """
+    Args:
+        keys (np.ndarray): int64 array of shape (columns, rows)
+
+    Returns:
+        np.ndarray: positions of rows which aren't equal to any earlier row, in order
+    """
+    # hashing int64 columns is much cheaper than drop_duplicates on the joined frame
+    return np.flatnonzero(~pd.DataFrame(keys.T, copy=False).duplicated().values)
+
+
+def _late_chunk(arrays: Dict[str, np.ndarray], out: Dict[str, np.ndarray], start: int, tolerance: int) -> int:
+    pos = lookup_keys(arrays['keys'], arrays['group'], arrays['t'], tolerance)
+    rows = np.flatnonzero(pos >= 0)
+    pos = pos[rows]
+    dist = haversine_np(arrays['lon'][rows], arrays['lat'][rows], arrays['stop_lon'][pos], arrays['stop_lat'][pos])
+
+    # filter out buses that are too close to the stop
+    near = dist >= MIN_STOP_DIST
+    rows, pos, dist = rows[near], pos[near], dist[near]
+
+    # order of late_join within a line, duplicates can only be found within a line
+    order = np.lexsort((arrays['t'][rows], arrays['line'][rows]))
+    rows, pos, dist = rows[order], pos[order], dist[order]
+    keep = _first_occurrences(np.vstack((arrays['codes'][:, rows], arrays['tt_ids'][pos])))
+
+    end = start + len(keep)
+    out['rows'][start:end] = arrays['rows'][rows[keep]]
+    out['pos'][start:end] = arrays['tt_rows'][pos[keep]]
+    out['dist'][start:end] = dist[keep]
+    return len(keep)
+
+
+def _late_worker(spec: tuple, out_spec: tuple, start: int, tolerance: int) -> int:
+    shm, arrays = SharedArrays.attach(spec)
+    out_shm, out = SharedArrays.attach(out_spec)
+    count = _late_chunk(arrays, out, start, tolerance)
+    arrays.clear()  # views must be gone before the blocks are closed
+    out.clear()
+    shm.close()
+    out_shm.close()
+    return count
+
+
+def late_parallel(df: pd.DataFrame, index: TimetableIndex, tolerance: pd.Timedelta, n_jobs: int) -> pd.DataFrame:
+    """
+    Calculate how late buses are (see late_join) in a process pool, partitioned by line.
+    Lines are split between processes here, every process gets a shared memory block with only the positions
+    of its lines and the index keys of their timetable. Processes match positions, filter out the ones at the stop
+    and drop duplicates, writing the remaining rows, their timetable rows and distances to stops
+    into shared output arrays. Here they're only joined into the result frame.
+
+    Args:
+        df (pd.DataFrame): bus positions
+        index (TimetableIndex): timetable with stop locations of the day type of df
+        tolerance (pd.Timedelta): time tolerance for merging timetable and dataset
+        n_jobs (int): number of processes
+
+    Returns:
+        pd.DataFrame: results of late_join, rows are grouped by line and sorted by time of day within a line
+    """
+    t = timeint_np(df['Time'].values).astype(np.int64)
+    line, group = index.groups(df['Lines'], df['Brigade'])
+    sizes = np.bincount(line[line >= 0])
+
+    # greedy assignment of the biggest lines to the least loaded process
+    jobs = [[] for _ in range(n_jobs)]
+    load = np.zeros(n_jobs, dtype=np.int64)
+    for code in sorted(np.flatnonzero(sizes), key=lambda c: (-sizes[c], c)):
+        i = int(np.argmin(load))
+        jobs[i].append(code)
+        load[i] += sizes[code]
+    load = load[[bool(job) for job in jobs]]
+    jobs = [np.sort(job) for job in jobs if job]
+    if not jobs:
+        return late_frame(df.iloc[:0], index, np.arange(0), np.arange(0, dtype=np.float64))
+
+    # rows of positions of the lines of every process, processes one after another
+    job_of = np.full(len(sizes), len(jobs), dtype=np.int64)
+    for i, job in enumerate(jobs):
+        job_of[job] = i
+    valid = np.flatnonzero(line >= 0)
+    perm = valid[np.argsort(job_of[line[valid]] * len(sizes) + line[valid], kind='stable')]
+    starts = np.cumsum(load) - load
+
+    lon, lat = np.asarray(df['Lon'].values), np.asarray(df['Lat'].values)
+    stop_lon = np.asarray(index.frame['dlug_geo'].values, dtype=np.float64)
+    stop_lat = np.asarray(index.frame['szer_geo'].values, dtype=np.float64)
+    codes = _row_codes(df)
+    with ExitStack() as stack:
+        specs = []
+        for job, start, size in zip(jobs, starts, load):
+            rows = perm[start:start + size]
+            # timetable rows of a line are contiguous, so keys of the lines of a process stay sorted
+            tt_rows = np.concatenate([np.arange(a, b) for a, b in zip(*index.line_bounds(job))])
+            specs.append(stack.enter_context(SharedArrays({
+                'rows': rows,
+                'line': line[rows],
+                'group': group[rows],
+                't': t[rows],
+                'lon': lon[rows],
+                'lat': lat[rows],
+                'codes': codes[:, rows],
+                'keys': index.keys[tt_rows],
+                'tt_rows': tt_rows,
+                'tt_ids': index.row_ids[tt_rows],
+                'stop_lon': stop_lon[tt_rows],
+                'stop_lat': stop_lat[tt_rows],
+            })).spec)
+        out = stack.enter_context(SharedArrays({
+            'rows': np.empty(len(perm), dtype=np.int64),
+            'pos': np.empty(len(perm), dtype=np.int64),
+            'dist': np.empty(len(perm), dtype=np.float64),
+        }))
+        with ProcessPoolExecutor(len(jobs)) as pool:
+            counts = list(pool.map(_late_worker, specs, repeat(out.spec), starts.tolist(),
+                                   repeat(int(tolerance.total_seconds()))))
+        kept = np.concatenate([np.arange(start, start + count) for start, count in zip(starts, counts)])
+        rows, pos, dist = out['rows'][kept], out['pos'][kept], out['dist'][kept]
+
+    return late_frame(df.iloc[rows], index, pos, dist)
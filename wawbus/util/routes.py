@@ -0,0 +1,209 @@
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+from .dist import EARTH_RADIUS
+from ..constants import M_TO_KM
+
+
+class RouteIndex:
+    """
+    Route polylines of every line and direction, built from stop sequences of routes and stop coordinates,
+    for measuring distance travelled along the route instead of in a straight line.
+
+    Coordinates are projected to a local equirectangular plane (in meters), every segment between consecutive stops
+    is bucketed into all square cells of `radius` size it passes within `radius` of, so a position is only projected
+    onto segments of its line registered in its own cell.
+
+    Attributes:
+        radius (float): maximum distance in meters between a position and a route it's projected onto
+        polylines (pd.DataFrame): one row per polyline with 'line' and 'direction' columns,
+            rows are referenced by route ids returned from project
+        lengths (np.ndarray): length of every polyline in meters
+    """
+    radius: float
+    polylines: pd.DataFrame
+    lengths: np.ndarray
+
+    def __init__(self, routes: pd.DataFrame, stops: pd.DataFrame, radius: float = 100):
+        """
+        Args:
+            routes (pd.DataFrame): routes with 'bus', 'direction', 'stop' (position in the sequence), 'nr_zespolu'
+                and 'nr_przystanku' columns, see WawBus.routes
+            stops (pd.DataFrame): stop locations with 'zespol', 'slupek', 'szer_geo' (lat), 'dlug_geo' (lon) columns
+            radius (float): maximum distance in meters between a position and a route it's projected onto
+        """
+        self.radius = radius
+        df = pd.merge(routes[['bus', 'direction', 'stop', 'nr_zespolu', 'nr_przystanku']].astype(str),
+                      stops[['zespol', 'slupek', 'szer_geo', 'dlug_geo']].astype({'zespol': str, 'slupek': str}),
+                      left_on=['nr_zespolu', 'nr_przystanku'], right_on=['zespol', 'slupek'])
+        df['seq'] = pd.to_numeric(df['stop'], errors='coerce')
+        df = df.dropna(subset=['seq', 'szer_geo', 'dlug_geo']).sort_values(['bus', 'direction', 'seq'], kind='stable')
+
+        route = df.groupby(['bus', 'direction'], sort=False).ngroup().values
+        self.polylines = df[['bus', 'direction']].drop_duplicates().rename(columns={'bus': 'line'})
+        self.polylines = self.polylines.reset_index(drop=True)
+        self._lines = pd.Index(pd.unique(self.polylines['line']))
+        self._lat0 = float(np.radians(df['szer_geo'].mean())) if len(df) else 0.0
+        x, y = self._project(df['szer_geo'].values, df['dlug_geo'].values)
+
+        # segments join consecutive stops of the same polyline
+        same = route[1:] == route[:-1]
+        self._sx, self._sy = x[:-1][same], y[:-1][same]
+        self._dx, self._dy = x[1:][same] - self._sx, y[1:][same] - self._sy
+        self._route = route[:-1][same]
+        self._length = length = np.hypot(self._dx, self._dy)
+
+        # cumulative distance of every segment's start along its polyline
+        cumulative = np.cumsum(length)
+        first = np.flatnonzero(np.r_[True, self._route[1:] != self._route[:-1]]) if len(length) else np.empty(0, int)
+        before = np.repeat(cumulative[first] - length[first], np.diff(np.r_[first, len(length)]))
+        self._start = cumulative - length - before
+        self.lengths = np.zeros(len(self.polylines))
+        np.add.at(self.lengths, self._route, length)
+
+        self._build_grid(self._lines.get_indexer(self.polylines['line'].values)[self._route])
+
+    def _project(self, lat, lon) -> Tuple[np.ndarray, np.ndarray]:
+        lat = np.radians(np.asarray(lat, dtype=np.float64))
+        lon = np.radians(np.asarray(lon, dtype=np.float64))
+        return lon * np.cos(self._lat0) * EARTH_RADIUS * 1000, lat * EARTH_RADIUS * 1000
+
+    def _build_grid(self, line: np.ndarray):
+        ex, ey = self._sx + self._dx, self._sy + self._dy
+        self._x0 = min(self._sx.min(), ex.min()) - 2 * self.radius if len(line) else 0.0
+        self._y0 = min(self._sy.min(), ey.min()) - 2 * self.radius if len(line) else 0.0
+        cx0, cy0 = self._cells(np.minimum(self._sx, ex) - self.radius, np.minimum(self._sy, ey) - self.radius)
+        cx1, cy1 = self._cells(np.maximum(self._sx, ex) + self.radius, np.maximum(self._sy, ey) + self.radius)
+        self._nx = int(cx1.max()) + 2 if len(line) else 1
+        self._ny = int(cy1.max()) + 2 if len(line) else 1
+
+        # register every segment in all cells of its bounding box, expanded by radius
+        wx, wy = cx1 - cx0 + 1, cy1 - cy0 + 1
+        segment = np.repeat(np.arange(len(line)), wx * wy)
+        k = np.arange(len(segment)) - np.repeat(np.cumsum(wx * wy) - wx * wy, wx * wy)
+        keys = self._keys(line[segment], cx0[segment] + k // wy[segment], cy0[segment] + k % wy[segment])
+
+        # entries of a cell are ordered by route, so candidates of a position come grouped by route
+        order = np.lexsort((self._route[segment], keys))
+        self._keys_sorted = keys[order]
+        self._segments = segment[order]
+
+    def _cells(self, x, y) -> Tuple[np.ndarray, np.ndarray]:
+        return (np.floor((x - self._x0) / self.radius).astype(np.int64),
+                np.floor((y - self._y0) / self.radius).astype(np.int64))
+
+    def _keys(self, line, cx, cy) -> np.ndarray:
+        return (line * self._nx + cx) * self._ny + cy
+
+    def line_codes(self, lines) -> np.ndarray:
+        """
+        Args:
+            lines: line of every position, categoricals are looked up once per category
+
+        Returns:
+            np.ndarray: codes of lines to pass to project and travelled, -1 for lines without routes
+        """
+        if isinstance(getattr(lines, 'dtype', None), pd.CategoricalDtype):
+            lines = pd.Categorical(lines)
+            return np.append(self._lines.get_indexer(lines.categories.astype(str)), -1)[lines.codes]
+        return self._lines.get_indexer(pd.Index(lines).astype(str))
+
+    def project(self, line: np.ndarray, lat, lon) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Project positions onto every route of their line passing within radius
+
+        Args:
+            line (np.ndarray): code of the line of every position (see line_codes)
+            lat (np.ndarray): latitudes
+            lon (np.ndarray): longitudes
+
+        Returns:
+            four arrays with one element per (position, route) match, sorted by position and route:
+            positions, route ids (rows of self.polylines), distances along the route and distances from the route,
+            both in meters
+        """
+        x, y = self._project(lat, lon)
+        cx, cy = self._cells(np.nan_to_num(x, nan=-1), np.nan_to_num(y, nan=-1))
+
+        valid = (line >= 0) & (cx >= 0) & (cx < self._nx) & (cy >= 0) & (cy < self._ny)
+        keys = self._keys(line, cx, cy)
+        start = np.searchsorted(self._keys_sorted, keys, side='left')
+        count = np.where(valid, np.searchsorted(self._keys_sorted, keys + 1, side='left') - start, 0)
+
+        # every (position, candidate segment) pair, ordered by position and route (see _build_grid)
+        fix = np.repeat(np.arange(len(x)), count)
+        seg = self._segments[np.arange(len(fix)) + np.repeat(start - np.cumsum(count) + count, count)]
+
+        px, py = x[fix] - self._sx[seg], y[fix] - self._sy[seg]
+        dx, dy = self._dx[seg], self._dy[seg]
+        length = self._length[seg]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = np.clip((px * dx + py * dy) / (length * length), 0, 1)
+        t[length == 0] = 0
+        offset = np.hypot(px - t * dx, py - t * dy)
+
+        near = offset <= self.radius
+        fix, seg, t, offset = fix[near], seg[near], t[near], offset[near]
+        route = self._route[seg]
+        along = self._start[seg] + t * self._length[seg]
+        if not len(fix):
+            return fix, route, along, offset
+
+        # keep the closest segment of every route
+        first = np.flatnonzero(np.r_[True, (fix[1:] != fix[:-1]) | (route[1:] != route[:-1])])
+        best = _argmin_groups(offset, first)
+        return fix[best], route[best], along[best], offset[best]
+
+    def travelled(self, line: np.ndarray, lat, lon, last: np.ndarray) -> np.ndarray:
+        """
+        Distance travelled along the route between consecutive positions of trajectories.
+        Both positions have to be projected onto the same route, with the second one further along it,
+        when there's more than one such route, the one closest to both positions is used.
+
+        Args:
+            line (np.ndarray): code of the line of every position (see line_codes), in trajectory order
+                (see Trajectories.take)
+            lat (np.ndarray): latitudes, in trajectory order
+            lon (np.ndarray): longitudes, in trajectory order
+            last (np.ndarray): positions of the last element of each trajectory (see Trajectories.last)
+
+        Returns:
+            np.ndarray: distance in kilometers from every position to the next one, NaN when it isn't known
+        """
+        out = np.full(len(lat), np.nan)
+        fix, route, along, offset = self.project(line, lat, lon)
+        if not len(fix):
+            return out
+
+        # match (position, route) with (next position, same route), keys are sorted by project
+        n = len(self.polylines)
+        keys = fix.astype(np.int64) * n + route
+        pos = np.minimum(np.searchsorted(keys, keys + n), len(keys) - 1)
+        ends = np.zeros(len(lat), dtype=bool)
+        ends[last] = True
+        found = (keys[pos] == keys + n) & ~ends[fix] & (along[pos] >= along)
+
+        fix, delta, score = fix[found], along[pos][found] - along[found], offset[found] + offset[pos][found]
+        if not len(fix):
+            return out
+        best = _argmin_groups(score, np.flatnonzero(np.r_[True, fix[1:] != fix[:-1]]))
+        out[fix[best]] = delta[best] * M_TO_KM
+        return out
+
+
+def _argmin_groups(values: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    """
+    Args:
+        values (np.ndarray): values of consecutive groups
+        starts (np.ndarray): positions of the first element of each group
+
+    Returns:
+        np.ndarray: position of the first minimum of every group
+    """
+    sizes = np.diff(np.r_[starts, len(values)])
+    is_min = values == np.repeat(np.minimum.reduceat(values, starts), sizes)
+    # first minimum of a group: the smallest position at or after its start, where is_min holds
+    candidates = np.flatnonzero(is_min)
+    return candidates[np.searchsorted(candidates, starts)]
@@ -0,0 +1,106 @@
+from math import ceil, floor, inf
+from time import sleep, time
+from typing import Callable, Optional
+
+
+class PollScheduler:
+    """
+    Fixed-rate scheduler for polling. Ticks are placed on a grid of multiples of interval
+    (aligned to wall-clock time), so time spent on requests doesn't shift later polls.
+    When a poll takes longer than interval, the ticks it overran are skipped.
+
+    Attributes:
+        interval (float): target time between ticks in seconds
+        late_tolerance (float): how late (in seconds) a tick can fire before it's counted as late
+        ticks (int): number of fired ticks
+        skipped (int): number of ticks skipped because a poll took too long
+        late (int): number of ticks fired later than late_tolerance
+        last_interval (float): time between the last two fired ticks in seconds, None before the second tick
+    """
+    interval: float
+    late_tolerance: float
+    ticks: int = 0
+    skipped: int = 0
+    late: int = 0
+    last_interval: Optional[float] = None
+
+    def __init__(self, interval: float, align: bool = True, late_tolerance: float = 0.1,
+                 clock: Callable[[], float] = time, sleep_fn: Callable[[float], None] = sleep):
+        """
+        Args:
+            interval (float): target time between ticks in seconds
+            align (bool): align ticks to multiples of interval since the epoch
+            late_tolerance (float): how late (in seconds) a tick can fire before it's counted as late
+            clock (Callable): wall-clock time source
+            sleep_fn (Callable): sleep function
+        """
+        self.interval = interval
+        self.late_tolerance = late_tolerance
+        self._align = align
+        self._clock = clock
+        self._sleep = sleep_fn
+        self._start: Optional[float] = None
+        self._k = 0
+        self._last_fired: Optional[float] = None
+        self._interval_sum = 0.0
+        self._interval_min = inf
+        self._interval_max = 0.0
+
+    def wait(self) -> float:
+        """
+        Sleep until the next tick
+
+        Returns:
+            float: scheduled time of the tick
+        """
+        now = self._clock()
+        if self.interval <= 0:
+            self._record(now)
+            return now
+
+        if self._start is None:
+            self._start = ceil(now / self.interval) * self.interval if self._align else now
+
+        scheduled = self._start + self._k * self.interval
+        if now >= scheduled + self.interval:
+            # fire the most recent due tick, the older ones are lost
+            missed = floor((now - scheduled) / self.interval)
+            self.skipped += missed
+            self._k += missed
+            scheduled = self._start + self._k * self.interval
+
+        if scheduled > now:
+            self._sleep(scheduled - now)
+
+        fired = self._clock()
+        if fired - scheduled > self.late_tolerance:
+            self.late += 1
+        self._record(fired)
+        self._k += 1
+        return scheduled
+
+    def _record(self, fired: float):
+        if self._last_fired is not None:
+            actual = fired - self._last_fired
+            self.last_interval = actual
+            self._interval_sum += actual
+            self._interval_min = min(self._interval_min, actual)
+            self._interval_max = max(self._interval_max, actual)
+        self._last_fired = fired
+        self.ticks += 1
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: target and actual (mean, min, max) interval between ticks, number of fired, skipped and late ticks
+        """
+        measured = self.ticks - 1
+        return {
+            'target_interval': self.interval,
+            'mean_interval': self._interval_sum / measured if measured > 0 else None,
+            'min_interval': self._interval_min if measured > 0 else None,
+            'max_interval': self._interval_max if measured > 0 else None,
+            'ticks': self.ticks,
+            'skipped': self.skipped,
+            'late': self.late,
+        }
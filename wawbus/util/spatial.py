@@ -0,0 +1,101 @@
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+from .dist import EARTH_RADIUS, haversine_np
+
+
+class StopIndex:
+    """
+    Grid index of stops, keyed per line, for nearest stop queries.
+
+    Coordinates are projected to a local equirectangular plane (in meters), stops are bucketed into square cells
+    of `radius` size, so only the 3x3 neighbouring cells of the same line have to be checked.
+
+    Attributes:
+        radius (float): search radius in meters
+        stops (pd.DataFrame): indexed stops, rows are referenced by positions returned from query
+    """
+    radius: float
+    stops: pd.DataFrame
+
+    def __init__(self, stops: pd.DataFrame, radius: float = 50):
+        """
+        Args:
+            stops (pd.DataFrame): one row per (line, stop) with 'line', 'szer_geo' (lat), 'dlug_geo' (lon) columns
+            radius (float): search radius in meters
+        """
+        self.radius = radius
+        self._lines = pd.Index(pd.unique(stops['line'].astype(str)))
+        self._lat0 = float(np.radians(stops['szer_geo'].mean())) if len(stops) else 0.0
+
+        x, y = self._project(stops['szer_geo'].values, stops['dlug_geo'].values)
+        self._x0 = x.min() if len(x) else 0.0
+        self._y0 = y.min() if len(y) else 0.0
+        cx, cy = self._cells(x, y)
+        # one spare cell on every side of the stops
+        self._nx = int(cx.max()) + 3 if len(cx) else 1
+        self._ny = int(cy.max()) + 3 if len(cy) else 1
+
+        keys = self._keys(self._lines.get_indexer(stops['line'].astype(str)), cx, cy)
+        order = np.argsort(keys, kind='stable')
+        self.stops = stops.iloc[order].reset_index(drop=True)
+        self._keys_sorted = keys[order]
+        self._x = x[order]
+        self._y = y[order]
+        self._max_occupancy = int(np.unique(keys, return_counts=True)[1].max()) if len(keys) else 0
+
+    def _project(self, lat, lon) -> Tuple[np.ndarray, np.ndarray]:
+        lat = np.radians(np.asarray(lat, dtype=np.float64))
+        lon = np.radians(np.asarray(lon, dtype=np.float64))
+        return lon * np.cos(self._lat0) * EARTH_RADIUS * 1000, lat * EARTH_RADIUS * 1000
+
+    def _cells(self, x, y) -> Tuple[np.ndarray, np.ndarray]:
+        return (np.floor((x - self._x0) / self.radius).astype(np.int64) + 1,
+                np.floor((y - self._y0) / self.radius).astype(np.int64) + 1)
+
+    def _keys(self, line, cx, cy) -> np.ndarray:
+        return (line * self._nx + cx) * self._ny + cy
+
+    def query(self, lines, lat, lon) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the nearest stop of the given line within radius for every position
+
+        Args:
+            lines (np.ndarray): line of every position
+            lat (np.ndarray): latitudes
+            lon (np.ndarray): longitudes
+
+        Returns:
+            positions in self.stops (-1 when there's no stop within radius) and distances in kilometers (NaN then)
+        """
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        line = self._lines.get_indexer(pd.Index(lines).astype(str))
+        x, y = self._project(lat, lon)
+        cx, cy = self._cells(x, y)
+
+        best = np.full(len(lat), -1, dtype=np.int64)
+        best_d2 = np.full(len(lat), self.radius ** 2)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                # cells outside the indexed area (and unknown lines) have no stops
+                valid = (line >= 0) & (cx + dx >= 0) & (cx + dx < self._nx) & (cy + dy >= 0) & (cy + dy < self._ny)
+                keys = self._keys(line, cx + dx, cy + dy)
+                start = np.searchsorted(self._keys_sorted, keys, side='left')
+                count = np.searchsorted(self._keys_sorted, keys, side='right') - start
+                for j in range(self._max_occupancy):
+                    mask = valid & (count > j)
+                    cand = start[mask] + j
+                    d2 = (self._x[cand] - x[mask]) ** 2 + (self._y[cand] - y[mask]) ** 2
+                    closer = d2 <= best_d2[mask]
+                    idx = np.flatnonzero(mask)[closer]
+                    best[idx] = cand[closer]
+                    best_d2[idx] = d2[closer]
+
+        found = best >= 0
+        dist = np.full(len(lat), np.nan)
+        stops = self.stops.iloc[best[found]]
+        dist[found] = haversine_np(lon[found], lat[found], stops['dlug_geo'].values, stops['szer_geo'].values)
+        return best, dist
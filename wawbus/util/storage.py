@@ -0,0 +1,455 @@
+import os
+from datetime import datetime
+from glob import glob
+from os.path import exists, getsize, isdir, join
+from time import time
+from typing import Callable, Iterable, Optional, Tuple, List
+from uuid import uuid4
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+from .dtypes import compact_positions
+
+POSITIONS_SCHEMA = pa.schema([
+    ("Lat", pa.float64()),
+    ("Lon", pa.float64()),
+    ("Time", pa.timestamp("ns")),
+    ("Lines", pa.string()),
+    ("VehicleNumber", pa.string()),
+    ("Brigade", pa.string()),
+])
+ARROW_EXTENSIONS = ("arrow", "feather")
+
+
+def read_frame(path: str) -> pd.DataFrame:
+    """
+    Read a dataframe saved with write_frame, file type is picked by extension
+
+    Args:
+        path (str): .csv, .parquet, .gzip (gzip compressed parquet) or .arrow/.feather (Arrow IPC) file
+
+    Returns:
+        pd.DataFrame: loaded dataframe, csv columns are loaded as strings
+    """
+    filetype = path.split(".")[-1]
+    if filetype == "csv":
+        return pd.read_csv(path, dtype=str)
+    elif filetype in ("parquet", "gzip"):
+        return pd.read_parquet(path)
+    elif filetype in ARROW_EXTENSIONS:
+        return read_arrow(path)
+    else:
+        raise ValueError("Unsupported file type")
+
+
+def read_arrow(path: str, columns: Optional[List[str]] = None, filter=None) -> pd.DataFrame:
+    """
+    Read an uncompressed Arrow IPC (Feather) file through a memory map.
+    Numeric and timestamp columns without nulls are not copied, they point into the mapped file,
+    so processes reading the same file share it through the page cache.
+
+    Args:
+        path (str): .arrow or .feather file
+        columns (List[str]): columns to load, all by default
+        filter (pyarrow.dataset.Expression): only load rows matching it, matching rows are copied
+
+    Returns:
+        pd.DataFrame: loaded dataframe
+    """
+    table = feather.read_table(path, memory_map=True)
+    if filter is not None:
+        table = table.filter(filter)
+    if columns is not None:
+        table = table.select(columns)
+    return table.to_pandas(split_blocks=True)
+
+
+def _and(expr: Optional[ds.Expression], cond: ds.Expression) -> ds.Expression:
+    return cond if expr is None else expr & cond
+
+
+def _positions_filter(time_type: pa.DataType, lines: Optional[Iterable[str]] = None,
+                      time_range: Optional[Tuple] = None) -> Optional[ds.Expression]:
+    expr = None
+    if lines is not None:
+        expr = ds.field("Lines").isin([str(line) for line in lines])
+    if time_range is not None:
+        start, end = time_range
+        if start is not None:
+            expr = _and(expr, ds.field("Time") >= pa.scalar(pd.Timestamp(start), type=time_type))
+        if end is not None:
+            expr = _and(expr, ds.field("Time") < pa.scalar(pd.Timestamp(end), type=time_type))
+    return expr
+
+
+def read_positions(source, columns: Optional[List[str]] = None, lines: Optional[Iterable[str]] = None,
+                   time_range: Optional[Tuple] = None, format: str = "parquet") -> pd.DataFrame:
+    """
+    Read bus positions, selecting only some columns and rows.
+    Filters are pushed down to pyarrow, row groups whose statistics don't match are skipped without being read.
+
+    Args:
+        source: file, directory or list of files, a single .arrow/.feather file is memory mapped (see read_arrow)
+        columns (List[str]): columns to load, all by default
+        lines (Iterable[str]): only load these lines
+        time_range (tuple): only load positions with start <= Time < end, either bound can be None
+        format (str): pyarrow dataset format of the files
+
+    Returns:
+        pd.DataFrame: bus positions
+    """
+    mapped = isinstance(source, str) and source.split(".")[-1] in ARROW_EXTENSIONS
+    dataset = ds.dataset(source, format="ipc" if mapped else format)
+
+    expr = _positions_filter(dataset.schema.field("Time").type, lines, time_range)
+    if mapped:
+        return read_arrow(source, columns=columns, filter=expr)
+    return dataset.to_table(columns=columns, filter=expr).to_pandas()
+
+
+def write_frame(df: pd.DataFrame, path: str):
+    """
+    Write a dataframe, file type is picked by extension
+
+    Args:
+        df (pd.DataFrame): dataframe to write
+        path (str): .csv, .parquet, .gzip (gzip compressed parquet) or .arrow/.feather (uncompressed Arrow IPC,
+            can be memory mapped by read_arrow, bus position columns are stored with compact dtypes, see
+            compact_positions) file
+    """
+    filetype = path.split(".")[-1]
+    if filetype == "csv":
+        df.to_csv(path, index=False)
+    elif filetype in ARROW_EXTENSIONS:
+        # stored with the dtypes used in memory, so a mapped load doesn't convert (and copy) any column,
+        # in a single record batch, so columns aren't concatenated (and copied) from chunks either
+        table = pa.Table.from_pandas(compact_positions(df), preserve_index=False).combine_chunks()
+        feather.write_feather(table, path, compression="uncompressed", chunksize=max(len(table), 1))
+    elif filetype == "parquet":
+        df.to_parquet(path, index=False)
+    elif filetype == "gzip":
+        df.to_parquet(path, index=False, compression="gzip")
+    else:
+        raise ValueError("Unsupported file type")
+
+
+class PositionsWriter:
+    """
+    Streaming writer for bus positions, writes collected snapshots to a directory of numbered parquet files
+    (<path>/part-000000.parquet, ...), so memory usage doesn't grow with the number of collections.
+
+    Every flushed batch is a complete file, written under a hidden name and renamed once it's finished,
+    so everything flushed so far can be read (e.g. with pd.read_parquet(path)) while collection is running
+    or after it was killed. Writing to an existing directory continues its numbering.
+
+    Attributes:
+        path (str): output directory
+        batch_size (int): number of snapshots written as one file
+        rows (int): number of rows written so far
+        parts (int): number of files written so far
+        nbytes (int): size of files written so far
+    """
+    path: str
+    batch_size: int
+    rows: int = 0
+    parts: int = 0
+    nbytes: int = 0
+
+    def __init__(self, path: str, batch_size: int = 1, compression: Optional[str] = "snappy",
+                 schema: pa.Schema = POSITIONS_SCHEMA):
+        """
+        Args:
+            path (str): output directory, created if it doesn't exist
+            batch_size (int): number of snapshots written as one file
+            compression (str): parquet compression codec
+            schema (pa.Schema): schema of the written data
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self._schema = schema
+        self._compression = compression
+        self._batch = []
+        os.makedirs(path, exist_ok=True)
+        numbers = [int(name[len("part-"):-len(".parquet")]) for name in os.listdir(path)
+                   if name.startswith("part-") and name.endswith(".parquet")]
+        self._next = max(numbers, default=-1) + 1
+
+    def write(self, df: pd.DataFrame):
+        """
+        Add a snapshot to the current batch, the batch is written once it has batch_size snapshots
+
+        Args:
+            df (pd.DataFrame): snapshot of bus positions
+        """
+        self._batch.append(df)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the current batch as a new file
+        """
+        if not self._batch:
+            return
+        df = pd.concat(self._batch, ignore_index=True)
+        self._batch = []
+
+        name = f"part-{self._next:06}.parquet"
+        # readers skip files starting with a dot, so an unfinished file is never read
+        tmp, path = join(self.path, "." + name), join(self.path, name)
+        pq.write_table(pa.Table.from_pandas(df, schema=self._schema, preserve_index=False), tmp,
+                       compression=self._compression)
+        os.replace(tmp, path)
+        self._next += 1
+        self.parts += 1
+        self.nbytes += getsize(path)
+        self.rows += len(df)
+
+    def close(self):
+        """
+        Flush the remaining snapshots
+        """
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class PositionsStore:
+    """
+    Append-only store of bus positions, partitioned hive-style by date and hour (and optionally by line):
+    <path>/date=2024-01-01/hour=12[/Lines=123]/part-<id>-0.parquet
+
+    Every flush adds new files to the partitions it touches, existing files are never rewritten.
+    Reads only open partitions matching the requested time range and lines.
+    Can be passed to WawBus.collect_positions as a writer.
+
+    Attributes:
+        path (str): root directory of the store
+        by_line (bool): whether positions are also partitioned by line
+        batch_size (int): number of snapshots written at once
+        rows (int): number of rows written so far
+    """
+    path: str
+    by_line: bool = False
+    batch_size: int
+    rows: int = 0
+
+    def __init__(self, path: str, by_line: Optional[bool] = None, batch_size: int = 1):
+        """
+        Args:
+            path (str): root directory of the store, created on the first write
+            by_line (bool): partition positions by line too, detected from existing files by default
+            batch_size (int): number of snapshots written at once, every write creates a file in every partition
+                it touches, so bigger batches mean fewer files
+        """
+        self.path = path
+        if by_line is None:
+            by_line = bool(glob(join(path, "date=*", "hour=*", "Lines=*")))
+        self.by_line = by_line
+        self.batch_size = batch_size
+        self._batch = []
+
+        fields = [("date", pa.string()), ("hour", pa.int8())]
+        if by_line:
+            fields.append(("Lines", pa.string()))
+        self._partitioning = ds.partitioning(pa.schema(fields), flavor="hive")
+
+    def write(self, df: pd.DataFrame):
+        """
+        Add a snapshot to the current batch, the batch is written once it has batch_size snapshots
+
+        Args:
+            df (pd.DataFrame): snapshot of bus positions
+        """
+        self._batch.append(df)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the current batch as new files of its partitions
+        """
+        if not self._batch:
+            return
+        df = pd.concat(self._batch, ignore_index=True)
+        self._batch = []
+        if df.empty:
+            return
+
+        table = pa.Table.from_pandas(df[POSITIONS_SCHEMA.names], schema=POSITIONS_SCHEMA, preserve_index=False)
+        time = df["Time"].dt
+        table = table.append_column("date", pa.array(time.strftime("%Y-%m-%d").values, pa.string()))
+        table = table.append_column("hour", pa.array(time.hour.values, pa.int8()))
+        ds.write_dataset(table, self.path, format="parquet", partitioning=self._partitioning,
+                         basename_template=f"part-{uuid4().hex}-{{i}}.parquet",
+                         existing_data_behavior="overwrite_or_ignore")
+        self.rows += len(df)
+
+    def close(self):
+        """
+        Flush the remaining snapshots
+        """
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def read(self, columns: Optional[List[str]] = None, lines: Optional[Iterable[str]] = None,
+             time_range: Optional[Tuple] = None) -> pd.DataFrame:
+        """
+        Read positions from the store as one dataframe, only partitions matching the filters are opened
+
+        Args:
+            columns (List[str]): columns to load, all position columns by default
+            lines (Iterable[str]): only load these lines
+            time_range (tuple): only load positions with start <= Time < end, either bound can be None
+
+        Returns:
+            pd.DataFrame: bus positions
+        """
+        if not isdir(self.path):
+            return pd.DataFrame(columns=columns or POSITIONS_SCHEMA.names)
+        dataset = ds.dataset(self.path, format="parquet", partitioning=self._partitioning)
+
+        expr = _positions_filter(POSITIONS_SCHEMA.field("Time").type, lines, time_range)
+        if time_range is not None:
+            # partition keys of the bounds, so only their partitions are listed
+            start, end = (None if t is None else pd.Timestamp(t) for t in time_range)
+            date, hour = ds.field("date"), ds.field("hour")
+            if start is not None:
+                day = start.strftime("%Y-%m-%d")
+                expr = _and(expr, (date > day) | ((date == day) & (hour >= start.hour)))
+            if end is not None:
+                day = end.strftime("%Y-%m-%d")
+                expr = _and(expr, (date < day) | ((date == day) & (hour <= end.hour)))
+
+        return dataset.to_table(columns=columns or POSITIONS_SCHEMA.names, filter=expr).to_pandas()
+
+
+class RollingPositionsWriter:
+    """
+    Streaming writer for long-running collection, starts a new output every rotate_every seconds
+    or once the current one reaches max_bytes. Outputs are PositionsWriter directories named
+    <prefix>-<YYYYmmdd-HHMMSS>.parquet after the time they were opened, written as <name>.part until they're complete,
+    so readers of finished outputs never see unfinished ones.
+
+    At most batch_size snapshots and max_buffer_rows rows are kept in memory before they are written.
+
+    Attributes:
+        prefix (str): path prefix of outputs
+        rotate_every (float): seconds after which a new output is started
+        max_bytes (int): size after which a new output is started, unlimited when None
+        batch_size (int): number of snapshots written as one file
+        max_buffer_rows (int): number of buffered rows after which the batch is written early
+        rows (int): number of rows written so far
+        files (List[str]): completed outputs
+    """
+    prefix: str
+    rotate_every: float
+    max_bytes: Optional[int] = None
+    batch_size: int
+    max_buffer_rows: int
+    rows: int = 0
+    files: List[str]
+
+    def __init__(self, prefix: str, rotate_every: float = 3600, max_bytes: Optional[int] = None, batch_size: int = 1,
+                 max_buffer_rows: int = 100_000, compression: Optional[str] = "snappy",
+                 clock: Callable[[], float] = time):
+        """
+        Args:
+            prefix (str): path prefix of outputs
+            rotate_every (float): seconds after which a new output is started
+            max_bytes (int): size after which a new output is started, unlimited when None
+            batch_size (int): number of snapshots written as one file
+            max_buffer_rows (int): number of buffered rows after which the batch is written early
+            compression (str): parquet compression codec
+            clock (Callable): wall-clock time source
+        """
+        self.prefix = prefix
+        self.rotate_every = rotate_every
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.max_buffer_rows = max_buffer_rows
+        self.files = []
+        self._compression = compression
+        self._clock = clock
+        self._batch = []
+        self._buffered = 0
+        self._writer: Optional[PositionsWriter] = None
+        self._opened = 0.0
+
+    def write(self, df: pd.DataFrame):
+        """
+        Add a snapshot to the current batch, the batch is written once it has batch_size snapshots
+        or max_buffer_rows rows
+
+        Args:
+            df (pd.DataFrame): snapshot of bus positions
+        """
+        self._batch.append(df)
+        self._buffered += len(df)
+        if len(self._batch) >= self.batch_size or self._buffered >= self.max_buffer_rows:
+            self.flush()
+
+    def _due(self) -> bool:
+        if self._writer is None:
+            return True
+        if self._clock() - self._opened >= self.rotate_every:
+            return True
+        return self.max_bytes is not None and self._writer.nbytes >= self.max_bytes
+
+    def rotate(self):
+        """
+        Complete the current output, the next batch is written to a new one
+        """
+        if self._writer is None:
+            return
+        self._writer.close()
+        path = self._writer.path[:-len(".part")]
+        os.replace(self._writer.path, path)
+        self.files.append(path)
+        self._writer = None
+
+    def flush(self):
+        """
+        Write the current batch as a file, starting a new output first when the current one is due
+        """
+        if not self._batch:
+            return
+        if self._due():
+            self.rotate()
+            self._opened = self._clock()
+            name = f"{self.prefix}-{datetime.fromtimestamp(self._opened):%Y%m%d-%H%M%S}"
+            path, n = f"{name}.parquet", 1
+            while exists(path) or exists(path + ".part"):
+                path, n = f"{name}-{n}.parquet", n + 1
+            self._writer = PositionsWriter(path + ".part", compression=self._compression)
+
+        df = pd.concat(self._batch, ignore_index=True)
+        self._batch, self._buffered = [], 0
+        self._writer.write(df)
+        self.rows += len(df)
+
+    def close(self):
+        """
+        Flush the remaining snapshots and complete the current output
+        """
+        self.flush()
+        self.rotate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
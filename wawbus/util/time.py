@@ -1,3 +1,8 @@
+import numpy as np
+
+DAY_TYPES = ("weekday", "saturday", "sunday")
+
+
 def timeint(x):
     """
     Pandas UDF which returns seconds from 00:00:00.
@@ -9,3 +14,32 @@ def timeint(x):
         int: Seconds from 00:00:00
     """
     return x.hour * 3600 + x.minute * 60 + x.second
+
+
+def timeint_np(x) -> np.ndarray:
+    """
+    Vectorized version of timeint.
+
+    Args:
+        x (np.ndarray): datetime64 values, without NaT
+
+    Returns:
+        np.ndarray: int32 seconds from 00:00:00
+    """
+    x = np.asarray(x, dtype='datetime64[s]')
+    return (x - x.astype('datetime64[D]')).astype(np.int32)
+
+
+def day_type_np(x) -> np.ndarray:
+    """
+    Timetable day type of every timestamp, public holidays aren't recognized.
+
+    Args:
+        x (np.ndarray): datetime64 values, without NaT
+
+    Returns:
+        np.ndarray: int8 positions in DAY_TYPES
+    """
+    days = np.asarray(x, dtype='datetime64[D]').astype(np.int64)
+    weekday = (days + 3) % 7  # 1970-01-01 was a Thursday, 0 is Monday
+    return np.clip(weekday - 4, 0, 2).astype(np.int8)
@@ -0,0 +1,155 @@
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+from .time import timeint_np
+
+
+def timetable_locations(tt: pd.DataFrame, stops: pd.DataFrame) -> pd.DataFrame:
+    """
+    Args:
+        tt (pd.DataFrame): timetable
+        stops (pd.DataFrame): stop locations
+
+    Returns:
+        pd.DataFrame: timetable joined with stop locations, with "t" column (seconds from 00:00:00 of "czas")
+    """
+    tt_loc = pd.merge(tt, stops, left_on=['nr_zespolu', 'nr_przystanku'], right_on=['zespol', 'slupek'])
+    tt_loc = tt_loc.drop(columns=['zespol', 'slupek'])
+    tt_loc['t'] = timeint_np(tt_loc['czas'].values)
+    return tt_loc
+
+
+def _factorize(values) -> Tuple[np.ndarray, pd.Index]:
+    codes, uniques = pd.factorize(values)
+    return codes, pd.Index(np.asarray(uniques))
+
+
+def _codes(index: pd.Index, values) -> np.ndarray:
+    if isinstance(getattr(values, 'dtype', None), pd.CategoricalDtype):
+        # look up every category once instead of every value, code -1 (NaN) stays -1
+        values = pd.Categorical(values)
+        return np.append(index.get_indexer(values.categories), -1)[values.codes]
+    return index.get_indexer(values)
+
+
+class TimetableIndex:
+    """
+    Timetable with stop locations, indexed by (line, brigade) with departures of every brigade sorted by time,
+    so the last departure before a position is found with a binary search instead of a merge.
+
+    Attributes:
+        frame (pd.DataFrame): timetable with stop locations and "t" column, sorted by line, brigade and "t",
+            rows are referenced by positions returned from lookup
+    """
+    frame: pd.DataFrame
+
+    def __init__(self, tt_loc: pd.DataFrame):
+        """
+        Args:
+            tt_loc (pd.DataFrame): timetable with stop locations and "t" column (see timetable_locations)
+        """
+        line, self._lines = _factorize(tt_loc['bus'])
+        brigade, self._brigades = _factorize(tt_loc['brygada'])
+        group = line.astype(np.int64) * len(self._brigades) + brigade
+        t = tt_loc['t'].values.astype(np.int64)
+
+        # stable, so entries with equal time keep their order
+        order = np.lexsort((t, group))
+        self.frame = tt_loc.iloc[order].reset_index(drop=True)
+        self._group = group[order]
+        self._keys = (self._group << 32) + t[order]
+        self._row_ids = None
+
+    def __len__(self):
+        return len(self.frame)
+
+    @property
+    def keys(self) -> np.ndarray:
+        """
+        Returns:
+            np.ndarray: sorted search keys of self.frame rows, (line, brigade) group in the high 32 bits
+                and departure time in the low ones
+        """
+        return self._keys
+
+    @property
+    def row_ids(self) -> np.ndarray:
+        """
+        Returns:
+            np.ndarray: id of every row of self.frame, equal for rows which only differ in 'bus', 'brygada' and 't',
+                so they give equal rows of late_join when matched with the same position
+        """
+        if self._row_ids is None:
+            columns = [c for c in self.frame.columns if c not in ('bus', 'brygada', 't')]
+            self._row_ids = self.frame.groupby(columns, sort=False, dropna=False, observed=True).ngroup().values \
+                if columns else np.zeros(len(self), dtype=np.int64)
+        return self._row_ids
+
+    def groups(self, lines, brigades) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Args:
+            lines: line of every position
+            brigades: brigade of every position
+
+        Returns:
+            line codes and (line, brigade) group codes of every position, -1 when they aren't in the timetable
+        """
+        line = _codes(self._lines, lines).astype(np.int64)
+        brigade = _codes(self._brigades, brigades)
+        group = np.where((line >= 0) & (brigade >= 0), line * len(self._brigades) + brigade, -1)
+        return line, group
+
+    def line_bounds(self, line: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Args:
+            line (np.ndarray): line codes (see groups)
+
+        Returns:
+            first and past-the-last positions of rows of every line in self.frame
+        """
+        line = np.asarray(line, dtype=np.int64)
+        return (np.searchsorted(self._group, line * len(self._brigades), side='left'),
+                np.searchsorted(self._group, (line + 1) * len(self._brigades), side='left'))
+
+    def lookup(self, lines, brigades, t: np.ndarray, tolerance: int) -> np.ndarray:
+        """
+        Find the last departure of the brigade at or before the given time, like a backward merge_asof
+
+        Args:
+            lines: line of every position
+            brigades: brigade of every position
+            t (np.ndarray): seconds from 00:00:00 of every position
+            tolerance (int): maximum number of seconds since the departure
+
+        Returns:
+            np.ndarray: positions in self.frame, -1 when there's no departure within tolerance
+        """
+        if not len(self):
+            return np.full(len(t), -1, dtype=np.int64)
+        return lookup_keys(self._keys, self.groups(lines, brigades)[1], t, tolerance)
+
+
+def lookup_keys(keys: np.ndarray, group: np.ndarray, t: np.ndarray, tolerance: int) -> np.ndarray:
+    """
+    Binary search of TimetableIndex.lookup, also works on a subset of the keys covering whole lines
+
+    Args:
+        keys (np.ndarray): sorted keys (see TimetableIndex.keys)
+        group (np.ndarray): (line, brigade) group code of every position, -1 when it isn't in the timetable
+        t (np.ndarray): seconds from 00:00:00 of every position
+        tolerance (int): maximum number of seconds since the departure
+
+    Returns:
+        np.ndarray: positions in keys, -1 when there's no departure within tolerance
+    """
+    group = np.asarray(group, dtype=np.int64)
+    t = np.asarray(t, dtype=np.int64)
+    if not len(keys):
+        return np.full(len(t), -1, dtype=np.int64)
+    pos = np.searchsorted(keys, (group << 32) + t, side='right') - 1
+    found = (group >= 0) & (pos >= 0)
+    pos = np.where(found, pos, 0)
+    found &= ((keys[pos] >> 32) == group) & (t - (keys[pos] & 0xFFFFFFFF) <= tolerance)
+    return np.where(found, pos, -1)
@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+
+
+def shift_next(values: np.ndarray, last: np.ndarray) -> np.ndarray:
+    """
+    Args:
+        values (np.ndarray): values of consecutive segments
+        last (np.ndarray): positions of the last element of each segment
+
+    Returns:
+        np.ndarray: the following element of the same segment, NaN (or NaT) for the last element of a segment
+    """
+    if np.issubdtype(values.dtype, np.datetime64):
+        shifted = np.empty_like(values)
+        fill = np.datetime64('NaT')
+    else:
+        shifted = np.empty(len(values), dtype=np.result_type(values.dtype, np.float64))
+        fill = np.nan
+    shifted[:-1] = values[1:]
+    shifted[last] = fill
+    return shifted
+
+
+class Trajectories:
+    """
+    Per-vehicle trajectory layout of a positions dataframe.
+
+    The dataframe is stably sorted once by (VehicleNumber, Time), every vehicle then occupies
+    a contiguous segment of the sorted order. Per-vehicle analyses (speed, acceleration, dwell time, gaps)
+    can work on neighbouring elements of a segment without grouping or sorting again.
+
+    Attributes:
+        order (np.ndarray): row positions of the original dataframe, in sorted order
+        offsets (np.ndarray): segment boundaries, vehicle i occupies order[offsets[i]:offsets[i + 1]]
+        vehicles (np.ndarray): vehicle numbers, one per segment
+    """
+    order: np.ndarray
+    offsets: np.ndarray
+    vehicles: np.ndarray
+
+    def __init__(self, df: pd.DataFrame):
+        """
+        Args:
+            df (pd.DataFrame): dataframe with 'VehicleNumber' and 'Time' columns
+        """
+        codes, self.vehicles = pd.factorize(df['VehicleNumber'], sort=True)
+        times = df['Time'].values.astype('datetime64[ns]').view(np.int64)
+        # lexsort is stable and sorts by the last key first
+        self.order = np.lexsort((times, codes))
+
+        sorted_codes = codes[self.order]
+        boundaries = np.flatnonzero(sorted_codes[1:] != sorted_codes[:-1]) + 1
+        if len(sorted_codes):
+            self.offsets = np.concatenate(([0], boundaries, [len(sorted_codes)])).astype(np.int64)
+        else:
+            self.offsets = np.zeros(1, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    @property
+    def last(self) -> np.ndarray:
+        """
+        Returns:
+            np.ndarray: positions (in sorted order) of the last element of each segment
+        """
+        return self.offsets[1:] - 1
+
+    def take(self, values) -> np.ndarray:
+        """
+        Args:
+            values: column of the original dataframe
+
+        Returns:
+            np.ndarray: values in sorted order
+        """
+        return np.asarray(values)[self.order]
+
+    def next(self, values) -> np.ndarray:
+        """
+        Args:
+            values (np.ndarray): values in sorted order (see take)
+
+        Returns:
+            np.ndarray: the following element of the same segment, NaN (or NaT) for the last element of a segment
+        """
+        return shift_next(values, self.last)
+
+    def scatter(self, values) -> np.ndarray:
+        """
+        Args:
+            values (np.ndarray): values in sorted order
+
+        Returns:
+            np.ndarray: values in the row order of the original dataframe
+        """
+        out = np.empty_like(values)
+        out[self.order] = values
+        return out